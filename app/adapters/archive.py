@@ -0,0 +1,205 @@
+"""Archival of batches that can not be allocated to anymore.
+
+Batches are never removed from a product by the domain, so without archival every
+load of a product hydrates the batches that ran out long ago, with all of their
+allocations. Exhausted batches are moved with their allocations and order lines to
+the archive tables, in chunks that each get their own transaction.
+
+A batch is only archived once its last allocation is older than the retention
+window and it holds no stock for a reservation. Within the window the lines of
+the batch can still be deallocated and its quantity changed; after it the
+allocations are final and only the views still read them.
+"""
+from datetime import datetime, timedelta
+from typing import Callable, Optional, Tuple
+
+from sqlalchemy import Table, and_, delete, exists, func, insert, select, update
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.elements import ClauseElement
+from sqlalchemy.sql.selectable import Select
+
+from app.adapters import orm
+from app.adapters.repository import batch_allocated_quantity
+
+
+def archivable_batches(cutoff: datetime) -> ClauseElement:
+    """Condition on the batches that can be archived.
+
+    Args:
+        cutoff: naive utc time the last allocation of a batch must be older than
+
+    Returns:
+        where clause on the batches table
+    """
+    recent_allocations = (
+        select([orm.allocations.c.id])
+        .where(orm.allocations.c.batch_id == orm.batches.c.id)
+        .where(orm.allocations.c.allocated_at > cutoff)
+    )
+    holds = select([orm.reservations.c.id]).where(
+        orm.reservations.c.batch_id == orm.batches.c.id
+    )
+    return and_(
+        orm.batches.c._purchased_quantity <= batch_allocated_quantity(),
+        ~exists(recent_allocations),
+        ~exists(holds),
+    )
+
+
+def exhausted_batches_query(cutoff: datetime, chunk_size: int) -> Select:
+    """Query for the ids and number of lines of the batches to archive.
+
+    Args:
+        cutoff: naive utc time the last allocation of a batch must be older than
+        chunk_size: maximum number of batches to select
+
+    Returns:
+        select statement for the id and number of lines of the batches
+    """
+    lines = (
+        select([func.count()])
+        .where(orm.allocations.c.batch_id == orm.batches.c.id)
+        .as_scalar()
+    )
+    return (
+        select([orm.batches.c.id, lines])
+        .where(archivable_batches(cutoff))
+        .order_by(orm.batches.c.id)
+        .limit(chunk_size)
+    )
+
+
+def _chunk_bounds(
+    session: Session, cutoff: datetime, chunk_size: int
+) -> Optional[Tuple[int, int]]:
+    """Get the range of batch ids whose order lines fit in one chunk.
+
+    The first batch is always in the chunk, even when it has more lines.
+    """
+    bounds = None
+    total = 0
+    for batch_id, lines in session.execute(exhausted_batches_query(cutoff, chunk_size)):
+        total += lines
+        if bounds and total > chunk_size:
+            break
+        bounds = (bounds[0] if bounds else batch_id, batch_id)
+    return bounds
+
+
+def _copy_rows(
+    session: Session, source: Table, target: Table, where: ClauseElement
+) -> None:
+    """Copy the rows matching a condition to the table with the same columns."""
+    session.execute(
+        insert(target).from_select(
+            [column.name for column in source.c],
+            select(list(source.c)).where(where),
+        )
+    )
+
+
+def archive_chunk(session: Session, cutoff: datetime, chunk_size: int) -> int:
+    """Move a chunk of exhausted batches to the archive tables.
+
+    The chunk is the live batches in one range of ids that can be archived. They
+    are copied with their allocations and order lines before anything is deleted,
+    as a batch stops being exhausted once its allocations are deleted; the deletes
+    then select the chunk from the copies. The ids of the tables are never reused,
+    so the archive tables only hold ids that are not live anymore. The version of
+    the products losing batches is increased, so units of work that loaded one of
+    these batches concurrently fail instead of writing to them. The changes are
+    not committed.
+
+    Args:
+        session: session to run the statements in
+        cutoff: naive utc time the last allocation of a batch must be older than
+        chunk_size: maximum number of order lines to archive, unless a single
+            batch has more
+
+    Returns:
+        the number of batches archived
+    """
+    bounds = _chunk_bounds(session, cutoff, chunk_size)
+    if bounds is None:
+        return 0
+    in_bounds = orm.batches.c.id.between(*bounds)
+    batch_ids = select([orm.batches.c.id]).where(in_bounds)
+    chunk = batch_ids.where(archivable_batches(cutoff))
+    _copy_rows(
+        session,
+        orm.allocations,
+        orm.archived_allocations,
+        orm.allocations.c.batch_id.in_(chunk),
+    )
+    _copy_rows(
+        session,
+        orm.order_lines,
+        orm.archived_order_lines,
+        orm.order_lines.c.id.in_(
+            select([orm.allocations.c.orderline_id]).where(
+                orm.allocations.c.batch_id.in_(chunk)
+            )
+        ),
+    )
+    _copy_rows(session, orm.batches, orm.archived_batches, orm.batches.c.id.in_(chunk))
+
+    copied = batch_ids.where(
+        orm.batches.c.id.in_(
+            select([orm.archived_batches.c.id]).where(
+                orm.archived_batches.c.id.between(*bounds)
+            )
+        )
+    )
+    copied_allocations = select([orm.archived_allocations.c.id]).where(
+        orm.archived_allocations.c.batch_id.in_(copied)
+    )
+    line_ids = select([orm.archived_allocations.c.orderline_id]).where(
+        orm.archived_allocations.c.batch_id.in_(copied)
+    )
+    session.execute(
+        update(orm.products)
+        .where(
+            orm.products.c.sku.in_(
+                select([orm.batches.c.sku]).where(orm.batches.c.id.in_(copied))
+            )
+        )
+        .values(version_number=orm.products.c.version_number + 1)
+    )
+    session.execute(
+        delete(orm.allocations).where(orm.allocations.c.id.in_(copied_allocations))
+    )
+    session.execute(delete(orm.order_lines).where(orm.order_lines.c.id.in_(line_ids)))
+    result = session.execute(delete(orm.batches).where(orm.batches.c.id.in_(copied)))
+    return int(result.rowcount)
+
+
+def archive_exhausted_batches(
+    session_factory: Callable[[], Session],
+    chunk_size: int = 1000,
+    retention: timedelta = timedelta(days=90),
+    now: Optional[datetime] = None,
+) -> int:
+    """Archive all exhausted batches past the retention, committing every chunk.
+
+    Args:
+        session_factory: Callable that returns a sqlalchemy session
+        chunk_size: maximum number of order lines archived in one transaction
+        retention: how long after its last allocation a batch is kept
+        now: naive utc time the retention is counted back from, defaults to the
+            current time
+
+    Returns:
+        the number of batches archived
+    """
+    cutoff = (now or datetime.utcnow()) - retention
+    archived = 0
+    while True:
+        session = session_factory()
+        try:
+            archived_in_chunk = archive_chunk(session, cutoff, chunk_size)
+            session.commit()
+        finally:
+            session.close()
+        if not archived_in_chunk:
+            return archived
+        archived += archived_in_chunk
@@ -0,0 +1,64 @@
+"""In-process cache with a time to live and a bounded size."""
+import threading
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, Optional, Tuple, TypeVar
+
+V = TypeVar("V")
+
+
+class TTLCache(Generic[V]):
+    """Least recently used cache whose entries also expire after a while.
+
+    The cache is safe to share between threads.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        """Init method.
+
+        Args:
+            maxsize: number of entries kept, the least recently used entry is
+                evicted when it is full
+            ttl: seconds an entry is kept
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, V]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[V]:
+        """Get a cached value.
+
+        Args:
+            key: key of the value
+
+        Returns:
+            the value, None when it is not cached or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: V) -> None:
+        """Cache a value.
+
+        Args:
+            key: key of the value
+            value: the value
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        """Number of cached entries, including the expired ones not evicted yet."""
+        return len(self._entries)
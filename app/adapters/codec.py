@@ -0,0 +1,363 @@
+"""Wire format of the commands and events.
+
+Every Command and Event dataclass gets an encoder and a decoder that are compiled
+once from its type hints, so encoding a message does not inspect its class again.
+The encoding is compact json: the name of the message type under "type" and only
+the fields that differ from their default. Decoding validates the type of every
+field, dates and times travel as iso strings. Unknown keys are ignored, so
+producers can add optional fields before every consumer knows them.
+
+The entry points, the bulk command files, the dead letter store, the event log and
+the event store all use this module.
+"""
+import dataclasses
+import json
+from datetime import date, datetime
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+    get_type_hints,
+)
+
+from app.domain import commands, events
+
+Message = Union[commands.Command, events.Event]
+M = TypeVar("M")
+
+_MISSING = dataclasses.MISSING
+
+
+class ValidationError(ValueError):
+    """A message could not be decoded."""
+
+    pass
+
+
+class MissingFieldError(ValidationError, KeyError):
+    """A required field of a message is missing, str() is the quoted field name."""
+
+    def __str__(self) -> str:
+        """Quote the name of the field, like a KeyError."""
+        return KeyError.__str__(self)
+
+
+class EmptyBodyError(ValidationError):
+    """A request has no json body to build a message from."""
+
+    pass
+
+
+def _encode_field(hint: Any) -> Callable[[Any], Any]:
+    """Get the function converting a field value to its json value."""
+    if hint in (date, datetime) or hint in (Union[date, None], Union[datetime, None]):
+        return lambda value: value.isoformat() if value is not None else None
+    return lambda value: value
+
+
+def _is_int(value: Any) -> bool:
+    """Check that a json value is an int, booleans are not."""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_quantities(value: Any) -> bool:
+    """Check that a json value is an object of ints."""
+    if not isinstance(value, dict):
+        return False
+    return all(isinstance(k, str) and _is_int(v) for k, v in value.items())
+
+
+def _checked(valid: Callable[[Any], bool]) -> Callable[[Any], Any]:
+    """Get a conversion that keeps the json values passing a check."""
+
+    def convert(value: Any) -> Any:
+        if not valid(value):
+            raise ValueError(value)
+        return value
+
+    return convert
+
+
+def _from_iso(kind: type) -> Callable[[Any], Any]:
+    """Get a conversion of iso strings to dates or datetimes."""
+
+    def convert(value: Any) -> Any:
+        if isinstance(value, kind):
+            return value
+        parsed = datetime.fromisoformat(value)
+        return parsed if kind is datetime else parsed.date()
+
+    return convert
+
+
+_CONVERSIONS: Dict[Any, Callable[[Any], Any]] = {
+    str: _checked(lambda value: isinstance(value, str)),
+    int: _checked(_is_int),
+    date: _from_iso(date),
+    datetime: _from_iso(datetime),
+    Dict[str, int]: _checked(_is_quantities),
+}
+
+
+def _decode_field(name: str, hint: Any) -> Callable[[Any], Any]:
+    """Get the function validating a json value and converting it to the field."""
+    optional = (
+        getattr(hint, "__origin__", None) is Union and type(None) in hint.__args__
+    )
+    if optional:
+        hint = next(arg for arg in hint.__args__ if arg is not type(None))
+    try:
+        conversion = _CONVERSIONS[hint]
+    except KeyError:
+        raise TypeError(f"No codec for field {name} of type {hint}") from None
+
+    def convert(value: Any) -> Any:
+        if value is None and optional:
+            return None
+        try:
+            return conversion(value)
+        except (TypeError, ValueError):
+            raise ValidationError(f"Invalid value {value!r} for {name}") from None
+
+    return convert
+
+
+@dataclasses.dataclass(frozen=True)
+class _Field:
+    """A field of a message type with its compiled conversions."""
+
+    name: str
+    default: Any
+    encode: Callable[[Any], Any]
+    decode: Callable[[Any], Any]
+
+    @property
+    def required(self) -> bool:
+        """Whether the field has no default."""
+        return self.default is _MISSING
+
+
+class MessageCodec:
+    """Encoder and decoder of one message type."""
+
+    def __init__(self, message_type: type):
+        """Compile the conversions of the fields of a message dataclass.
+
+        Args:
+            message_type: Command or Event dataclass
+        """
+        self.message_type = message_type
+        self.name = message_type.__name__
+        hints = get_type_hints(message_type)
+        self.fields: List[_Field] = []
+        for field in dataclasses.fields(message_type):
+            default = field.default
+            if field.default_factory is not _MISSING:
+                default = field.default_factory()
+            hint = hints[field.name]
+            self.fields.append(
+                _Field(
+                    field.name,
+                    default,
+                    _encode_field(hint),
+                    _decode_field(field.name, hint),
+                )
+            )
+
+    def to_dict(self, message: Any) -> Dict[str, Any]:
+        """Get the json values of the fields that differ from their default.
+
+        Args:
+            message: message of this type
+
+        Returns:
+            the values by field name
+        """
+        values = {}
+        for field in self.fields:
+            value = getattr(message, field.name)
+            if field.required or value != field.default:
+                values[field.name] = field.encode(value)
+        return values
+
+    def from_dict(self, values: Any) -> Any:
+        """Build a message from json values, validating them.
+
+        Args:
+            values: json object with the values by field name
+
+        Returns:
+            the message
+
+        Raises:
+            ValidationError: when the values are not a valid message
+            MissingFieldError: when a required field is missing
+        """
+        if not isinstance(values, dict):
+            raise ValidationError(f"Expected a json object for {self.name}")
+        kwargs = {}
+        for field in self.fields:
+            if field.name in values:
+                kwargs[field.name] = field.decode(values[field.name])
+            elif field.required:
+                raise MissingFieldError(field.name)
+        return self.message_type(**kwargs)
+
+
+def _message_types() -> Dict[str, type]:
+    """Get every command and event dataclass by name."""
+    types: Dict[str, type] = {}
+    for base in (commands.Command, events.Event):
+        pending = list(base.__subclasses__())
+        while pending:
+            message_type = pending.pop()
+            pending.extend(message_type.__subclasses__())
+            if dataclasses.is_dataclass(message_type):
+                types[message_type.__name__] = message_type
+    return types
+
+
+CODECS: Dict[str, MessageCodec] = {
+    name: MessageCodec(message_type) for name, message_type in _message_types().items()
+}
+_CODECS_BY_TYPE: Dict[type, MessageCodec] = {
+    codec.message_type: codec for codec in CODECS.values()
+}
+_SEPARATORS: Tuple[str, str] = (",", ":")
+
+
+def codec_for(message_type: Union[str, type]) -> MessageCodec:
+    """Get the codec of a message type.
+
+    Args:
+        message_type: the class of the message or its name
+
+    Returns:
+        the codec
+
+    Raises:
+        ValidationError: for an unknown message type
+    """
+    try:
+        if isinstance(message_type, str):
+            return CODECS[message_type]
+        return _CODECS_BY_TYPE[message_type]
+    except KeyError:
+        raise ValidationError(f"Unknown message type {message_type}") from None
+
+
+def to_dict(message: Message) -> Dict[str, Any]:
+    """Get the json values of a message, with its type name under "type".
+
+    Args:
+        message: command or event
+
+    Returns:
+        json object of the message
+    """
+    codec = codec_for(type(message))
+    values = codec.to_dict(message)
+    values["type"] = codec.name
+    return values
+
+
+def from_dict(message_type: Type[M], values: Any) -> M:
+    """Build a message of a known type from json values.
+
+    Args:
+        message_type: the class of the message
+        values: json object with the values by field name
+
+    Returns:
+        the message
+    """
+    return codec_for(message_type).from_dict(values)  # type: ignore[no-any-return]
+
+
+def from_json_body(message_type: Type[M], body: Any, **extra: Optional[str]) -> M:
+    """Build a message from the json body of a request and fields from its headers.
+
+    Args:
+        message_type: the class of the message
+        body: the decoded json body, None when the request has none
+        extra: values of fields that do not come from the body, None values are
+            left out
+
+    Returns:
+        the message
+
+    Raises:
+        EmptyBodyError: when there is no body
+        ValidationError: when the values are not a valid message
+    """
+    if body is None:
+        raise EmptyBodyError("no json body")
+    if isinstance(body, dict):
+        body = {**body, **{k: v for k, v in extra.items() if v is not None}}
+    return from_dict(message_type, body)
+
+
+def encode(message: Message) -> str:
+    """Get the compact json of a message, with its type.
+
+    Args:
+        message: command or event
+
+    Returns:
+        the json
+    """
+    return json.dumps(to_dict(message), separators=_SEPARATORS)
+
+
+def decode(data: Union[str, bytes]) -> Message:
+    """Build a message from the json made by encode.
+
+    Args:
+        data: the json
+
+    Returns:
+        the command or event
+
+    Raises:
+        ValidationError: when the json is not a valid message
+    """
+    try:
+        values = json.loads(data)
+    except ValueError as e:
+        raise ValidationError(f"Invalid json: {e}") from None
+    if not isinstance(values, dict) or "type" not in values:
+        raise ValidationError("Expected a json object with the message type")
+    return codec_for(values["type"]).from_dict(values)  # type: ignore[no-any-return]
+
+
+def encode_payload(message: Message) -> str:
+    """Get the compact json of the fields of a message, for a separate type column.
+
+    Args:
+        message: command or event
+
+    Returns:
+        the json, without the type
+    """
+    return json.dumps(codec_for(type(message)).to_dict(message), separators=_SEPARATORS)
+
+
+def decode_payload(message_type: str, payload: Union[str, bytes]) -> Message:
+    """Build a message from its type name and the json of its fields.
+
+    Args:
+        message_type: name of the class of the message
+        payload: the json made by encode_payload
+
+    Returns:
+        the command or event
+    """
+    return codec_for(message_type).from_dict(  # type: ignore[no-any-return]
+        json.loads(payload)
+    )
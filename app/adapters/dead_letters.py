@@ -0,0 +1,172 @@
+"""Storage for events whose handlers kept failing.
+
+A dead letter keeps the event and the name of the handler that failed, so the
+handler can be replayed for it once the cause of the failures is fixed.
+"""
+import abc
+from dataclasses import dataclass
+from typing import Callable, List, Optional, cast
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.orm import Session
+
+from app.adapters import codec, orm
+from app.domain import events
+
+
+@dataclass(frozen=True)
+class DeadLetter:
+    """Event that a handler failed to handle in all of its attempts."""
+
+    id: int
+    handler: str
+    event: events.Event
+    error: str
+    attempts: int
+
+
+class AbstractDeadLetterStore(abc.ABC):
+    """Interface for storing dead letters."""
+
+    @abc.abstractmethod
+    def add(self, handler: str, event: events.Event, error: str, attempts: int) -> None:
+        """Store an event that a handler failed to handle.
+
+        Args:
+            handler: name of the handler
+            event: event the handler failed on
+            error: description of the last failure
+            attempts: number of times the handler was called
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def list(self, ids: Optional[List[int]] = None) -> List[DeadLetter]:
+        """Get the stored dead letters, oldest first.
+
+        Args:
+            ids: ids of the dead letters to get, all of them when None
+
+        Returns:
+            the dead letters
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def record_failure(self, id: int, error: str) -> None:
+        """Record that replaying a dead letter failed again.
+
+        Args:
+            id: id of the dead letter
+            error: description of the failure
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove(self, id: int) -> None:
+        """Remove a dead letter, after it was replayed successfully.
+
+        Args:
+            id: id of the dead letter
+        """
+        raise NotImplementedError
+
+
+class SqlAlchemyDeadLetterStore(AbstractDeadLetterStore):
+    """Dead letters in the dead_letters table.
+
+    Every call uses its own short transaction, so storing a dead letter does not
+    depend on the unit of work the handler failed in.
+    """
+
+    def __init__(self, session_factory: Callable[[], Session]):
+        """Init method.
+
+        Args:
+            session_factory: Callable that returns a sqlalchemy session
+        """
+        self.session_factory = session_factory
+
+    def add(self, handler: str, event: events.Event, error: str, attempts: int) -> None:
+        """Store an event that a handler failed to handle.
+
+        Args:
+            handler: name of the handler
+            event: event the handler failed on
+            error: description of the last failure
+            attempts: number of times the handler was called
+        """
+        session = self.session_factory()
+        try:
+            session.execute(
+                insert(orm.dead_letters).values(
+                    handler=handler,
+                    event_type=type(event).__name__,
+                    payload=codec.encode_payload(event),
+                    error=error,
+                    attempts=attempts,
+                )
+            )
+            session.commit()
+        finally:
+            session.close()
+
+    def list(self, ids: Optional[List[int]] = None) -> List[DeadLetter]:
+        """Get the stored dead letters, oldest first.
+
+        Args:
+            ids: ids of the dead letters to get, all of them when None
+
+        Returns:
+            the dead letters
+        """
+        query = select([orm.dead_letters]).order_by(orm.dead_letters.c.id)
+        if ids is not None:
+            query = query.where(orm.dead_letters.c.id.in_(ids))
+        session = self.session_factory()
+        try:
+            return [
+                DeadLetter(
+                    row.id,
+                    row.handler,
+                    cast(
+                        events.Event, codec.decode_payload(row.event_type, row.payload)
+                    ),
+                    row.error,
+                    row.attempts,
+                )
+                for row in session.execute(query)
+            ]
+        finally:
+            session.close()
+
+    def record_failure(self, id: int, error: str) -> None:
+        """Record that replaying a dead letter failed again.
+
+        Args:
+            id: id of the dead letter
+            error: description of the failure
+        """
+        session = self.session_factory()
+        try:
+            session.execute(
+                update(orm.dead_letters)
+                .where(orm.dead_letters.c.id == id)
+                .values(error=error, attempts=orm.dead_letters.c.attempts + 1)
+            )
+            session.commit()
+        finally:
+            session.close()
+
+    def remove(self, id: int) -> None:
+        """Remove a dead letter, after it was replayed successfully.
+
+        Args:
+            id: id of the dead letter
+        """
+        session = self.session_factory()
+        try:
+            session.execute(delete(orm.dead_letters).where(orm.dead_letters.c.id == id))
+            session.commit()
+        finally:
+            session.close()
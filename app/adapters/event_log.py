@@ -0,0 +1,205 @@
+"""Append-only log of the events raised by the aggregates.
+
+The events of a unit of work are inserted with one statement in the transaction
+of its commit, so the log holds exactly the events of the committed changes. The
+log can be read back in chunks to replay events into handlers, from a named
+checkpoint that is moved forward after every chunk.
+"""
+import abc
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple, cast
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+
+from app.adapters import codec, orm
+from app.domain import events
+
+
+def append(session: Session, logged: Sequence[events.Event]) -> None:
+    """Add events to the log, without committing.
+
+    Args:
+        session: session of the unit of work that raised the events
+        logged: the events, in the order they were raised
+    """
+    if not logged:
+        return
+    session.execute(
+        insert(orm.event_log),
+        [
+            {
+                "event_type": type(event).__name__,
+                "sku": getattr(event, "sku", None),
+                "payload": codec.encode_payload(event),
+            }
+            for event in logged
+        ],
+    )
+
+
+class AbstractEventLog(abc.ABC):
+    """Interface for reading the event log."""
+
+    @abc.abstractmethod
+    def read(
+        self,
+        after: int,
+        chunk_size: int,
+        event_types: Optional[Sequence[str]] = None,
+    ) -> List[Tuple[int, events.Event]]:
+        """Get the next chunk of logged events.
+
+        Args:
+            after: position of the last event already read, 0 for the start
+            chunk_size: maximum number of events to get
+            event_types: names of the event types to get, all of them when None
+
+        Returns:
+            the events with their position in the log, in order
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_checkpoint(self, name: str) -> int:
+        """Get the position up to which a replay has handled the log.
+
+        Args:
+            name: name of the replay
+
+        Returns:
+            the position, 0 when the replay did not start yet
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def save_checkpoint(self, name: str, position: int) -> None:
+        """Store the position up to which a replay has handled the log.
+
+        Args:
+            name: name of the replay
+            position: position of the last handled event
+        """
+        raise NotImplementedError
+
+    def stream(
+        self,
+        checkpoint: str,
+        chunk_size: int = 1000,
+        event_types: Optional[Sequence[str]] = None,
+    ) -> Iterator[List[Tuple[int, events.Event]]]:
+        """Read the log in chunks from a checkpoint.
+
+        The checkpoint is moved past a chunk when the next chunk is asked for, so
+        a replay that stops halfway resumes with the chunk it was handling.
+
+        Args:
+            checkpoint: name of the replay
+            chunk_size: maximum number of events in a chunk
+            event_types: names of the event types to get, all of them when None
+
+        Yields:
+            the chunks of events with their position in the log
+        """
+        position = self.get_checkpoint(checkpoint)
+        while True:
+            chunk = self.read(position, chunk_size, event_types)
+            if not chunk:
+                return
+            yield chunk
+            position = chunk[-1][0]
+            self.save_checkpoint(checkpoint, position)
+
+
+class SqlAlchemyEventLog(AbstractEventLog):
+    """Event log in the event_log table, read with keyset pagination."""
+
+    def __init__(self, session_factory: Callable[[], Session]):
+        """Init method.
+
+        Args:
+            session_factory: Callable that returns a sqlalchemy session
+        """
+        self.session_factory = session_factory
+
+    def read(
+        self,
+        after: int,
+        chunk_size: int,
+        event_types: Optional[Sequence[str]] = None,
+    ) -> List[Tuple[int, events.Event]]:
+        """Get the next chunk of logged events.
+
+        Args:
+            after: position of the last event already read, 0 for the start
+            chunk_size: maximum number of events to get
+            event_types: names of the event types to get, all of them when None
+
+        Returns:
+            the events with their position in the log, in order
+        """
+        query = (
+            select(
+                [
+                    orm.event_log.c.id,
+                    orm.event_log.c.event_type,
+                    orm.event_log.c.payload,
+                ]
+            )
+            .where(orm.event_log.c.id > after)
+            .order_by(orm.event_log.c.id)
+            .limit(chunk_size)
+        )
+        if event_types is not None:
+            query = query.where(orm.event_log.c.event_type.in_(event_types))
+        session = self.session_factory()
+        try:
+            return [
+                (
+                    position,
+                    cast(events.Event, codec.decode_payload(event_type, payload)),
+                )
+                for position, event_type, payload in session.execute(query)
+            ]
+        finally:
+            session.close()
+
+    def get_checkpoint(self, name: str) -> int:
+        """Get the position up to which a replay has handled the log.
+
+        Args:
+            name: name of the replay
+
+        Returns:
+            the position, 0 when the replay did not start yet
+        """
+        session = self.session_factory()
+        try:
+            position = session.execute(
+                select([orm.event_log_checkpoints.c.position]).where(
+                    orm.event_log_checkpoints.c.name == name
+                )
+            ).scalar()
+            return int(position or 0)
+        finally:
+            session.close()
+
+    def save_checkpoint(self, name: str, position: int) -> None:
+        """Store the position up to which a replay has handled the log.
+
+        Args:
+            name: name of the replay
+            position: position of the last handled event
+        """
+        session = self.session_factory()
+        try:
+            session.execute(
+                delete(orm.event_log_checkpoints).where(
+                    orm.event_log_checkpoints.c.name == name
+                )
+            )
+            session.execute(
+                insert(orm.event_log_checkpoints).values(name=name, position=position)
+            )
+            session.commit()
+        finally:
+            session.close()
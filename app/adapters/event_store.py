@@ -0,0 +1,283 @@
+"""Event sourced persistence of the Product aggregate.
+
+Instead of updating the rows of its batches and allocations, the changes a
+product records are appended to its stream in the product_events table, one row
+per change with the next version of the stream. Two units of work that change the
+same product append the same version, so the second one fails on the primary key
+like a stale version_number fails in the orm mapping. Every snapshot_interval
+versions the whole state of the product is stored as a snapshot, loading a
+product replays only the changes after its snapshot.
+"""
+import json
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple, cast
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm.session import Session
+
+import app.domain.model as model
+from app.adapters import codec, orm
+from app.adapters.repository import AbstractRepository
+from app.domain import events
+
+
+def _json_default(value: Any) -> str:
+    """Serialize the dates and times of a snapshot."""
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"{value!r} is not json serializable")
+
+
+def snapshot_state(product: model.Product) -> str:
+    """Get the json of the whole state of a product.
+
+    Args:
+        product: the product
+
+    Returns:
+        json object with the batches of the product, their allocations and holds
+    """
+    return json.dumps(
+        {
+            "batches": [
+                {
+                    "ref": batch.reference,
+                    "qty": batch._purchased_quantity,
+                    "eta": batch.eta,
+                    "location": batch.location,
+                    "allocations": [
+                        [line.order_id, line.qty] for line in batch._allocations
+                    ],
+                    "reservations": [
+                        [reservation.order_id, reservation.qty, reservation.expires_at]
+                        for reservation in batch._reservations
+                    ],
+                }
+                for batch in product.batches
+            ]
+        },
+        default=_json_default,
+    )
+
+
+def product_from_snapshot(sku: str, state: str, version: int) -> model.Product:
+    """Rebuild a product from a snapshot of its state.
+
+    Args:
+        sku: sku of the product
+        state: json object made by snapshot_state
+        version: version of the stream the snapshot was taken at
+
+    Returns:
+        the product
+    """
+    batches = []
+    for values in json.loads(state)["batches"]:
+        eta = values["eta"]
+        batch = model.Batch(
+            values["ref"],
+            sku,
+            values["qty"],
+            date.fromisoformat(eta) if eta else None,
+            values["location"],
+        )
+        for orderid, qty in values["allocations"]:
+            batch._allocations.add(model.OrderLine(orderid, sku, qty))
+        for orderid, qty, expires_at in values.get("reservations", []):
+            batch._reservations.add(
+                model.Reservation(orderid, sku, qty, datetime.fromisoformat(expires_at))
+            )
+        batches.append(batch)
+    return model.Product(sku, batches, version)
+
+
+class EventSourcedRepository(AbstractRepository):
+    """Repository of products stored as streams of their changes."""
+
+    # sqlite refuses statements with more parameters than this
+    max_bound_parameters = 999
+
+    def __init__(self, session: Session, snapshot_interval: int = 100) -> None:
+        """Initialize the repository.
+
+        Args:
+            session: SqlAlchemy session to attach the repository to.
+            snapshot_interval: number of versions between two snapshots
+        """
+        super().__init__()
+        self.session = session
+        self.snapshot_interval = snapshot_interval
+        self._versions: Dict[str, int] = {}
+
+    def _add(self, product: model.Product) -> None:
+        """Add a new product, its stream starts with its first change.
+
+        Args:
+            product: model to add
+        """
+        self._versions[product.sku] = 0
+
+    def _get(self, sku: str) -> Optional[model.Product]:
+        """Load a product from its snapshot and the changes after it.
+
+        Args:
+            sku: str with the sku of the product
+
+        Returns:
+            Product if it has a stream
+        """
+        product = next((p for p in self.seen if p.sku == sku), None)
+        if product is not None:
+            return product
+        snapshot = self.session.execute(
+            select(
+                [orm.product_snapshots.c.version, orm.product_snapshots.c.state]
+            ).where(orm.product_snapshots.c.sku == sku)
+        ).first()
+        version = 0
+        product = model.Product(sku, [])
+        if snapshot is not None:
+            version = snapshot.version
+            product = product_from_snapshot(sku, snapshot.state, version)
+        rows = self.session.execute(
+            select(
+                [
+                    orm.product_events.c.version,
+                    orm.product_events.c.event_type,
+                    orm.product_events.c.payload,
+                ]
+            )
+            .where(orm.product_events.c.sku == sku)
+            .where(orm.product_events.c.version > version)
+            .order_by(orm.product_events.c.version)
+        )
+        for version, event_type, payload in rows:
+            product.apply(cast(events.Event, codec.decode_payload(event_type, payload)))
+        if version == 0:
+            return None
+        product.version_number = version
+        self._versions[sku] = version
+        return product
+
+    def _get_by_batchref(self, batchref: str) -> Optional[model.Product]:
+        """Get the product whose stream added a batch.
+
+        Args:
+            batchref: how to identify the batch
+
+        Returns:
+            product associated to a batch
+        """
+        sku = self.skus_by_batchref([batchref]).get(batchref)
+        return self._get(sku) if sku is not None else None
+
+    def skus_by_batchref(self, batchrefs: Iterable[str]) -> Dict[str, str]:
+        """Get the skus of batches from the indexed batchref of the changes.
+
+        Args:
+            batchrefs: references of the batches
+
+        Returns:
+            sku of each batch that exists, by batchref
+        """
+        batchrefs = list(batchrefs)
+        skus: Dict[str, str] = {}
+        for start in range(0, len(batchrefs), self.max_bound_parameters):
+            end = start + self.max_bound_parameters
+            rows = self.session.execute(
+                select([orm.product_events.c.batchref, orm.product_events.c.sku])
+                .where(orm.product_events.c.event_type == events.BatchAdded.__name__)
+                .where(orm.product_events.c.batchref.in_(batchrefs[start:end]))
+            )
+            skus.update({batchref: sku for batchref, sku in rows})
+        return skus
+
+    def _list_by_orderid(
+        self, orderid: str, sku: Optional[str] = None
+    ) -> List[model.Product]:
+        """Get the products lines of an order were allocated to.
+
+        Args:
+            orderid: id of the order
+            sku: only get the product of this sku, if given
+
+        Returns:
+            the products whose stream allocated a line of the order, directly or
+            by confirming its hold
+        """
+        query = (
+            select([orm.product_events.c.sku])
+            .where(orm.product_events.c.orderid == orderid)
+            .where(
+                orm.product_events.c.event_type.in_(
+                    [events.Allocated.__name__, events.ReservationConfirmed.__name__]
+                )
+            )
+            .distinct()
+        )
+        if sku is not None:
+            query = query.where(orm.product_events.c.sku == sku)
+        skus = self.session.execute(query)
+        products = [self._get(sku) for [sku] in skus]
+        return [product for product in products if product is not None]
+
+    def save(self) -> None:
+        """Append the recorded changes of the seen products to their streams.
+
+        The changes are not committed. A snapshot is written for every product
+        whose stream passed a multiple of the snapshot interval.
+        """
+        for product in self.seen:
+            if not product.changes:
+                continue
+            previous = self._versions.get(product.sku, 0)
+            rows, version = self._change_rows(product, previous)
+            self.session.execute(insert(orm.product_events), rows)
+            interval = self.snapshot_interval
+            if version // interval > previous // interval:
+                self._snapshot(product, version)
+            product.changes.clear()
+            product.version_number = version
+            self._versions[product.sku] = version
+
+    def _change_rows(
+        self, product: model.Product, version: int
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """Get the rows of the recorded changes of a product.
+
+        Args:
+            product: product with recorded changes
+            version: current version of the stream of the product
+
+        Returns:
+            the rows and the version of the stream after them
+        """
+        rows = []
+        for change in product.changes:
+            version += 1
+            rows.append(
+                {
+                    "sku": product.sku,
+                    "version": version,
+                    "event_type": type(change).__name__,
+                    "batchref": getattr(
+                        change, "batchref", getattr(change, "ref", None)
+                    ),
+                    "orderid": getattr(change, "orderid", None),
+                    "payload": codec.encode_payload(change),
+                }
+            )
+        return rows, version
+
+    def _snapshot(self, product: model.Product, version: int) -> None:
+        """Replace the snapshot of a product with its current state."""
+        self.session.execute(
+            delete(orm.product_snapshots).where(
+                orm.product_snapshots.c.sku == product.sku
+            )
+        )
+        self.session.execute(
+            insert(orm.product_snapshots).values(
+                sku=product.sku, version=version, state=snapshot_state(product)
+            )
+        )
@@ -0,0 +1,182 @@
+"""Export of the allocations for reporting.
+
+The join of the order lines, allocations and batches, live and archived, is read
+with a server side cursor and written row by row, so the memory used does not grow
+with the number of allocations. No Product is hydrated for it.
+"""
+import csv
+import json
+from datetime import date, datetime
+from pathlib import Path
+from typing import IO, Any, Dict, Iterator, List, Optional, Sequence
+
+from sqlalchemy import Table, select
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.selectable import Select
+
+from app.adapters import orm
+
+COLUMNS = ["order_id", "sku", "qty", "batchref", "eta", "allocated_at"]
+FORMATS = ("csv", "jsonl")
+
+
+def _allocated_lines(
+    lines: Table,
+    allocations: Table,
+    batches: Table,
+    skus: Optional[Sequence[str]],
+    since: Optional[datetime],
+    until: Optional[datetime],
+) -> Select:
+    """Query for the allocated order lines of a set of tables, live or archived."""
+    query = select(
+        [
+            allocations.c.id.label("allocation_id"),
+            lines.c.order_id,
+            lines.c.sku,
+            lines.c.qty,
+            batches.c.reference.label("batchref"),
+            batches.c.eta,
+            allocations.c.allocated_at,
+        ]
+    ).select_from(
+        allocations.join(lines, allocations.c.orderline_id == lines.c.id).join(
+            batches, allocations.c.batch_id == batches.c.id
+        )
+    )
+    if skus:
+        query = query.where(lines.c.sku.in_(skus))
+    if since is not None:
+        query = query.where(allocations.c.allocated_at >= since)
+    if until is not None:
+        query = query.where(allocations.c.allocated_at < until)
+    return query
+
+
+def allocations_query(
+    skus: Optional[Sequence[str]] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+) -> Select:
+    """Query for the allocated order lines with their batch.
+
+    The allocations of archived batches are read from the archive tables.
+
+    Args:
+        skus: only export these skus, all of them when None
+        since: only export allocations made at or after this time
+        until: only export allocations made before this time
+
+    Returns:
+        select statement ordered by allocation time
+    """
+    live = _allocated_lines(
+        orm.order_lines, orm.allocations, orm.batches, skus, since, until
+    )
+    archived = _allocated_lines(
+        orm.archived_order_lines,
+        orm.archived_allocations,
+        orm.archived_batches,
+        skus,
+        since,
+        until,
+    )
+    allocated = live.union_all(archived).alias("allocated")
+    return select([allocated.c[column] for column in COLUMNS]).order_by(
+        allocated.c.allocated_at, allocated.c.allocation_id
+    )
+
+
+def stream_rows(
+    session: Session, query: Select, chunk_size: int = 1000
+) -> Iterator[Dict[str, Any]]:
+    """Stream the rows of a query with a server side cursor.
+
+    Args:
+        session: session to run the query in
+        query: the query
+        chunk_size: number of rows fetched from the cursor at once
+
+    Yields:
+        the rows, by column name
+    """
+    result = session.connection(execution_options={"stream_results": True}).execute(
+        query
+    )
+    for partition in result.partitions(chunk_size):
+        for row in partition:
+            yield dict(row._mapping)
+
+
+def _format_value(value: Any) -> Any:
+    """Get the exported form of a value, dates as iso strings."""
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+class _Output:
+    """Writes rows to one file, as csv or json lines."""
+
+    def __init__(self, path: Path, fmt: str):
+        """Open the file and write the header of a csv file."""
+        self.path = path
+        self.file: IO[str] = path.open("w", newline="")
+        self.csv_writer = None
+        if fmt == "csv":
+            self.csv_writer = csv.writer(self.file)
+            self.csv_writer.writerow(COLUMNS)
+
+    def write(self, row: Dict[str, Any]) -> None:
+        """Write a row."""
+        values = [_format_value(row[column]) for column in COLUMNS]
+        if self.csv_writer is not None:
+            self.csv_writer.writerow(values)
+        else:
+            self.file.write(json.dumps(dict(zip(COLUMNS, values))) + "\n")
+
+    def close(self) -> None:
+        """Close the file."""
+        self.file.close()
+
+
+def export_allocations(
+    rows: Iterator[Dict[str, Any]],
+    prefix: Path,
+    fmt: str = "csv",
+    rows_per_file: Optional[int] = None,
+) -> List[Path]:
+    """Write allocations to one or more files.
+
+    Args:
+        rows: the allocations, as streamed from allocations_query
+        prefix: path of the files without the extension
+        fmt: csv or jsonl
+        rows_per_file: start a new numbered file after this many rows, all rows
+            go to one file when None
+
+    Returns:
+        the paths of the written files
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt}")
+
+    def path(number: int) -> Path:
+        suffix = f"-{number:04d}" if rows_per_file else ""
+        return prefix.with_name(f"{prefix.name}{suffix}.{fmt}")
+
+    paths = [path(1)]
+    output = _Output(paths[0], fmt)
+    written = 0
+    try:
+        for row in rows:
+            if rows_per_file and written == rows_per_file:
+                output.close()
+                paths.append(path(len(paths) + 1))
+                output = _Output(paths[-1], fmt)
+                written = 0
+            output.write(row)
+            written += 1
+    finally:
+        output.close()
+    return paths
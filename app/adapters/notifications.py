@@ -0,0 +1,251 @@
+"""Adapters for notifying people about things that happened in the app."""
+import abc
+import logging
+import smtplib
+import threading
+from collections import Counter
+from email.message import EmailMessage
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationsNotSent(Exception):
+    """Sending several notifications failed part of the way."""
+
+    def __init__(self, unsent: List[Tuple[str, str]]):
+        """Init method.
+
+        Args:
+            unsent: destination and message of the notifications that were not
+                sent, in order
+        """
+        super().__init__(f"{len(unsent)} notifications were not sent")
+        self.unsent = unsent
+
+
+class AbstractNotifications(abc.ABC):
+    """Interface for sending notifications."""
+
+    @abc.abstractmethod
+    def send(self, destination: str, message: str) -> None:
+        """Send a notification.
+
+        Args:
+            destination: who to notify
+            message: what to tell them
+        """
+        raise NotImplementedError
+
+    def send_many(self, notifications: Iterable[Tuple[str, str]]) -> None:
+        """Send several notifications, one by one unless an adapter can do better.
+
+        Args:
+            notifications: destination and message of each notification
+
+        Raises:
+            NotificationsNotSent: with the notifications from the one that failed
+        """
+        pending = list(notifications)
+        for i, (destination, message) in enumerate(pending):
+            try:
+                self.send(destination, message)
+            except Exception as e:
+                raise NotificationsNotSent(pending[i:]) from e
+
+    def close(self) -> None:
+        """Send what is still waiting to be sent."""
+        pass
+
+
+class LoggingNotifications(AbstractNotifications):
+    """Notifications that are only written to the log."""
+
+    def send(self, destination: str, message: str) -> None:
+        """Log a notification.
+
+        Args:
+            destination: who to notify
+            message: what to tell them
+        """
+        logger.info("notification for %s: %s", destination, message)
+
+
+class FileNotifications(AbstractNotifications):
+    """Notifications appended to a file, one line each."""
+
+    def __init__(self, path: Path):
+        """Init method.
+
+        Args:
+            path: file to append the notifications to
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send(self, destination: str, message: str) -> None:
+        """Append a notification to the file.
+
+        Args:
+            destination: who to notify
+            message: what to tell them
+        """
+        self.send_many([(destination, message)])
+
+    def send_many(self, notifications: Iterable[Tuple[str, str]]) -> None:
+        """Append several notifications with a single write.
+
+        Args:
+            notifications: destination and message of each notification
+        """
+        lines = "".join(
+            f"{destination}\t{' | '.join(message.splitlines())}\n"
+            for destination, message in notifications
+        )
+        with self._lock, self.path.open("a") as f:
+            f.write(lines)
+
+
+class EmailNotifications(AbstractNotifications):
+    """Notifications sent as emails over SMTP."""
+
+    def __init__(self, host: str, port: int, sender: str = "allocations@example.com"):
+        """Init method.
+
+        Args:
+            host: host of the SMTP server
+            port: port of the SMTP server
+            sender: address the emails are sent from
+        """
+        self.host = host
+        self.port = port
+        self.sender = sender
+
+    def send(self, destination: str, message: str) -> None:
+        """Send a notification as an email.
+
+        Args:
+            destination: email address to notify
+            message: body of the email
+        """
+        self.send_many([(destination, message)])
+
+    def send_many(self, notifications: Iterable[Tuple[str, str]]) -> None:
+        """Send several emails over one SMTP connection.
+
+        Args:
+            notifications: email address and body of each email
+
+        Raises:
+            NotificationsNotSent: with the emails from the one that failed, all of
+                them when the server could not be reached
+        """
+        pending = list(notifications)
+        sent = 0
+        try:
+            with smtplib.SMTP(self.host, self.port) as server:
+                for destination, message in pending:
+                    email = EmailMessage()
+                    email["From"] = self.sender
+                    email["To"] = destination
+                    email["Subject"] = "allocation service notification"
+                    email.set_content(message)
+                    server.send_message(email)
+                    sent += 1
+        except Exception as e:
+            if sent < len(pending):
+                raise NotificationsNotSent(pending[sent:]) from e
+            # every email was sent, only closing the connection failed
+            logger.warning("Failed to close the SMTP connection: %s", e)
+
+
+class DigestNotifications(AbstractNotifications):
+    """Collects notifications over a window and sends one digest per destination.
+
+    The same message sent more than once within a window is only listed once in
+    the digest, with the number of times it was sent. The digests that were not
+    sent are kept for the next window.
+    """
+
+    def __init__(self, notifications: AbstractNotifications, window: float):
+        """Init method.
+
+        Args:
+            notifications: adapter that sends the digests
+            window: seconds between the first notification and its digest
+        """
+        self.notifications = notifications
+        self.window = window
+        self._pending: Dict[str, Counter] = {}
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+
+    def send(self, destination: str, message: str) -> None:
+        """Add a notification to the next digest of its destination.
+
+        Args:
+            destination: who to notify
+            message: what to tell them
+        """
+        with self._lock:
+            self._pending.setdefault(destination, Counter())[message] += 1
+            self._start_timer()
+
+    def flush(self) -> None:
+        """Send the digests of the notifications collected so far."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._timer = None
+        if not pending:
+            return
+        try:
+            self.notifications.send_many(
+                (destination, digest(messages))
+                for destination, messages in pending.items()
+            )
+        except Exception as e:
+            unsent = (
+                {destination for destination, _ in e.unsent}
+                if isinstance(e, NotificationsNotSent)
+                else set(pending)
+            )
+            logger.exception("Failed to send %d notification digests", len(unsent))
+            with self._lock:
+                for destination, messages in pending.items():
+                    if destination in unsent:
+                        self._pending.setdefault(destination, Counter()).update(
+                            messages
+                        )
+                self._start_timer()
+
+    def _start_timer(self) -> None:
+        """Flush once the window has passed, unless that is planned already."""
+        if self._timer is None:
+            self._timer = threading.Timer(self.window, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def close(self) -> None:
+        """Stop waiting for the window and send the digests now."""
+        with self._lock:
+            timer = self._timer
+        if timer is not None:
+            timer.cancel()
+        self.flush()
+        self.notifications.close()
+
+
+def digest(messages: Counter) -> str:
+    """Build the text of a digest.
+
+    Args:
+        messages: how many times each message was sent
+
+    Returns:
+        one line per message, with its count when it was sent more than once
+    """
+    return "\n".join(
+        message if count == 1 else f"{message} (x{count})"
+        for message, count in sorted(messages.items())
+    )
@@ -1,8 +1,20 @@
 """Setup the mapping between the domain models and the orm objects."""
 
-from typing import Any
+from typing import Any, Iterable, Optional
 
-from sqlalchemy import Column, Date, ForeignKey, Integer, MetaData, String, Table, event
+from sqlalchemy import (
+    Column,
+    Date,
+    DateTime,
+    ForeignKey,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    event,
+    func,
+)
 from sqlalchemy.orm import mapper, relationship
 
 import app.domain.model as model
@@ -13,9 +25,10 @@ order_lines = Table(
     "order_lines",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("order_id", String(255)),
+    Column("order_id", String(255), index=True),
     Column("sku", String(255)),
     Column("qty", Integer, nullable=False),
+    sqlite_autoincrement=True,
 )
 
 products = Table(
@@ -33,6 +46,8 @@ batches = Table(
     Column("sku", ForeignKey("products.sku")),
     Column("_purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
+    Column("location", String(255), nullable=True, index=True),
+    sqlite_autoincrement=True,
 )
 
 allocations = Table(
@@ -40,13 +55,115 @@ allocations = Table(
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("orderline_id", ForeignKey("order_lines.id")),
-    Column("batch_id", ForeignKey("batches.id")),
+    Column("batch_id", ForeignKey("batches.id"), index=True),
+    Column("allocated_at", DateTime, index=True, server_default=func.now()),
+    sqlite_autoincrement=True,
+)
+
+reservations = Table(
+    "reservations",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("batch_id", ForeignKey("batches.id"), index=True),
+    Column("order_id", String(255), index=True),
+    Column("sku", String(255)),
+    Column("qty", Integer, nullable=False),
+    Column("expires_at", DateTime, nullable=False, index=True),
+)
+
+processed_commands = Table(
+    "processed_commands",
+    metadata,
+    Column("idempotency_key", String(255), primary_key=True),
+    Column("command", String(255), nullable=False),
+    Column("result", String(255), nullable=True),
+)
+
+archived_batches = Table(
+    "archived_batches",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("reference", String(255)),
+    Column("sku", String(255), index=True),
+    Column("_purchased_quantity", Integer, nullable=False),
+    Column("eta", Date, nullable=True),
+    Column("location", String(255), nullable=True, index=True),
+)
+
+archived_order_lines = Table(
+    "archived_order_lines",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("order_id", String(255), index=True),
+    Column("sku", String(255)),
+    Column("qty", Integer, nullable=False),
+)
+
+archived_allocations = Table(
+    "archived_allocations",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("orderline_id", Integer, index=True),
+    Column("batch_id", Integer, index=True),
+    Column("allocated_at", DateTime),
+)
+
+dead_letters = Table(
+    "dead_letters",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("handler", String(255), nullable=False),
+    Column("event_type", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("error", Text, nullable=False),
+    Column("attempts", Integer, nullable=False),
+    Column("failed_at", DateTime, nullable=False, server_default=func.now()),
+)
+
+
+product_events = Table(
+    "product_events",
+    metadata,
+    Column("sku", String(255), primary_key=True),
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("event_type", String(255), nullable=False),
+    Column("batchref", String(255), index=True),
+    Column("orderid", String(255), index=True),
+    Column("payload", Text, nullable=False),
+    Column("recorded_at", DateTime, nullable=False, server_default=func.now()),
+)
+
+product_snapshots = Table(
+    "product_snapshots",
+    metadata,
+    Column("sku", String(255), primary_key=True),
+    Column("version", Integer, nullable=False),
+    Column("state", Text, nullable=False),
+)
+
+
+event_log = Table(
+    "event_log",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("event_type", String(255), nullable=False),
+    Column("sku", String(255), index=True),
+    Column("payload", Text, nullable=False),
+    Column("recorded_at", DateTime, nullable=False, server_default=func.now()),
+)
+
+event_log_checkpoints = Table(
+    "event_log_checkpoints",
+    metadata,
+    Column("name", String(255), primary_key=True),
+    Column("position", Integer, nullable=False),
 )
 
 
 def start_mappers() -> None:
     """Map the domain models to the sqlalchemy tables with imperative mappings."""
     lines_mapper = mapper(model.OrderLine, order_lines)
+    reservations_mapper = mapper(model.Reservation, reservations)
     batches_mapper = mapper(
         model.Batch,
         batches,
@@ -55,7 +172,12 @@ def start_mappers() -> None:
                 lines_mapper,
                 secondary=allocations,
                 collection_class=set,
-            )
+            ),
+            "_reservations": relationship(
+                reservations_mapper,
+                collection_class=set,
+                cascade="all, delete-orphan",
+            ),
         },
     )
     mapper(
@@ -67,3 +189,44 @@ def start_mappers() -> None:
 def receive_load(product: model.Product, _: Any) -> None:
     """When the Product is loaded, events are added to the orm object."""
     product.events = []
+    product.changes = []
+    product._invalidate_indexes()
+
+
+@event.listens_for(model.Product, "expire")
+def receive_product_expire(
+    product: Optional[model.Product], attrs: Optional[Iterable[str]]
+) -> None:
+    """Drop the indexes of the batches of a product whose batches are expired."""
+    if product is not None and (attrs is None or "batches" in attrs):
+        product._invalidate_indexes()
+
+
+@event.listens_for(model.Product, "refresh")
+def receive_product_refresh(
+    product: model.Product, _: Any, attrs: Optional[Iterable[str]]
+) -> None:
+    """Drop the indexes of the batches of a product when they are loaded again."""
+    receive_product_expire(product, attrs)
+
+
+@event.listens_for(model.Batch, "expire")
+def receive_expire(
+    batch: Optional[model.Batch], attrs: Optional[Iterable[str]]
+) -> None:
+    """Forget the quantities summed by the database with the lines they count.
+
+    They would otherwise outlive a commit or rollback, which expires the batch.
+    Batches that were garbage collected already are passed as None.
+    """
+    if batch is None:
+        return
+    if attrs is None or {"_allocations", "_reservations"} & set(attrs):
+        batch._allocated_quantity = None
+        batch._reserved_quantity = None
+
+
+@event.listens_for(model.Batch, "refresh")
+def receive_refresh(batch: model.Batch, _: Any, attrs: Optional[Iterable[str]]) -> None:
+    """Forget the summed quantities when the batch is loaded again."""
+    receive_expire(batch, attrs)
@@ -0,0 +1,188 @@
+"""Profiling of the SQL statements sent to the database.
+
+Engines are instrumented with listeners that record every statement, its
+duration and its row count into the profiles that are active in the current
+context. The message bus labels the context with the message it handles, so a
+profile tells which command emitted which SQL. Statements that are repeated
+identically are flagged as possible N+1 queries.
+"""
+import contextlib
+import contextvars
+import logging
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Iterator, List, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+_active_profiles: "contextvars.ContextVar[Tuple[QueryProfile, ...]]" = (
+    contextvars.ContextVar("active_profiles", default=())
+)
+_label: "contextvars.ContextVar[str]" = contextvars.ContextVar("label", default="")
+
+# reports of the last profiled units of work, for the debug endpoints
+recent_reports: Deque[Dict[str, Any]] = deque(maxlen=100)
+
+
+@dataclass(frozen=True)
+class StatementRecord:
+    """A statement that was sent to the database."""
+
+    statement: str
+    duration: float
+    rowcount: int
+
+
+@dataclass
+class QueryProfile:
+    """Statements recorded while the profile was active.
+
+    Attributes:
+        label: what was being handled, usually the name of a message
+        n_plus_one_threshold: number of identical statements that is flagged
+        statements: the recorded statements, in order
+    """
+
+    label: str = ""
+    n_plus_one_threshold: int = 3
+    statements: List[StatementRecord] = field(default_factory=list)
+
+    @property
+    def count(self) -> int:
+        """Number of statements sent."""
+        return len(self.statements)
+
+    @property
+    def duration(self) -> float:
+        """Seconds spent in the database."""
+        return sum(record.duration for record in self.statements)
+
+    def repeated_statements(self) -> Dict[str, int]:
+        """Get the statements that were repeated identically, possible N+1 queries.
+
+        Returns:
+            number of executions of each statement at or above the threshold
+        """
+        counts = Counter(record.statement for record in self.statements)
+        return {
+            statement: count
+            for statement, count in counts.items()
+            if count >= self.n_plus_one_threshold
+        }
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Get the profile in a json serializable form."""
+        return {
+            "label": self.label,
+            "count": self.count,
+            "duration_ms": round(self.duration * 1000, 3),
+            "statements": [
+                {
+                    "statement": record.statement,
+                    "duration_ms": round(record.duration * 1000, 3),
+                    "rowcount": record.rowcount,
+                }
+                for record in self.statements
+            ],
+            "n_plus_one": self.repeated_statements(),
+        }
+
+    def report(self) -> str:
+        """Get a readable report of the profile."""
+        lines = [
+            f"{self.label or 'queries'}: {self.count} statements"
+            f" in {self.duration * 1000:.1f}ms"
+        ]
+        for record in self.statements:
+            statement = " ".join(record.statement.split())
+            lines.append(
+                f"  {record.duration * 1000:8.2f}ms {record.rowcount:>6} rows"
+                f"  {statement}"
+            )
+        for statement, count in self.repeated_statements().items():
+            lines.append(
+                f"  possible N+1, {count} times: {' '.join(statement.split())}"
+            )
+        return "\n".join(lines)
+
+
+def instrument(engine: Engine) -> None:
+    """Record the statements of an engine into the active profiles.
+
+    Instrumenting an engine more than once has no further effect.
+
+    Args:
+        engine: engine to listen to
+    """
+    if event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _before_cursor_execute(conn: Any, *args: Any) -> None:
+    """Keep the start time of a statement on its connection."""
+    if _active_profiles.get():
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn: Any, cursor: Any, statement: str, *args: Any) -> None:
+    """Record a statement into the active profiles."""
+    profiles = _active_profiles.get()
+    start_times = conn.info.get("query_start_time")
+    if not profiles or not start_times:
+        return
+    record = StatementRecord(
+        statement, time.perf_counter() - start_times.pop(), cursor.rowcount
+    )
+    for profile in profiles:
+        profile.statements.append(record)
+
+
+@contextlib.contextmanager
+def record_queries(label: str = "") -> Iterator[QueryProfile]:
+    """Record the statements of instrumented engines in this context.
+
+    Args:
+        label: what is being handled, defaults to the label of the context
+
+    Yields:
+        the profile the statements are recorded in
+    """
+    profile = QueryProfile(label or _label.get())
+    token = _active_profiles.set(_active_profiles.get() + (profile,))
+    try:
+        yield profile
+    finally:
+        _active_profiles.reset(token)
+
+
+@contextlib.contextmanager
+def label(name: str) -> Iterator[None]:
+    """Label the profiles started in this context.
+
+    Args:
+        name: what is being handled
+    """
+    token = _label.set(name)
+    try:
+        yield
+    finally:
+        _label.reset(token)
+
+
+def publish(profile: QueryProfile) -> None:
+    """Log the report of a profile and keep it for the debug endpoints.
+
+    Args:
+        profile: the finished profile
+    """
+    recent_reports.append(profile.as_dict())
+    if profile.repeated_statements():
+        logger.warning(profile.report())
+    else:
+        logger.info(profile.report())
@@ -0,0 +1,108 @@
+"""Routing of read-only sessions to the read replicas of the database.
+
+Command handlers keep using the primary. Queries that can read slightly stale
+data, like the views, get their sessions from a ReplicaRouter, which picks the
+replicas in turn and skips the ones that failed their last health check. Without
+a healthy replica the router falls back to the primary. The result of a health
+check is kept for the check interval, and only one thread checks a replica again
+while the others keep using the last result.
+"""
+import itertools
+import logging
+import threading
+import time
+from typing import Dict, Sequence, Set, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicaRouter:
+    """Callable that returns a session on the next healthy read replica."""
+
+    def __init__(
+        self,
+        replicas: Sequence[Engine],
+        primary: Engine,
+        check_interval: float = 5.0,
+    ):
+        """Init method.
+
+        Args:
+            replicas: engines of the read replicas
+            primary: engine used when no replica is healthy
+            check_interval: seconds for which the result of a health check is
+                trusted
+        """
+        self.replicas = list(replicas)
+        self.primary = primary
+        self.check_interval = check_interval
+        self._next_replica = itertools.cycle(self.replicas)
+        self._lock = threading.Lock()
+        self._health: Dict[Engine, Tuple[bool, float]] = {}
+        self._checking: Set[Engine] = set()
+
+    def __call__(self) -> Session:
+        """Get a session bound to the next healthy replica.
+
+        Returns:
+            the session
+        """
+        return Session(bind=self.engine())
+
+    def engine(self) -> Engine:
+        """Get the next healthy replica, round-robin.
+
+        Returns:
+            the engine of the replica, the primary when no replica is healthy
+        """
+        for _ in self.replicas:
+            with self._lock:
+                replica = next(self._next_replica)
+            if self.is_healthy(replica):
+                return replica
+        if self.replicas:
+            logger.warning("No healthy read replica, reading from the primary")
+        return self.primary
+
+    def is_healthy(self, engine: Engine) -> bool:
+        """Get whether a replica passed its last health check.
+
+        The replica is checked again once the last check is older than the check
+        interval. While a thread checks it, the others get the last result.
+
+        Args:
+            engine: engine of the replica
+
+        Returns:
+            True if the replica can be read from
+        """
+        with self._lock:
+            healthy, checked_at = self._health.get(engine, (False, -float("inf")))
+            if time.monotonic() - checked_at < self.check_interval:
+                return healthy
+            if engine in self._checking:
+                return healthy
+            self._checking.add(engine)
+        healthy = False
+        try:
+            healthy = self._check(engine)
+        finally:
+            with self._lock:
+                self._health[engine] = (healthy, time.monotonic())
+                self._checking.discard(engine)
+        return healthy
+
+    def _check(self, engine: Engine) -> bool:
+        """Run a trivial query on a replica."""
+        try:
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+        except DBAPIError as e:
+            logger.warning("Read replica %r failed its health check: %s", engine.url, e)
+            return False
+        return True
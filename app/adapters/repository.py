@@ -1,13 +1,79 @@
 """Implementations of the repositories for the domain."""
 import abc
-from typing import Optional, Set, cast
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, cast
 
+from sqlalchemy import func, inspect, select
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.session import Session
+from sqlalchemy.sql.elements import ColumnElement
 
 import app.domain.model as model
 from app.adapters import orm
 
 
+def batch_allocated_quantity() -> ColumnElement:
+    """Sum of the quantities allocated to a batch, correlated to the batches table.
+
+    Returns:
+        scalar expression usable in queries on the batches table
+    """
+    return cast(
+        ColumnElement,
+        func.coalesce(
+            select([func.sum(orm.order_lines.c.qty)])
+            .select_from(
+                orm.allocations.join(
+                    orm.order_lines,
+                    orm.allocations.c.orderline_id == orm.order_lines.c.id,
+                )
+            )
+            .where(orm.allocations.c.batch_id == orm.batches.c.id)
+            .as_scalar(),
+            0,
+        ),
+    )
+
+
+def batch_reserved_quantity(now: Optional[datetime] = None) -> ColumnElement:
+    """Sum of the quantities held in a batch, correlated to the batches table.
+
+    Holds that expired but were not released yet are not counted.
+
+    Args:
+        now: naive utc time the holds are checked against, defaults to the
+            current time
+
+    Returns:
+        scalar expression usable in queries on the batches table
+    """
+    return cast(
+        ColumnElement,
+        func.coalesce(
+            select([func.sum(orm.reservations.c.qty)])
+            .where(orm.reservations.c.batch_id == orm.batches.c.id)
+            .where(orm.reservations.c.expires_at > (now or datetime.utcnow()))
+            .as_scalar(),
+            0,
+        ),
+    )
+
+
+def batch_available_quantity(now: Optional[datetime] = None) -> ColumnElement:
+    """Quantity of a batch that is neither allocated nor held.
+
+    Args:
+        now: naive utc time the holds are checked against, defaults to the
+            current time
+
+    Returns:
+        scalar expression usable in queries on the batches table
+    """
+    available = orm.batches.c._purchased_quantity - batch_allocated_quantity()
+    return cast(ColumnElement, available - batch_reserved_quantity(now))
+
+
 class AbstractRepository(abc.ABC):
     """Interface for a Repository."""
 
@@ -35,6 +101,25 @@ class AbstractRepository(abc.ABC):
             self.seen.add(product)
         return product
 
+    def get_for_allocation(self, sku: str) -> Optional[model.Product]:
+        """Get a product with only the batches that can still be allocated to.
+
+        A product that was already retrieved by this repository is returned as
+        it is, so its changes are not lost.
+
+        Args:
+            sku: sku of the product to retrieve
+
+        Returns:
+            Product if it exists
+        """
+        product = next((p for p in self.seen if p.sku == sku), None)
+        if product is None:
+            product = self._get_for_allocation(sku)
+        if product:
+            self.seen.add(product)
+        return product
+
     def get_by_batchref(self, batchref: str) -> Optional[model.Product]:
         """Get a product based on the given batchref.
 
@@ -49,6 +134,41 @@ class AbstractRepository(abc.ABC):
             self.seen.add(product)
         return product
 
+    def skus_by_batchref(self, batchrefs: Iterable[str]) -> Dict[str, str]:
+        """Get the skus of batches without loading their products.
+
+        Args:
+            batchrefs: references of the batches
+
+        Returns:
+            sku of each batch that exists, by batchref
+        """
+        skus = {}
+        for batchref in batchrefs:
+            product = self._get_by_batchref(batchref)
+            if product is not None:
+                skus[batchref] = product.sku
+        return skus
+
+    def list_by_orderid(
+        self, orderid: str, sku: Optional[str] = None
+    ) -> List[model.Product]:
+        """Get the products an order has allocations for.
+
+        The products may hold only the batches with lines of the order, they are
+        meant for deallocating the order.
+
+        Args:
+            orderid: id of the order
+            sku: only get the product of this sku, if given
+
+        Returns:
+            the products with a batch holding a line of the order
+        """
+        products = self._list_by_orderid(orderid, sku)
+        self.seen.update(products)
+        return products
+
     @abc.abstractmethod
     def _add(self, product: model.Product) -> None:
         """Add a product to the repository.
@@ -67,6 +187,17 @@ class AbstractRepository(abc.ABC):
         """
         raise NotImplementedError
 
+    def _get_for_allocation(self, sku: str) -> Optional[model.Product]:
+        """Get a product with at least the batches that can be allocated to.
+
+        Args:
+            sku: sku of the product to retrieve
+
+        Returns:
+            Product if it exists, by default with all of its batches
+        """
+        return self._get(sku)
+
     @abc.abstractmethod
     def _get_by_batchref(self, batchref: str) -> Optional[model.Product]:
         """Get a product from a repository by using a batch reference.
@@ -79,10 +210,28 @@ class AbstractRepository(abc.ABC):
         """
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def _list_by_orderid(
+        self, orderid: str, sku: Optional[str] = None
+    ) -> List[model.Product]:
+        """Get the products an order has allocations for.
+
+        Args:
+            orderid: id of the order
+            sku: only get the product of this sku, if given
+
+        Returns:
+            the products with a batch holding a line of the order
+        """
+        raise NotImplementedError
+
 
 class SqlAlchemyRepository(AbstractRepository):
     """Instance of the Repository interface for SqlAlchemy."""
 
+    # sqlite refuses statements with more parameters than this
+    max_bound_parameters = 999
+
     def __init__(self, session: Session) -> None:
         """Initialize a sqlalchemy repository object.
 
@@ -91,6 +240,8 @@ class SqlAlchemyRepository(AbstractRepository):
         """
         super().__init__()
         self.session = session
+        self._partially_loaded: List[model.Product] = []
+        self._partially_loaded_batches: List[model.Batch] = []
 
     def _add(self, product: model.Product) -> None:
         """Add a product to the repository.
@@ -109,8 +260,66 @@ class SqlAlchemyRepository(AbstractRepository):
         Returns:
             Product that is chosen
         """
+        self._expire_partially_loaded()
         return self.session.query(model.Product).filter_by(sku=sku).first()
 
+    def _get_for_allocation(self, sku: str) -> Optional[model.Product]:
+        """Get a product with only the batches that have available quantity.
+
+        The allocated and reserved quantities of the batches are summed by the
+        database. The allocated lines and the holds of the batches are not
+        loaded, they start as empty collections that new lines and holds are
+        appended to, so allocating to a batch with many lines inserts the new
+        one without reading the others.
+
+        Args:
+            sku: str with the sku of the product
+
+        Returns:
+            Product with a partial list of batches
+        """
+        product = self.session.query(model.Product).filter_by(sku=sku).first()
+        if product is None:
+            return None
+        allocated = batch_allocated_quantity()
+        reserved = batch_reserved_quantity()
+        rows = (
+            self.session.query(model.Batch, allocated, reserved)
+            .filter(orm.batches.c.sku == sku)
+            .filter(orm.batches.c._purchased_quantity > allocated + reserved)
+            .all()
+        )
+        for batch, allocated_quantity, reserved_quantity in rows:
+            unloaded = inspect(batch).unloaded
+            if {"_allocations", "_reservations"} <= unloaded:
+                set_committed_value(batch, "_allocations", set())
+                set_committed_value(batch, "_reservations", set())
+                self._partially_loaded_batches.append(batch)
+            batch._allocated_quantity = allocated_quantity
+            batch._reserved_quantity = reserved_quantity
+        set_committed_value(product, "batches", [row[0] for row in rows])
+        product._invalidate_indexes()
+        self._partially_loaded.append(product)
+        return cast(model.Product, product)
+
+    def _expire_partially_loaded(self) -> None:
+        """Make partially loaded products and batches load all of their state.
+
+        They stay in the identity map, so queries for whole products would
+        otherwise return them with only some of their batches, or batches with
+        only some of their lines.
+        """
+        if not self._partially_loaded and not self._partially_loaded_batches:
+            return
+        self.session.flush()
+        for product in self._partially_loaded:
+            self.session.expire(product, ["batches"])
+        for batch in self._partially_loaded_batches:
+            # the expire listener of the orm resets the summed quantities
+            self.session.expire(batch, ["_allocations", "_reservations"])
+        self._partially_loaded.clear()
+        self._partially_loaded_batches.clear()
+
     def _get_by_batchref(self, batchref: str) -> Optional[model.Product]:
         """Get a product from a repository by using a batch reference.
 
@@ -120,6 +329,7 @@ class SqlAlchemyRepository(AbstractRepository):
         Returns:
             product associated to a batch
         """
+        self._expire_partially_loaded()
         return cast(
             Optional[model.Product],
             self.session.query(model.Product)
@@ -127,3 +337,162 @@ class SqlAlchemyRepository(AbstractRepository):
             .filter(orm.batches.c.reference == batchref)
             .first(),
         )
+
+    def skus_by_batchref(self, batchrefs: Iterable[str]) -> Dict[str, str]:
+        """Get the skus of batches with one query per chunk of batchrefs.
+
+        Args:
+            batchrefs: references of the batches
+
+        Returns:
+            sku of each batch that exists, by batchref
+        """
+        batchrefs = list(batchrefs)
+        skus: Dict[str, str] = {}
+        for start in range(0, len(batchrefs), self.max_bound_parameters):
+            end = start + self.max_bound_parameters
+            rows = self.session.execute(
+                select([orm.batches.c.reference, orm.batches.c.sku]).where(
+                    orm.batches.c.reference.in_(batchrefs[start:end])
+                )
+            )
+            skus.update({reference: sku for reference, sku in rows})
+        return skus
+
+    def _list_by_orderid(
+        self, orderid: str, sku: Optional[str] = None
+    ) -> List[model.Product]:
+        """Get the products of an order with only the batches and lines of the order.
+
+        The batches and lines come from one indexed join of the order lines with
+        their allocations. Every batch gets the lines of the order as its
+        allocations, so deallocating them deletes only their association rows
+        without loading the other lines of the batch. Products this repository
+        already returned are kept as they are.
+
+        Args:
+            orderid: id of the order
+            sku: only get the product of this sku, if given
+
+        Returns:
+            the products with a batch holding a line of the order
+        """
+        self._expire_partially_loaded()
+        query = (
+            self.session.query(
+                model.Batch,
+                model.OrderLine,
+                batch_allocated_quantity(),
+                batch_reserved_quantity(),
+            )
+            .select_from(orm.order_lines)
+            .join(
+                orm.allocations, orm.allocations.c.orderline_id == orm.order_lines.c.id
+            )
+            .join(orm.batches, orm.batches.c.id == orm.allocations.c.batch_id)
+            .filter(orm.order_lines.c.order_id == orderid)
+        )
+        if sku is not None:
+            query = query.filter(orm.order_lines.c.sku == sku)
+        seen = {product.sku: product for product in self.seen}
+        products: Dict[str, model.Product] = {}
+        lines: Dict[model.Batch, Set[model.OrderLine]] = {}
+        for batch, line, allocated_quantity, reserved_quantity in query:
+            if batch.sku in seen:
+                products[batch.sku] = seen[batch.sku]
+                continue
+            batch._allocated_quantity = allocated_quantity
+            batch._reserved_quantity = reserved_quantity
+            lines.setdefault(batch, set()).add(line)
+        batches: Dict[str, List[model.Batch]] = {}
+        for batch, batch_lines in lines.items():
+            set_committed_value(batch, "_allocations", batch_lines)
+            batches.setdefault(batch.sku, []).append(batch)
+            self._partially_loaded_batches.append(batch)
+        if batches:
+            for product in self.session.query(model.Product).filter(
+                orm.products.c.sku.in_(list(batches))
+            ):
+                set_committed_value(product, "batches", batches[product.sku])
+                product._invalidate_indexes()
+                self._partially_loaded.append(product)
+                products[product.sku] = product
+        return list(products.values())
+
+
+@dataclass(frozen=True)
+class ProcessedCommand:
+    """Result of a command that was handled with an idempotency key."""
+
+    idempotency_key: str
+    command: str
+    result: Optional[str]
+
+
+class AbstractProcessedCommandRepository(abc.ABC):
+    """Interface for storing the results of already handled commands."""
+
+    @abc.abstractmethod
+    def get(self, idempotency_key: str) -> Optional[ProcessedCommand]:
+        """Get the stored result of a command.
+
+        Args:
+            idempotency_key: key the command was sent with
+
+        Returns:
+            the processed command, None if the key was not seen before
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add(self, processed: ProcessedCommand) -> None:
+        """Store the result of a command.
+
+        Args:
+            processed: the key, name and result of the command
+        """
+        raise NotImplementedError
+
+
+class SqlAlchemyProcessedCommandRepository(AbstractProcessedCommandRepository):
+    """Processed commands stored in the same transaction as the aggregates."""
+
+    def __init__(self, session: Session) -> None:
+        """Initialize the repository.
+
+        Args:
+            session: SqlAlchemy session to attach the repository to.
+        """
+        self.session = session
+
+    def get(self, idempotency_key: str) -> Optional[ProcessedCommand]:
+        """Get the stored result of a command with a primary key lookup.
+
+        Args:
+            idempotency_key: key the command was sent with
+
+        Returns:
+            the processed command, None if the key was not seen before
+        """
+        row = self.session.execute(
+            select(
+                [orm.processed_commands.c.command, orm.processed_commands.c.result]
+            ).where(orm.processed_commands.c.idempotency_key == idempotency_key)
+        ).first()
+        if row is None:
+            return None
+        return ProcessedCommand(idempotency_key, row.command, row.result)
+
+    def add(self, processed: ProcessedCommand) -> None:
+        """Store the result of a command.
+
+        Args:
+            processed: the key, name and result of the command
+        """
+        self.session.execute(
+            orm.processed_commands.insert().values(
+                idempotency_key=processed.idempotency_key,
+                command=processed.command,
+                result=processed.result,
+            )
+        )
@@ -0,0 +1,94 @@
+"""Expiry of the holds that were neither confirmed nor released in time.
+
+Expired holds are deleted in bulk through the index on their expiry, without
+loading the products they belong to, in chunks that each get their own
+transaction. The sweeper works on the tables of the orm persistence mode, event
+sourced products release their expired holds when the order is confirmed.
+"""
+from datetime import datetime
+from typing import Callable, Optional
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.selectable import Select
+
+from app.adapters import orm
+
+
+def expired_reservations_query(now: datetime, chunk_size: int) -> Select:
+    """Query for the ids and skus of holds that expired.
+
+    Args:
+        now: naive utc time the holds are checked against
+        chunk_size: maximum number of holds to select
+
+    Returns:
+        select statement for the id and sku of the holds
+    """
+    return (
+        select([orm.reservations.c.id, orm.reservations.c.sku])
+        .where(orm.reservations.c.expires_at <= now)
+        .order_by(orm.reservations.c.expires_at)
+        .limit(chunk_size)
+    )
+
+
+def expire_chunk(session: Session, now: datetime, chunk_size: int) -> int:
+    """Delete a chunk of expired holds.
+
+    The version of the products losing holds is increased, so units of work that
+    loaded one of these holds concurrently fail instead of confirming it. The
+    changes are not committed.
+
+    Args:
+        session: session to run the statements in
+        now: naive utc time the holds are checked against
+        chunk_size: maximum number of holds to delete
+
+    Returns:
+        the number of holds deleted
+    """
+    rows = list(session.execute(expired_reservations_query(now, chunk_size)))
+    if not rows:
+        return 0
+    reservation_ids = [reservation_id for reservation_id, _ in rows]
+    skus = {sku for _, sku in rows}
+    session.execute(
+        delete(orm.reservations).where(orm.reservations.c.id.in_(reservation_ids))
+    )
+    session.execute(
+        update(orm.products)
+        .where(orm.products.c.sku.in_(skus))
+        .values(version_number=orm.products.c.version_number + 1)
+    )
+    return len(reservation_ids)
+
+
+def expire_reservations(
+    session_factory: Callable[[], Session],
+    now: Optional[datetime] = None,
+    chunk_size: int = 1000,
+) -> int:
+    """Delete all expired holds, committing after every chunk.
+
+    Args:
+        session_factory: Callable that returns a sqlalchemy session
+        now: naive utc time the holds are checked against, defaults to the
+            current time
+        chunk_size: maximum number of holds deleted in one transaction
+
+    Returns:
+        the number of holds deleted
+    """
+    now = now or datetime.utcnow()
+    expired = 0
+    while True:
+        session = session_factory()
+        try:
+            expired_in_chunk = expire_chunk(session, now, chunk_size)
+            session.commit()
+        finally:
+            session.close()
+        expired += expired_in_chunk
+        if expired_in_chunk < chunk_size:
+            return expired
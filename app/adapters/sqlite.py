@@ -0,0 +1,198 @@
+"""Sqlite database for running the app on a single node.
+
+The database is one file in WAL mode, so readers keep reading while a writer
+commits. Every connection gets the same pragmas: synchronous NORMAL, which only
+syncs at checkpoints of the WAL, a larger page cache, temporary tables in memory
+and a busy timeout instead of failing at once on a lock.
+
+Sqlite allows one writer at a time, and a transaction that read before it writes
+fails when another one committed in between, whatever the busy timeout. So the
+writer engine begins every transaction with BEGIN IMMEDIATE, which takes the
+write lock up front, and its transactions queue for that lock in a WriterQueue
+in the order they arrive instead of polling the file lock. The queue only orders
+the threads of one process, between processes the busy timeout still applies.
+Views use a separate reader engine whose connections can not write.
+"""
+import sqlite3
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+
+from app.adapters import orm
+
+
+class WriterQueue:
+    """Lock that lets one writer at a time through, in the order they arrived."""
+
+    def __init__(self, timeout: Optional[float] = None):
+        """Init method.
+
+        Args:
+            timeout: seconds a writer waits for its turn, forever when None
+        """
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._waiting: Deque[threading.Event] = deque()
+        self._busy = False
+
+    def acquire(self) -> bool:
+        """Wait for the turn of the calling writer.
+
+        Returns:
+            False when the timeout passed first
+        """
+        with self._lock:
+            if not self._busy:
+                self._busy = True
+                return True
+            turn = threading.Event()
+            self._waiting.append(turn)
+        if turn.wait(self.timeout):
+            return True
+        with self._lock:
+            try:
+                self._waiting.remove(turn)
+            except ValueError:
+                # the turn was handed over right after the timeout
+                return True
+        return False
+
+    def release(self) -> None:
+        """Hand the turn over to the next writer."""
+        with self._lock:
+            if self._waiting:
+                self._waiting.popleft().set()
+            else:
+                self._busy = False
+
+
+def pragmas(
+    busy_timeout: float, cache_size_kib: int, synchronous: str
+) -> Dict[str, Any]:
+    """Get the pragmas of the connections to the database.
+
+    Args:
+        busy_timeout: seconds a connection waits for a lock
+        cache_size_kib: size of the page cache of a connection
+        synchronous: value of the synchronous pragma
+
+    Returns:
+        the value of every pragma by name
+    """
+    return {
+        "journal_mode": "WAL",
+        "synchronous": synchronous,
+        "cache_size": -cache_size_kib,
+        "busy_timeout": int(busy_timeout * 1000),
+        "temp_store": "MEMORY",
+    }
+
+
+def _engine(path: str, settings: Dict[str, Any], pool_size: int) -> Engine:
+    """Create an engine that applies pragmas to its connections.
+
+    The transactions are begun by the engine, not by pysqlite, which would only
+    begin them before the first write.
+    """
+    engine = create_engine(
+        f"sqlite:///{path}",
+        connect_args={"check_same_thread": False},
+        poolclass=QueuePool,
+        pool_size=pool_size,
+    )
+
+    @event.listens_for(engine, "connect")
+    def _connect(dbapi_connection: sqlite3.Connection, record: Any) -> None:
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in settings.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return engine
+
+
+def create_writer_engine(
+    path: str,
+    busy_timeout: float = 5.0,
+    cache_size_kib: int = 64 * 1024,
+    synchronous: str = "NORMAL",
+    pool_size: int = 8,
+) -> Engine:
+    """Create the engine for the units of work, with the tables of the app.
+
+    A single node has no separate step that creates the schema, so missing tables
+    are created here.
+
+    Args:
+        path: file of the database
+        busy_timeout: seconds a transaction waits for the write lock
+        cache_size_kib: size of the page cache of a connection
+        synchronous: value of the synchronous pragma
+        pool_size: number of connections kept open
+
+    Returns:
+        the engine
+    """
+    engine = _engine(
+        path, pragmas(busy_timeout, cache_size_kib, synchronous), pool_size
+    )
+    writers = WriterQueue(busy_timeout)
+
+    @event.listens_for(engine, "begin")
+    def _begin(conn: Connection) -> None:
+        if not writers.acquire():
+            raise OperationalError(
+                "BEGIN IMMEDIATE", None, sqlite3.OperationalError("database is locked")
+            )
+        conn.info["writer"] = True
+        try:
+            conn.execute(text("BEGIN IMMEDIATE"))
+        except Exception:
+            _end(conn)
+            raise
+
+    @event.listens_for(engine, "commit")
+    @event.listens_for(engine, "rollback")
+    def _end(conn: Connection) -> None:
+        if conn.info.pop("writer", False):
+            writers.release()
+
+    orm.metadata.create_all(engine)
+    return engine
+
+
+def create_reader_engine(
+    path: str,
+    busy_timeout: float = 5.0,
+    cache_size_kib: int = 64 * 1024,
+    synchronous: str = "NORMAL",
+    pool_size: int = 8,
+) -> Engine:
+    """Create the engine for the views, whose connections refuse to write.
+
+    Every transaction reads one snapshot of the database.
+
+    Args:
+        path: file of the database
+        busy_timeout: seconds a connection waits for a lock
+        cache_size_kib: size of the page cache of a connection
+        synchronous: value of the synchronous pragma
+        pool_size: number of connections kept open
+
+    Returns:
+        the engine
+    """
+    settings = pragmas(busy_timeout, cache_size_kib, synchronous)
+    engine = _engine(path, {**settings, "query_only": "ON"}, pool_size)
+
+    @event.listens_for(engine, "begin")
+    def _begin(conn: Connection) -> None:
+        conn.execute(text("BEGIN"))
+
+    return engine
@@ -0,0 +1,174 @@
+"""Explicit startup of the app.
+
+Nothing is built when the modules of the app are imported. Entry points call
+bootstrap once, which maps the domain models, builds the engine and returns a
+message bus whose handlers already have their dependencies. Tests and benchmarks
+pass fakes for those dependencies instead of patching modules.
+"""
+import inspect
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+from sqlalchemy.orm import Session
+
+import app.config as config
+from app.adapters import orm
+from app.adapters.dead_letters import AbstractDeadLetterStore, SqlAlchemyDeadLetterStore
+from app.adapters.notifications import (
+    AbstractNotifications,
+    DigestNotifications,
+    EmailNotifications,
+    FileNotifications,
+    LoggingNotifications,
+)
+from app.service_layer import handlers, message_bus, unit_of_work
+from app.service_layer.retries import AbstractRetryQueue
+
+_mappers_started = False
+_mappers_lock = threading.Lock()
+
+
+def start_mappers() -> None:
+    """Map the domain models to the tables, unless that was done already."""
+    global _mappers_started
+    with _mappers_lock:
+        if not _mappers_started:
+            orm.start_mappers()
+            _mappers_started = True
+
+
+def bootstrap(
+    start_orm: bool = True,
+    uow_factory: Optional[Callable[[], unit_of_work.AbstractUnitOfWork]] = None,
+    notifications: Optional[AbstractNotifications] = None,
+    session_factory: Optional[Callable[[], Session]] = None,
+    retry_queue: Optional[AbstractRetryQueue] = None,
+    dead_letters: Optional[AbstractDeadLetterStore] = None,
+) -> message_bus.MessageBus:
+    """Build the message bus and the dependencies of its handlers.
+
+    Args:
+        start_orm: whether the domain models still need to be mapped
+        uow_factory: Callable that returns the unit of work for a message,
+            defaults to sqlalchemy units of work
+        notifications: adapter used by handlers that notify people, defaults to
+            the configured backend
+        session_factory: Callable that returns a sqlalchemy session for the
+            default units of work, defaults to the configured database
+        retry_queue: queue that runs the retries of failed event handlers,
+            defaults to a queue in a background thread
+        dead_letters: store for events whose handlers ran out of attempts,
+            defaults to the dead_letters table of the database of the session
+            factory
+
+    Returns:
+        the message bus, to be closed by the entry point when it shuts down
+    """
+    if start_orm:
+        start_mappers()
+    if uow_factory is None:
+        uow_factory = default_uow_factory(session_factory)
+    if dead_letters is None:
+        dead_letters = SqlAlchemyDeadLetterStore(
+            lambda: (session_factory or unit_of_work.default_session_factory())()
+        )
+    notifications = notifications or default_notifications()
+    dependencies = {"notifications": notifications}
+    injected_event_handlers = {
+        event_type: [
+            message_bus.EventHandler(
+                handler.__name__, inject_dependencies(handler, dependencies), policy
+            )
+            for handler, policy in event_handlers
+        ]
+        for event_type, event_handlers in handlers.EVENT_HANDLERS.items()
+    }
+    injected_command_handlers = {
+        command_type: inject_dependencies(handler, dependencies)
+        for command_type, handler in handlers.COMMAND_HANDLERS.items()
+    }
+    return message_bus.MessageBus(
+        uow_factory=uow_factory,
+        event_handlers=injected_event_handlers,
+        command_handlers=injected_command_handlers,
+        retry_queue=retry_queue,
+        dead_letters=dead_letters,
+        atomic_commands=handlers.ATOMIC_COMMANDS,
+        on_close=[notifications.close],
+    )
+
+
+def default_uow_factory(
+    session_factory: Optional[Callable[[], Session]] = None
+) -> Callable[[], unit_of_work.AbstractUnitOfWork]:
+    """Build the factory of units of work for the configured persistence mode.
+
+    Args:
+        session_factory: Callable that returns a sqlalchemy session, defaults to
+            the configured database
+
+    Returns:
+        Callable that returns the unit of work, one instance shared by every
+        thread and task as it keeps its session per thread and task
+    """
+    session_factory = session_factory or unit_of_work.default_session_factory()
+    persistence = config.get_persistence()
+    uow: unit_of_work.AbstractUnitOfWork
+    if persistence == "orm":
+        uow = unit_of_work.SqlAlchemyUnitOfWork(
+            session_factory, profile=config.get_sql_profiling()
+        )
+    elif persistence == "events":
+        uow = unit_of_work.EventSourcedUnitOfWork(
+            session_factory,
+            profile=config.get_sql_profiling(),
+            snapshot_interval=config.get_snapshot_interval(),
+        )
+    else:
+        raise ValueError(f"Unknown persistence mode {persistence}")
+    return lambda: uow
+
+
+def default_notifications() -> AbstractNotifications:
+    """Build the configured notifications adapter.
+
+    Returns:
+        the adapter, sending digests when a digest window is configured
+    """
+    backend = config.get_notifications_backend()
+    notifications: AbstractNotifications
+    if backend == "email":
+        notifications = EmailNotifications(*config.get_email_host_and_port())
+    elif backend == "file":
+        notifications = FileNotifications(Path(config.get_notifications_file()))
+    elif backend == "log":
+        notifications = LoggingNotifications()
+    else:
+        raise ValueError(f"Unknown notifications backend {backend}")
+    window = config.get_notifications_digest_window()
+    if window > 0:
+        notifications = DigestNotifications(notifications, window)
+    return notifications
+
+
+def inject_dependencies(
+    handler: Callable, dependencies: Dict[str, Any]
+) -> message_bus.Handler:
+    """Build a closure that calls a handler with the dependencies it asks for.
+
+    The parameters of the handler are inspected once here, so the bus can call
+    every handler the same way with just the message and its unit of work.
+
+    Args:
+        handler: handler function, its parameter names select the dependencies
+        dependencies: available dependencies by name
+
+    Returns:
+        Callable that takes the message and the unit of work
+    """
+    params = inspect.signature(handler).parameters
+    deps = {name: dep for name, dep in dependencies.items() if name in params}
+    if "uow" in params:
+        return lambda message, uow: handler(message, uow=uow, **deps)
+    return lambda message, uow: handler(message, **deps)
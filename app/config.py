@@ -1,5 +1,6 @@
 """Helper functions for making connections to/from services."""
 import os
+from typing import List, Tuple
 
 
 def get_postgres_uri() -> str:
@@ -15,6 +16,90 @@ def get_postgres_uri() -> str:
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_database() -> str:
+    """Get which database backs the app, postgres or sqlite for a single node.
+
+    Returns:
+        str with the name of the database backend
+    """
+    return os.environ.get("DATABASE", "postgres")
+
+
+def get_sqlite_path() -> str:
+    """Get the file of the sqlite database.
+
+    Returns:
+        str with the path of the database file
+    """
+    return os.environ.get("SQLITE_PATH", "allocation.db")
+
+
+def get_sqlite_busy_timeout() -> float:
+    """Get how long a sqlite connection waits for a lock before it gives up.
+
+    Returns:
+        float with the timeout in seconds
+    """
+    return float(os.environ.get("SQLITE_BUSY_TIMEOUT", 5))
+
+
+def get_sqlite_cache_size() -> int:
+    """Get the size of the page cache of every sqlite connection.
+
+    Returns:
+        int with the size in KiB
+    """
+    return int(os.environ.get("SQLITE_CACHE_KIB", 64 * 1024))
+
+
+def get_sqlite_synchronous() -> str:
+    """Get when sqlite syncs to disk, NORMAL only syncs at WAL checkpoints.
+
+    Returns:
+        str with the value of the synchronous pragma
+    """
+    return os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+
+
+def get_postgres_replica_uris() -> List[str]:
+    """Get the connection uris of the read replicas of the postgres database.
+
+    DB_REPLICA_HOSTS is a comma separated list of hosts, optionally with a port.
+
+    Returns:
+        list with a connection uri per replica, empty without replicas
+    """
+    password = os.environ.get("DB_PASSWORD", "abc123")
+    user, db_name = "allocation", "allocation"
+    uris = []
+    for host in os.environ.get("DB_REPLICA_HOSTS", "").split(","):
+        host = host.strip()
+        if not host:
+            continue
+        if ":" not in host:
+            host = f"{host}:5432"
+        uris.append(f"postgresql://{user}:{password}@{host}/{db_name}")
+    return uris
+
+
+def get_replica_health_check_interval() -> float:
+    """Get the seconds for which the health of a read replica is trusted.
+
+    Returns:
+        float with the seconds between two health checks of a replica
+    """
+    return float(os.environ.get("REPLICA_HEALTH_CHECK_INTERVAL", 5))
+
+
+def get_replica_connect_timeout() -> int:
+    """Get the seconds after which connecting to a read replica is given up.
+
+    Returns:
+        int with the connect timeout of the replica connections, in seconds
+    """
+    return int(os.environ.get("REPLICA_CONNECT_TIMEOUT", 2))
+
+
 def get_api_url() -> str:
     """Get a valid url for the flask app.
 
@@ -24,3 +109,159 @@ def get_api_url() -> str:
     host = os.environ.get("API_HOST", "localhost")
     port = 5005 if host == "localhost" else 80
     return f"http://{host}:{port}"
+
+
+def get_asgi_host_and_port() -> Tuple[str, int]:
+    """Get the interface and port the asgi server should bind to.
+
+    Returns:
+        tuple with the host and the port
+    """
+    host = os.environ.get("ASGI_HOST", "127.0.0.1")
+    port = int(os.environ.get("ASGI_PORT", 5006))
+    return host, port
+
+
+def get_asgi_workers() -> int:
+    """Get the number of asgi server processes to run.
+
+    Returns:
+        int with the number of worker processes
+    """
+    return int(os.environ.get("ASGI_WORKERS", 1))
+
+
+def get_message_bus_threads() -> int:
+    """Get the number of threads each asgi worker uses to run the message bus.
+
+    Returns:
+        int with the size of the thread pool
+    """
+    return int(os.environ.get("MESSAGE_BUS_THREADS", 8))
+
+
+def get_allocate_batch_window() -> Tuple[float, int]:
+    """Get the window in which allocations are grouped into one transaction.
+
+    A wait of 0 disables the micro-batching of allocations.
+
+    Returns:
+        tuple with the seconds a window stays open and its maximum size
+    """
+    max_wait = float(os.environ.get("ALLOCATE_BATCH_WAIT_MS", 0)) / 1000
+    max_batch_size = int(os.environ.get("ALLOCATE_BATCH_SIZE", 50))
+    return max_wait, max_batch_size
+
+
+def get_out_of_stock_recipient() -> str:
+    """Get who should be notified when a product runs out of stock.
+
+    Returns:
+        str with the destination of out of stock notifications
+    """
+    return os.environ.get("OUT_OF_STOCK_RECIPIENT", "stock@made.com")
+
+
+def get_email_host_and_port() -> Tuple[str, int]:
+    """Get the SMTP server that notification emails are sent through.
+
+    Returns:
+        tuple with the host and the port
+    """
+    host = os.environ.get("EMAIL_HOST", "localhost")
+    port = 11025 if host == "localhost" else 1025
+    return host, port
+
+
+def get_notifications_backend() -> str:
+    """Get how notifications are sent, one of log, email or file.
+
+    Returns:
+        str with the name of the backend
+    """
+    return os.environ.get("NOTIFICATIONS", "log")
+
+
+def get_notifications_file() -> str:
+    """Get the file the file backend appends notifications to.
+
+    Returns:
+        str with the path of the file
+    """
+    return os.environ.get("NOTIFICATIONS_FILE", "notifications.log")
+
+
+def get_notifications_digest_window() -> float:
+    """Get the seconds over which notifications are collected into one digest.
+
+    A window of 0 sends every notification right away.
+
+    Returns:
+        float with the length of the window in seconds
+    """
+    return float(os.environ.get("NOTIFICATIONS_DIGEST_WINDOW", 60))
+
+
+def get_sql_profiling() -> bool:
+    """Get whether the statements of every unit of work are profiled.
+
+    Returns:
+        True when SQL_PROFILING is set to 1
+    """
+    return os.environ.get("SQL_PROFILING", "0") == "1"
+
+
+def get_persistence() -> str:
+    """Get how products are stored, orm for tables of their state, events for streams.
+
+    Returns:
+        str with the name of the persistence mode
+    """
+    return os.environ.get("PERSISTENCE", "orm")
+
+
+def get_snapshot_interval() -> int:
+    """Get the number of versions between two snapshots of an event sourced product.
+
+    Returns:
+        int with the interval
+    """
+    return int(os.environ.get("SNAPSHOT_INTERVAL", 100))
+
+
+def get_product_cache() -> Tuple[int, float]:
+    """Get the size and the time to live of the cache of product responses.
+
+    Returns:
+        tuple with the number of cached responses and their ttl in seconds
+    """
+    maxsize = int(os.environ.get("PRODUCT_CACHE_SIZE", 1024))
+    ttl = float(os.environ.get("PRODUCT_CACHE_TTL", 30))
+    return maxsize, ttl
+
+
+def get_reservation_ttl() -> int:
+    """Get how long a reservation holds stock when the command gives no ttl.
+
+    Returns:
+        int with the ttl in seconds
+    """
+    return int(os.environ.get("RESERVATION_TTL", 600))
+
+
+def get_reservation_sweep_interval() -> float:
+    """Get the seconds between two runs of the sweeper of expired reservations.
+
+    Returns:
+        float with the interval in seconds
+    """
+    return float(os.environ.get("RESERVATION_SWEEP_INTERVAL", 30))
+
+
+def get_archive_retention_days() -> float:
+    """Get how many days after its last allocation an exhausted batch is archived.
+
+    Returns:
+        float with the retention in days
+    """
+    return float(os.environ.get("ARCHIVE_RETENTION_DAYS", 90))
@@ -1,7 +1,7 @@
 """Module to define all the commands of the app."""
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional
+from typing import Dict, Optional
 
 
 class Command:
@@ -12,11 +12,47 @@ class Command:
 
 @dataclass
 class Allocate(Command):
-    """Command for allocating a line order to a batch."""
+    """Command for allocating a line order to a batch.
+
+    Batches at the destination are preferred, when given.
+    """
+
+    orderid: str
+    sku: str
+    qty: int
+    idempotency_key: Optional[str] = None
+    destination: Optional[str] = None
+
+
+@dataclass
+class Reserve(Command):
+    """Command for holding stock for an order line until it is confirmed.
+
+    The hold expires after ttl seconds, the configured reservation ttl when None.
+    """
 
     orderid: str
     sku: str
     qty: int
+    ttl: Optional[int] = None
+    idempotency_key: Optional[str] = None
+    destination: Optional[str] = None
+
+
+@dataclass
+class ConfirmReservation(Command):
+    """Command for turning the unexpired holds of an order into allocations."""
+
+    orderid: str
+    sku: str
+
+
+@dataclass
+class ReleaseReservation(Command):
+    """Command for giving back the stock held for an order."""
+
+    orderid: str
+    sku: str
 
 
 @dataclass
@@ -27,6 +63,8 @@ class CreateBatch(Command):
     sku: str
     qty: int
     eta: Optional[date] = None
+    idempotency_key: Optional[str] = None
+    location: Optional[str] = None
 
 
 @dataclass
@@ -35,3 +73,24 @@ class ChangeBatchQuantity(Command):
 
     ref: str
     qty: int
+
+
+@dataclass
+class ChangeBatchQuantities(Command):
+    """Command for changing the quantities of many batches at once.
+
+    Quantities are given by batchref, the batches may belong to any product.
+    """
+
+    quantities: Dict[str, int]
+
+
+@dataclass
+class Deallocate(Command):
+    """Command for cancelling the allocations of an order.
+
+    Without a sku the order is cancelled for every sku it was allocated for.
+    """
+
+    orderid: str
+    sku: Optional[str] = None
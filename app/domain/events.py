@@ -1,5 +1,7 @@
 """Module to implement all of the expected events for the app."""
 from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Optional
 
 
 class Event:
@@ -13,3 +15,74 @@ class OutOfStock(Event):
     """An event that is raised when there is no more stock for a batch."""
 
     sku: str
+
+
+@dataclass
+class BatchAdded(Event):
+    """A batch was added to a product."""
+
+    sku: str
+    ref: str
+    qty: int
+    eta: Optional[date] = None
+    location: Optional[str] = None
+
+
+@dataclass
+class Allocated(Event):
+    """An order line was allocated to a batch."""
+
+    sku: str
+    orderid: str
+    qty: int
+    batchref: str
+
+
+@dataclass
+class Deallocated(Event):
+    """An order line was taken out of a batch."""
+
+    sku: str
+    orderid: str
+    qty: int
+    batchref: str
+
+
+@dataclass
+class BatchQuantityChanged(Event):
+    """The purchased quantity of a batch was changed."""
+
+    sku: str
+    ref: str
+    qty: int
+
+
+@dataclass
+class Reserved(Event):
+    """Stock of a batch was held for an order line until expires_at."""
+
+    sku: str
+    orderid: str
+    qty: int
+    batchref: str
+    expires_at: datetime
+
+
+@dataclass
+class ReservationConfirmed(Event):
+    """A hold of a batch was turned into an allocation."""
+
+    sku: str
+    orderid: str
+    qty: int
+    batchref: str
+
+
+@dataclass
+class ReservationReleased(Event):
+    """A hold of a batch was given back, because it was released or expired."""
+
+    sku: str
+    orderid: str
+    qty: int
+    batchref: str
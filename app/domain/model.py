@@ -2,9 +2,11 @@
 
 from __future__ import annotations
 
+import heapq
+import itertools
 from dataclasses import dataclass
-from datetime import date
-from typing import Any, List, Optional, Set, Union
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
 from app.domain import commands, events
 
@@ -12,7 +14,16 @@ Message = Union[commands.Command, events.Event]
 
 
 class Product:
-    """Aggregate model."""
+    """Aggregate model.
+
+    Besides the messages in events, every change of state is recorded in changes,
+    so the product can be persisted by appending them to an event stream and be
+    rebuilt with apply.
+    """
+
+    # built on first use, as products loaded by the orm skip __init__
+    _allocations_by_order: Optional[Dict[str, List[Tuple[Batch, OrderLine]]]] = None
+    _batches_by_location: Optional[Dict[Optional[str], List[Batch]]] = None
 
     def __init__(self, sku: str, batches: List[Batch], version_number: int = 0):
         """Initialization of a product.
@@ -27,24 +38,134 @@ class Product:
         self.batches = batches
         self.version_number = version_number
         self.events: List[Message] = []
+        self.changes: List[events.Event] = []
+        self._invalidate_indexes()
+
+    def add_batch(self, batch: Batch) -> None:
+        """Add a batch to the product.
 
-    def allocate(self, line: OrderLine) -> Optional[str]:
+        Args:
+            batch: the new batch
+        """
+        self.batches.append(batch)
+        self._invalidate_indexes()
+        self.version_number += 1
+        self.changes.append(
+            events.BatchAdded(
+                self.sku,
+                batch.reference,
+                batch._purchased_quantity,
+                batch.eta,
+                batch.location,
+            )
+        )
+
+    def allocate(
+        self, line: OrderLine, destination: Optional[str] = None
+    ) -> Optional[str]:
         """Allocate an orderline to a product.
 
+        Batches at the destination are tried first, then the batches of all
+        other locations. Within those, batches in a warehouse come before
+        shipments and earlier shipments before later ones. A line that is
+        already allocated to the chosen batch records no change.
+
         Args:
             line: an order line to allocate to a product
+            destination: location the order is shipped to, if known
 
         Returns:
             reference of the batch to which the line was allocated to.
         """
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
+        batch = self._first_fit(line, destination)
+        if batch is None:
+            self.events.append(events.OutOfStock(line.sku))
+            return None
+        if line not in batch._allocations:
             batch.allocate(line)
-            self.version_number += 1
-            return batch.reference
-        except StopIteration:
+            self._index(batch, line)
+            self.changes.append(
+                events.Allocated(self.sku, line.order_id, line.qty, batch.reference)
+            )
+        self.version_number += 1
+        return batch.reference
+
+    def reserve(
+        self, line: OrderLine, expires_at: datetime, destination: Optional[str] = None
+    ) -> Optional[str]:
+        """Hold stock for an order line until it is confirmed or expires.
+
+        The batch is chosen like for allocate, the held quantity is not available
+        to other lines until the hold is confirmed, released or expired.
+
+        Args:
+            line: the order line to hold stock for
+            expires_at: naive utc time after which the hold can be released
+            destination: location the order is shipped to, if known
+
+        Returns:
+            reference of the batch the stock is held in
+        """
+        batch = self._first_fit(line, destination)
+        if batch is None:
             self.events.append(events.OutOfStock(line.sku))
             return None
+        batch.reserve(Reservation(line.order_id, line.sku, line.qty, expires_at))
+        self.version_number += 1
+        self.changes.append(
+            events.Reserved(
+                self.sku, line.order_id, line.qty, batch.reference, expires_at
+            )
+        )
+        return batch.reference
+
+    def confirm(self, orderid: str, now: datetime) -> List[str]:
+        """Turn the holds of an order into allocations of the same batches.
+
+        Holds that expired are released instead.
+
+        Args:
+            orderid: id of the order
+            now: naive utc time the holds are checked against
+
+        Returns:
+            references of the batches the confirmed lines are allocated to
+        """
+        held = self._reservations_of(orderid)
+        confirmed = []
+        for batch, reservation in held:
+            if reservation.expires_at <= now:
+                self._release(batch, reservation)
+                continue
+            line = reservation.line
+            batch.release(reservation)
+            batch.allocate(line)
+            self._index(batch, line)
+            self.changes.append(
+                events.ReservationConfirmed(
+                    self.sku, line.order_id, line.qty, batch.reference
+                )
+            )
+            confirmed.append(batch.reference)
+        if held:
+            self.version_number += 1
+        return confirmed
+
+    def release(self, orderid: str) -> List[str]:
+        """Give back the stock held for an order.
+
+        Args:
+            orderid: id of the order
+
+        Returns:
+            references of the batches the holds were released from
+        """
+        held = self._reservations_of(orderid)
+        for batch, reservation in held:
+            self._release(batch, reservation)
+        if held:
+            self.version_number += 1
+        return [batch.reference for batch, _ in held]
 
     def change_batch_quantity(self, ref: str, qty: int) -> None:
         """Change the quantity in a batch.
@@ -54,11 +175,224 @@ class Product:
             qty: new quantity in the batch
 
         """
-        batch = next(b for b in self.batches if b.reference == ref)
-        batch._purchased_quantity = qty
+        batch = self._batch(ref)
+        self._set_purchased_quantity(batch, qty)
+        self._invalidate_indexes()
+        self.version_number += 1
+        self._move_reservations(batch)
         while batch.available_quantity < 0:
-            line = batch.deallocate_one()
-            self.events.append(commands.Allocate(line.order_id, line.sku, line.qty))
+            line = self._deallocate_one(batch)
+            self.events.append(
+                commands.Allocate(
+                    line.order_id, line.sku, line.qty, destination=batch.location
+                )
+            )
+
+    def change_batch_quantities(self, quantities: Dict[str, int]) -> None:
+        """Change the quantities of several batches and reallocate what no longer fits.
+
+        The lines taken out of the batches are allocated again right away, instead
+        of through an Allocate command each, preferring the location of the batch
+        they came from.
+
+        Args:
+            quantities: new quantity of each batch, by reference
+        """
+        deallocated: List[Tuple[OrderLine, Optional[str]]] = []
+        for batch in self.batches:
+            if batch.reference not in quantities:
+                continue
+            self._set_purchased_quantity(batch, quantities[batch.reference])
+            self._move_reservations(batch)
+            while batch.available_quantity < 0:
+                line = self._deallocate_one(batch)
+                deallocated.append((line, batch.location))
+        self._invalidate_indexes()
+        self.version_number += 1
+        for line, location in deallocated:
+            self.allocate(line, location)
+
+    def deallocate(self, orderid: str) -> List[str]:
+        """Deallocate all the lines of an order.
+
+        Args:
+            orderid: id of the order to cancel
+
+        Returns:
+            references of the batches the lines were deallocated from
+        """
+        allocations = self._order_index().pop(orderid, [])
+        for batch, line in allocations:
+            batch.deallocate(line)
+            self.changes.append(
+                events.Deallocated(self.sku, line.order_id, line.qty, batch.reference)
+            )
+        if allocations:
+            self.version_number += 1
+        return [batch.reference for batch, _ in allocations]
+
+    def apply(self, change: events.Event) -> None:
+        """Change the state of the product by replaying a recorded change.
+
+        Args:
+            change: one of the changes the product recorded before
+        """
+        if isinstance(change, events.BatchAdded):
+            self.batches.append(
+                Batch(change.ref, change.sku, change.qty, change.eta, change.location)
+            )
+        elif isinstance(change, events.BatchQuantityChanged):
+            self._batch(change.ref)._purchased_quantity = change.qty
+        elif isinstance(change, events.Allocated):
+            self._batch(change.batchref)._allocations.add(
+                OrderLine(change.orderid, change.sku, change.qty)
+            )
+        elif isinstance(change, events.Deallocated):
+            self._batch(change.batchref).deallocate(
+                OrderLine(change.orderid, change.sku, change.qty)
+            )
+        elif isinstance(change, events.Reserved):
+            self._batch(change.batchref).reserve(
+                Reservation(change.orderid, change.sku, change.qty, change.expires_at)
+            )
+        elif isinstance(
+            change, (events.ReservationConfirmed, events.ReservationReleased)
+        ):
+            batch = self._batch(change.batchref)
+            batch.release(
+                next(
+                    r
+                    for r in batch._reservations
+                    if r.order_id == change.orderid and r.qty == change.qty
+                )
+            )
+            if isinstance(change, events.ReservationConfirmed):
+                batch._allocations.add(
+                    OrderLine(change.orderid, change.sku, change.qty)
+                )
+        else:
+            raise ValueError(f"{change} is not a change of a product")
+        self._invalidate_indexes()
+
+    def _invalidate_indexes(self) -> None:
+        """Drop the indexes of the batches, they are built again on next use.
+
+        Called whenever the list of batches or their lines may have changed other
+        than through the methods that keep the indexes up to date, including by
+        the repositories and the orm when they load or expire the batches.
+        """
+        self._allocations_by_order = None
+        self._batches_by_location = None
+
+    def _batch(self, ref: str) -> Batch:
+        """Get a batch by its reference."""
+        return next(b for b in self.batches if b.reference == ref)
+
+    def _first_fit(
+        self, line: OrderLine, destination: Optional[str]
+    ) -> Optional[Batch]:
+        """Get the first batch in allocation order that the line fits in."""
+        index = self._location_index()
+        local = index.get(destination, []) if destination is not None else []
+        others = heapq.merge(
+            *(batches for location, batches in index.items() if batches is not local),
+            key=_eta_order,
+        )
+        return next(
+            (b for b in itertools.chain(local, others) if b.can_allocate(line)), None
+        )
+
+    def _reservations_of(self, orderid: str) -> List[Tuple[Batch, Reservation]]:
+        """Get the holds of an order with the batches they are in."""
+        return [
+            (batch, reservation)
+            for batch in self.batches
+            for reservation in batch._reservations
+            if reservation.order_id == orderid
+        ]
+
+    def _release(self, batch: Batch, reservation: Reservation) -> None:
+        """Give back a hold of a batch and record it."""
+        batch.release(reservation)
+        self.changes.append(
+            events.ReservationReleased(
+                self.sku, reservation.order_id, reservation.qty, batch.reference
+            )
+        )
+
+    def _move_reservations(self, batch: Batch) -> None:
+        """Hold again elsewhere what a batch no longer has the stock for.
+
+        Holds give way before allocations, the latest ones first. They keep their
+        expiry and prefer the location of the batch they came from.
+        """
+        while batch.available_quantity < 0 and batch._reservations:
+            reservation = max(batch._reservations, key=lambda r: r.expires_at)
+            self._release(batch, reservation)
+            self.reserve(reservation.line, reservation.expires_at, batch.location)
+
+    def _set_purchased_quantity(self, batch: Batch, qty: int) -> None:
+        """Change the purchased quantity of a batch and record it."""
+        batch._purchased_quantity = qty
+        self.changes.append(events.BatchQuantityChanged(self.sku, batch.reference, qty))
+
+    def _deallocate_one(self, batch: Batch) -> OrderLine:
+        """Take a line out of a batch, keeping the index and changes up to date."""
+        line = batch.deallocate_one()
+        self._unindex(batch, line)
+        self.changes.append(
+            events.Deallocated(self.sku, line.order_id, line.qty, batch.reference)
+        )
+        return line
+
+    def _location_index(self) -> Dict[Optional[str], List[Batch]]:
+        """Get the batches of each location, in the order they are allocated from.
+
+        The index is built once and kept until the batches change, so an
+        allocation doesn't sort every batch of the product.
+        """
+        if self._batches_by_location is None:
+            self._batches_by_location = {}
+            for batch in sorted(self.batches, key=_eta_order):
+                self._batches_by_location.setdefault(batch.location, []).append(batch)
+        return self._batches_by_location
+
+    def _order_index(self) -> Dict[str, List[Tuple[Batch, OrderLine]]]:
+        """Get the batches and lines allocated to each order id.
+
+        The index is built once from the allocations of every batch and then kept
+        up to date, so finding the lines of an order doesn't scan all batches.
+        """
+        if self._allocations_by_order is None:
+            self._allocations_by_order = {}
+            for batch in self.batches:
+                for line in batch._allocations:
+                    self._allocations_by_order.setdefault(line.order_id, []).append(
+                        (batch, line)
+                    )
+        return self._allocations_by_order
+
+    def _index(self, batch: Batch, line: OrderLine) -> None:
+        """Add an allocated line to the order index, if it was built."""
+        if self._allocations_by_order is not None:
+            self._allocations_by_order.setdefault(line.order_id, []).append(
+                (batch, line)
+            )
+
+    def _unindex(self, batch: Batch, line: OrderLine) -> None:
+        """Remove a deallocated line from the order index, if it was built."""
+        if self._allocations_by_order is None:
+            return
+        allocations = self._allocations_by_order.get(line.order_id, [])
+        if (batch, line) in allocations:
+            allocations.remove((batch, line))
+        if not allocations:
+            self._allocations_by_order.pop(line.order_id, None)
+
+
+def _eta_order(batch: Batch) -> Tuple[bool, date]:
+    """Sort key putting batches in a warehouse first, then by eta."""
+    return batch.eta is not None, batch.eta or date.min
 
 
 @dataclass(unsafe_hash=True)
@@ -70,10 +404,38 @@ class OrderLine:
     qty: int
 
 
+@dataclass(unsafe_hash=True)
+class Reservation:
+    """Stock of a batch held for an order line until it expires, a value object."""
+
+    order_id: str
+    sku: str
+    qty: int
+    expires_at: datetime
+
+    @property
+    def line(self) -> OrderLine:
+        """The order line the stock is held for."""
+        return OrderLine(self.order_id, self.sku, self.qty)
+
+
 class Batch:
     """Model of a Batch. Batches are an entity."""
 
-    def __init__(self, ref: str, sku: str, qty: int, eta: Optional[date] = None):
+    # allocated and unexpired reserved quantities computed by the database when
+    # the batch was loaded for allocation, so the lines and holds are only loaded
+    # once they change
+    _allocated_quantity: Optional[int] = None
+    _reserved_quantity: Optional[int] = None
+
+    def __init__(
+        self,
+        ref: str,
+        sku: str,
+        qty: int,
+        eta: Optional[date] = None,
+        location: Optional[str] = None,
+    ):
         """Initialization of a batch object.
 
         Args:
@@ -82,14 +444,17 @@ class Batch:
             qty: initial ammount of purchased qty for a batch
             eta: estimate date of arrival of a batch if it is shipping,
             None if it is in a warehouse
+            location: warehouse the batch is or will be stored in, if known
 
         """
         self.reference = ref
         self.sku = sku
         self._purchased_quantity = qty
         self.eta = eta
+        self.location = location
         # Note to self, this is a candidate for a command pattern
         self._allocations: Set[OrderLine] = set()
+        self._reservations: Set[Reservation] = set()
 
     def __eq__(self, other: Any) -> bool:
         """Check if a Batch object and a different object are equal.
@@ -132,8 +497,10 @@ class Batch:
             line: Order line to allocate to the batch.
 
         """
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
             self._allocations.add(line)
+            if self._allocated_quantity is not None:
+                self._allocated_quantity += line.qty
 
     def deallocate(self, line: OrderLine) -> None:
         """Deallocate an order line to a batch.
@@ -144,6 +511,8 @@ class Batch:
         """
         if line in self._allocations:
             self._allocations.remove(line)
+            if self._allocated_quantity is not None:
+                self._allocated_quantity -= line.qty
 
     def deallocate_one(self) -> OrderLine:
         """Deallocate the first order line in a batch.
@@ -151,7 +520,34 @@ class Batch:
         Returns:
             the deallocated orderline
         """
-        return self._allocations.pop()
+        line = self._allocations.pop()
+        if self._allocated_quantity is not None:
+            self._allocated_quantity -= line.qty
+        return line
+
+    def reserve(self, reservation: Reservation) -> None:
+        """Hold stock of the batch for an order line.
+
+        Args:
+            reservation: the hold to add to the batch
+        """
+        if reservation in self._reservations:
+            return
+        if self.can_allocate(reservation.line):
+            self._reservations.add(reservation)
+            if self._reserved_quantity is not None:
+                self._reserved_quantity += reservation.qty
+
+    def release(self, reservation: Reservation) -> None:
+        """Give back stock that was held.
+
+        Args:
+            reservation: the hold to remove from the batch
+        """
+        if reservation in self._reservations:
+            self._reservations.remove(reservation)
+            if self._reserved_quantity is not None:
+                self._reserved_quantity -= reservation.qty
 
     @property
     def allocated_quantity(self) -> int:
@@ -160,12 +556,35 @@ class Batch:
         Returns:
             result
         """
+        if self._allocated_quantity is not None:
+            return self._allocated_quantity
         return sum(line.qty for line in self._allocations)
 
+    @property
+    def reserved_quantity(self) -> int:
+        """Get the sum of the quantities held in the batch by unexpired holds.
+
+        Expired holds stop holding stock right away, before they are released.
+
+        Returns:
+            result
+        """
+        if self._reserved_quantity is not None:
+            return self._reserved_quantity
+        now = datetime.utcnow()
+        return sum(
+            reservation.qty
+            for reservation in self._reservations
+            if reservation.expires_at > now
+        )
+
     @property
     def available_quantity(self) -> int:
         """Property with the available quantity of an sku from a batch.
 
+        Held stock is not available until its hold is released.
+
         Returns: result
         """
-        return self._purchased_quantity - self.allocated_quantity
+        unallocated = self._purchased_quantity - self.allocated_quantity
+        return unallocated - self.reserved_quantity
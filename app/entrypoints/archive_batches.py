@@ -0,0 +1,44 @@
+"""Command line tool for archiving the batches that ran out of stock.
+
+Usage:
+    python -m app.entrypoints.archive_batches --chunk-size 1000 --retention-days 90
+"""
+import argparse
+import logging
+from datetime import timedelta
+
+import app.config as config
+from app.adapters import archive
+from app.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def main() -> None:
+    """Archive the exhausted batches of the configured database."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="maximum number of order lines archived in one transaction",
+    )
+    parser.add_argument(
+        "--retention-days",
+        type=float,
+        default=config.get_archive_retention_days(),
+        help="days after its last allocation an exhausted batch is kept",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    archived = archive.archive_exhausted_batches(
+        unit_of_work.default_session_factory(),
+        args.chunk_size,
+        timedelta(days=args.retention_days),
+    )
+    logger.info("archived %d batches", archived)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,385 @@
+"""Module for creating the asgi app.
+
+The app exposes the same contract as the flask app, but the message bus is run
+in a thread pool so the event loop can keep accepting requests while a unit of
+work is waiting on the database.
+"""
+import asyncio
+import contextlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm.exc import StaleDataError
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+import app.config as config
+import app.service_layer.handlers as handlers
+from app import bootstrap, views
+from app.adapters import codec, profiling
+from app.adapters.cache import TTLCache
+from app.domain import commands
+from app.service_layer import message_bus, unit_of_work
+
+T = TypeVar("T")
+
+
+class ThreadedBus:
+    """Runs a message bus in a thread pool, optionally batching allocations."""
+
+    def __init__(
+        self,
+        bus: message_bus.MessageBus,
+        max_workers: int,
+        allocate_batch_window: Tuple[float, int],
+    ):
+        """Start the thread pool.
+
+        Args:
+            bus: message bus to handle the messages with
+            max_workers: size of the thread pool running the message bus
+            allocate_batch_window: seconds and size of the window in which
+                allocations are grouped per sku, a window of 0 seconds disables it
+        """
+        self.bus = bus
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="message-bus"
+        )
+        max_wait, max_batch_size = allocate_batch_window
+        self.batcher: Optional[message_bus.AllocateBatcher] = None
+        if max_wait > 0:
+            self.batcher = message_bus.AllocateBatcher(
+                bus,
+                max_batch_size=max_batch_size,
+                max_wait=max_wait,
+                workers=max_workers,
+            )
+
+    async def handle(self, message: message_bus.Message) -> List[Optional[str]]:
+        """Handle a message without blocking the event loop.
+
+        Args:
+            message: message to process
+
+        Returns:
+            List of results returned by the command handlers.
+        """
+        if self.batcher is not None and isinstance(message, commands.Allocate):
+            return [await asyncio.wrap_future(self.batcher.submit(message))]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.bus.handle, message)
+
+    async def query(
+        self,
+        view: Callable[[str, unit_of_work.ReadOnlyUnitOfWork], T],
+        key: str,
+        uow: unit_of_work.ReadOnlyUnitOfWork,
+    ) -> T:
+        """Run a view without blocking the event loop.
+
+        Args:
+            view: read-only query function
+            key: what to query for
+            uow: read-only unit of work for the view
+
+        Returns:
+            the result of the view
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, view, key, uow)
+
+    def close(self) -> None:
+        """Wait for the messages that are being handled, then close the bus."""
+        if self.batcher is not None:
+            self.batcher.close()
+        self.executor.shutdown(wait=True)
+        self.bus.close()
+
+
+async def _read_json(request: Request) -> Any:
+    """Get the json body of a request, None if there is no valid json body."""
+    try:
+        return await request.json()
+    except json.JSONDecodeError:
+        return None
+
+
+def _invalid_request(e: codec.ValidationError) -> JSONResponse:
+    """Response for a request that is not a valid command."""
+    if isinstance(e, codec.MissingFieldError):
+        return JSONResponse({"message": f"Missing the following input keys: {e}"}, 400)
+    if isinstance(e, codec.EmptyBodyError):
+        return JSONResponse(
+            {
+                "message": "Could not retrieve parameters from an empty request: "
+                f"{e}.\n Please try again ith different parameters."
+            },
+            400,
+        )
+    return JSONResponse({"message": str(e)}, 400)
+
+
+async def conflict_handler(request: Request, exc: Exception) -> JSONResponse:
+    """Answer 409 when a request lost a race with a concurrent one.
+
+    The request changed nothing and can be retried, other database errors are
+    still server errors.
+    """
+    if not unit_of_work.is_conflict(exc):
+        raise exc
+    return JSONResponse({"message": "Conflicting concurrent update, please retry"}, 409)
+
+
+async def key_reused_handler(request: Request, exc: Exception) -> JSONResponse:
+    """Answer 422 when an idempotency key was sent with another type of command."""
+    return JSONResponse({"message": str(exc)}, 422)
+
+
+async def allocate_endpoint(request: Request) -> JSONResponse:
+    """Endpoint for allocating an orderline to a batch.
+
+    Requests with an Idempotency-Key header that was seen before get the batchref
+    of the original allocation.
+    """
+    try:
+        command = codec.from_json_body(
+            commands.Allocate,
+            await _read_json(request),
+            idempotency_key=request.headers.get("Idempotency-Key"),
+        )
+    except codec.ValidationError as e:
+        return _invalid_request(e)
+
+    try:
+        results = await request.app.state.bus.handle(command)
+        batchref = results.pop(0)
+    except handlers.InvalidSku as e:
+        return JSONResponse({"message": str(e)}, 400)
+
+    return JSONResponse({"batchref": batchref}, 201)
+
+
+async def add_batch(request: Request) -> JSONResponse:
+    """Endpoint to add a batch to the database."""
+    try:
+        command = codec.from_json_body(
+            commands.CreateBatch,
+            await _read_json(request),
+            idempotency_key=request.headers.get("Idempotency-Key"),
+        )
+    except codec.ValidationError as e:
+        return _invalid_request(e)
+
+    await request.app.state.bus.handle(command)
+    return JSONResponse({"message": "OK"}, 201)
+
+
+async def deallocate_endpoint(request: Request) -> JSONResponse:
+    """Endpoint for cancelling the allocations of an order."""
+    try:
+        command = codec.from_json_body(commands.Deallocate, await _read_json(request))
+    except codec.ValidationError as e:
+        return _invalid_request(e)
+
+    try:
+        await request.app.state.bus.handle(command)
+    except handlers.InvalidOrderId as e:
+        return JSONResponse({"message": str(e)}, 400)
+    return JSONResponse({"message": "OK"}, 200)
+
+
+async def reserve_endpoint(request: Request) -> JSONResponse:
+    """Endpoint for holding stock for an orderline until it is confirmed.
+
+    The body may give the ttl of the hold in seconds.
+    """
+    try:
+        command = codec.from_json_body(
+            commands.Reserve,
+            await _read_json(request),
+            idempotency_key=request.headers.get("Idempotency-Key"),
+        )
+    except codec.ValidationError as e:
+        return _invalid_request(e)
+
+    try:
+        results = await request.app.state.bus.handle(command)
+        batchref = results.pop(0)
+    except handlers.InvalidSku as e:
+        return JSONResponse({"message": str(e)}, 400)
+
+    return JSONResponse({"batchref": batchref}, 201)
+
+
+async def _handle_reservation(
+    request: Request,
+    command_type: Union[
+        Type[commands.ConfirmReservation], Type[commands.ReleaseReservation]
+    ],
+) -> JSONResponse:
+    """Confirm or release the holds of the order in the request."""
+    try:
+        command = codec.from_json_body(command_type, await _read_json(request))
+    except codec.ValidationError as e:
+        return _invalid_request(e)
+
+    try:
+        await request.app.state.bus.handle(command)
+    except handlers.InvalidOrderId as e:
+        return JSONResponse({"message": str(e)}, 400)
+    return JSONResponse({"message": "OK"}, 200)
+
+
+async def confirm_endpoint(request: Request) -> JSONResponse:
+    """Endpoint for allocating the stock held for an order."""
+    return await _handle_reservation(request, commands.ConfirmReservation)
+
+
+async def release_endpoint(request: Request) -> JSONResponse:
+    """Endpoint for giving back the stock held for an order."""
+    return await _handle_reservation(request, commands.ReleaseReservation)
+
+
+async def allocations_view_endpoint(request: Request) -> JSONResponse:
+    """Endpoint with the batches the lines of an order are allocated to."""
+    result = await request.app.state.bus.query(
+        views.allocations,
+        request.path_params["orderid"],
+        request.app.state.read_uow_factory(),
+    )
+    if not result:
+        return JSONResponse({"message": "not found"}, 404)
+    return JSONResponse({"allocations": result}, 200)
+
+
+async def availability_view_endpoint(request: Request) -> JSONResponse:
+    """Endpoint with the batches of a product that can be allocated to."""
+    result = await request.app.state.bus.query(
+        views.availability,
+        request.path_params["sku"],
+        request.app.state.read_uow_factory(),
+    )
+    return JSONResponse({"batches": result}, 200)
+
+
+async def product_endpoint(request: Request) -> Response:
+    """Endpoint with a product and its batches.
+
+    The ETag is the version of the product, a request with that ETag in
+    If-None-Match gets a 304 after only looking up the version.
+    """
+    loop = asyncio.get_running_loop()
+    etag, body = await loop.run_in_executor(
+        request.app.state.bus.executor,
+        views.product_if_changed,
+        request.path_params["sku"],
+        request.headers.get("If-None-Match"),
+        request.app.state.read_uow_factory,
+        request.app.state.product_cache,
+    )
+    if etag is None:
+        return JSONResponse({"message": "not found"}, 404)
+    if body is None:
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse(body, 200, headers={"ETag": etag})
+
+
+async def sql_profiles_endpoint(request: Request) -> JSONResponse:
+    """Debug endpoint with the SQL reports of the last profiled units of work.
+
+    Only available when SQL_PROFILING is enabled.
+    """
+    if not config.get_sql_profiling():
+        return JSONResponse({"message": "SQL profiling is disabled"}, 404)
+    return JSONResponse({"profiles": list(profiling.recent_reports)}, 200)
+
+
+def create_app(
+    bus: Optional[message_bus.MessageBus] = None,
+    max_workers: Optional[int] = None,
+    allocate_batch_window: Optional[Tuple[float, int]] = None,
+    read_uow_factory: Optional[Callable[[], unit_of_work.ReadOnlyUnitOfWork]] = None,
+) -> Starlette:
+    """Create the asgi app.
+
+    Args:
+        bus: message bus to handle the requests with, defaults to bootstrapping
+            the app for the configured database
+        max_workers: size of the thread pool running the message bus, defaults to
+            the configured amount
+        allocate_batch_window: seconds and size of the window in which allocations
+            are grouped per sku, defaults to the configured window
+        read_uow_factory: Callable that returns the unit of work for the views,
+            defaults to the read replicas of the configured database
+
+    Returns:
+        The starlette app
+    """
+    threaded_bus = ThreadedBus(
+        bus or bootstrap.bootstrap(),
+        max_workers or config.get_message_bus_threads(),
+        allocate_batch_window or config.get_allocate_batch_window(),
+    )
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app: Starlette) -> AsyncIterator[None]:
+        """Wait for the running units of work and flush the notifications."""
+        yield
+        threaded_bus.close()
+
+    app = Starlette(
+        routes=[
+            Route("/allocate", allocate_endpoint, methods=["POST"]),
+            Route("/add_batch", add_batch, methods=["POST"]),
+            Route("/deallocate", deallocate_endpoint, methods=["POST"]),
+            Route("/reserve", reserve_endpoint, methods=["POST"]),
+            Route("/confirm", confirm_endpoint, methods=["POST"]),
+            Route("/release", release_endpoint, methods=["POST"]),
+            Route("/allocations/{orderid}", allocations_view_endpoint),
+            Route("/availability/{sku}", availability_view_endpoint),
+            Route("/products/{sku}", product_endpoint),
+            Route("/debug/sql", sql_profiles_endpoint, methods=["GET"]),
+        ],
+        lifespan=lifespan,
+        exception_handlers={
+            DBAPIError: conflict_handler,
+            StaleDataError: conflict_handler,
+            handlers.IdempotencyKeyReused: key_reused_handler,
+        },
+    )
+    app.state.bus = threaded_bus
+    app.state.read_uow_factory = read_uow_factory or unit_of_work.ReadOnlyUnitOfWork
+    app.state.product_cache = TTLCache(*config.get_product_cache())
+    return app
+
+
+def main() -> None:
+    """Serve the asgi app with the configured amount of worker processes."""
+    import uvicorn
+
+    host, port = config.get_asgi_host_and_port()
+    uvicorn.run(
+        "app.entrypoints.asgi_app:create_app",
+        factory=True,
+        host=host,
+        port=port,
+        workers=config.get_asgi_workers(),
+    )
+
+
+if __name__ == "__main__":
+    main()
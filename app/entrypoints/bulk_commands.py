@@ -0,0 +1,51 @@
+"""Command line tool for handling a file of commands with parallel workers.
+
+Every line of the input file is a json object with the name of the command under
+type and its fields, for example
+{"type": "Allocate", "orderid": "o1", "sku": "LAMP", "qty": 3}.
+
+Usage:
+    python -m app.entrypoints.bulk_commands commands.jsonl results.jsonl
+        [--workers 8]
+"""
+import argparse
+import json
+import logging
+from dataclasses import asdict
+from pathlib import Path
+from typing import cast
+
+from app.adapters import codec
+from app.domain import commands
+from app.service_layer import bulk
+
+logger = logging.getLogger(__name__)
+
+
+def main() -> None:
+    """Handle the commands of a file and write the results in the same order."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("commands", type=Path, help="json lines file of commands")
+    parser.add_argument("results", type=Path, help="json lines file for the results")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of worker processes, defaults to the number of cores",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with args.commands.open() as lines:
+        command_stream = [
+            cast(commands.Command, codec.decode(line)) for line in lines if line.strip()
+        ]
+    results = bulk.process_commands(command_stream, args.workers)
+    with args.results.open("w") as output:
+        for result in results:
+            output.write(json.dumps(asdict(result)) + "\n")
+    failed = sum(result.error is not None for result in results)
+    logger.info("handled %d commands, %d failed", len(results), failed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Command line tool for exporting the allocations to csv or json lines files.
+
+Usage:
+    python -m app.entrypoints.export_allocations exports/allocations
+        [--format csv|jsonl] [--sku SKU ...] [--since 2021-01-01]
+        [--until 2021-01-02] [--rows-per-file 1000000]
+"""
+import argparse
+import logging
+from datetime import datetime
+from pathlib import Path
+
+from app.adapters import export
+from app.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def main() -> None:
+    """Export the allocations of the configured database, from a read replica."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("prefix", type=Path, help="path of the files, no extension")
+    parser.add_argument("--format", choices=export.FORMATS, default="csv")
+    parser.add_argument(
+        "--sku", action="append", dest="skus", help="only export this sku"
+    )
+    parser.add_argument(
+        "--since",
+        type=datetime.fromisoformat,
+        help="only export allocations made at or after this time",
+    )
+    parser.add_argument(
+        "--until",
+        type=datetime.fromisoformat,
+        help="only export allocations made before this time",
+    )
+    parser.add_argument(
+        "--rows-per-file", type=int, help="start a new file after this many rows"
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="number of rows fetched from the database at once",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with unit_of_work.ReadOnlyUnitOfWork() as uow:
+        rows = export.stream_rows(
+            uow.session,
+            export.allocations_query(args.skus, args.since, args.until),
+            args.chunk_size,
+        )
+        paths = export.export_allocations(
+            rows, args.prefix, args.format, args.rows_per_file
+        )
+    logger.info("exported allocations to %s", ", ".join(map(str, paths)))
+
+
+if __name__ == "__main__":
+    main()
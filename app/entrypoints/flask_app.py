@@ -1,41 +1,93 @@
-"""Module for creating the flask app."""
-from datetime import datetime
-from typing import Dict, Optional, Tuple, cast
+"""Module for creating the flask app.
 
-from flask import Flask, request
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+The database and the orm are only set up when the first request is handled. Flask
+has no hook for the shutdown of the server, the message bus is closed when the
+process exits.
+"""
+import atexit
+import functools
+from typing import Any, Dict, Optional, Tuple, Type, Union, cast
+
+from flask import Flask, Response, request
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm.exc import StaleDataError
 
-import app.adapters.orm as orm
 import app.config as config
 import app.service_layer.handlers as handlers
+from app import bootstrap, views
+from app.adapters import codec, profiling
+from app.adapters.cache import TTLCache
 from app.domain import commands
 from app.service_layer import message_bus, unit_of_work
 
-orm.start_mappers()
-get_session = sessionmaker(bind=create_engine(config.get_postgres_uri()))
 app = Flask(__name__)
 
 
-@app.route("/allocate", methods=["POST"])
-def allocate_endpoint() -> Tuple[Dict[str, Optional[str]], int]:
-    """Endpoint for allocating an orderline to a batch."""
-    request_params_dict = cast(dict, request.json)
-    try:
-        orderid = request_params_dict["orderid"]
-        sku = request_params_dict["sku"]
-        qty = request_params_dict["qty"]
-        event = commands.Allocate(orderid, sku, qty)
-    except KeyError as e:
+@functools.lru_cache(maxsize=None)
+def get_bus() -> message_bus.MessageBus:
+    """Get the message bus, bootstrapping the app on the first call."""
+    bus = bootstrap.bootstrap()
+    atexit.register(bus.close)
+    return bus
+
+
+@functools.lru_cache(maxsize=None)
+def get_product_cache() -> TTLCache[Dict[str, Any]]:
+    """Get the cache of product responses of this process."""
+    return TTLCache(*config.get_product_cache())
+
+
+def _invalid_request(e: codec.ValidationError) -> Tuple[Dict[str, str], int]:
+    """Response for a request that is not a valid command."""
+    if isinstance(e, codec.MissingFieldError):
         return {"message": f"Missing the following input keys: {e}"}, 400
-    except TypeError as e:
+    if isinstance(e, codec.EmptyBodyError):
         return {
             "message": f"Could not retrieve parameters from an empty request: {e}."
             f"\n Please try again ith different parameters."
         }, 400
+    return {"message": str(e)}, 400
+
+
+def conflict_handler(e: Exception) -> Tuple[Dict[str, str], int]:
+    """Answer 409 when a request lost a race with a concurrent one.
+
+    The request changed nothing and can be retried, other database errors are
+    still server errors.
+    """
+    if not unit_of_work.is_conflict(e):
+        raise e
+    return {"message": "Conflicting concurrent update, please retry"}, 409
+
+
+def key_reused_handler(e: Exception) -> Tuple[Dict[str, str], int]:
+    """Answer 422 when an idempotency key was sent with another type of command."""
+    return {"message": str(e)}, 422
+
+
+app.register_error_handler(DBAPIError, conflict_handler)
+app.register_error_handler(StaleDataError, conflict_handler)
+app.register_error_handler(handlers.IdempotencyKeyReused, key_reused_handler)
+
 
+@app.route("/allocate", methods=["POST"])
+def allocate_endpoint() -> Tuple[Dict[str, Optional[str]], int]:
+    """Endpoint for allocating an orderline to a batch.
+
+    Requests with an Idempotency-Key header that was seen before get the batchref
+    of the original allocation.
+    """
     try:
-        results = message_bus.handle(event, unit_of_work.SqlAlchemyUnitOfWork())
+        command = codec.from_json_body(
+            commands.Allocate,
+            request.get_json(silent=True),
+            idempotency_key=request.headers.get("Idempotency-Key"),
+        )
+    except codec.ValidationError as e:
+        return cast(Tuple[Dict[str, Optional[str]], int], _invalid_request(e))
+
+    try:
+        results = get_bus().handle(command)
         batchref = results.pop(0)
     except (handlers.InvalidSku) as e:
         return {"message": str(e)}, 400
@@ -49,22 +101,130 @@ def add_batch() -> Tuple[Dict[str, str], int]:
 
     Note: this is probably not a good name for a rest api.
     """
-    request_params_dict = cast(dict, request.json)
     try:
-        ref = request_params_dict["ref"]
-        sku = request_params_dict["sku"]
-        qty = request_params_dict["qty"]
-        eta = request_params_dict["eta"]
-        if eta is not None:
-            eta = datetime.fromisoformat(eta).date()
-        event = commands.CreateBatch(ref, sku, qty, eta)
-    except KeyError as e:
-        return {"message": f"Missing the following input keys: {e}"}, 400
-    except TypeError as e:
-        return {
-            "message": f"Could not retrieve parameters from an empty request: {e}."
-            f"\n Please try again ith different parameters."
-        }, 400
+        command = codec.from_json_body(
+            commands.CreateBatch,
+            request.get_json(silent=True),
+            idempotency_key=request.headers.get("Idempotency-Key"),
+        )
+    except codec.ValidationError as e:
+        return _invalid_request(e)
 
-    message_bus.handle(event, unit_of_work.SqlAlchemyUnitOfWork())
+    get_bus().handle(command)
     return {"message": "OK"}, 201
+
+
+@app.route("/deallocate", methods=["POST"])
+def deallocate_endpoint() -> Tuple[Dict[str, str], int]:
+    """Endpoint for cancelling the allocations of an order."""
+    try:
+        command = codec.from_json_body(
+            commands.Deallocate, request.get_json(silent=True)
+        )
+    except codec.ValidationError as e:
+        return _invalid_request(e)
+
+    try:
+        get_bus().handle(command)
+    except handlers.InvalidOrderId as e:
+        return {"message": str(e)}, 400
+    return {"message": "OK"}, 200
+
+
+@app.route("/reserve", methods=["POST"])
+def reserve_endpoint() -> Tuple[Dict[str, Optional[str]], int]:
+    """Endpoint for holding stock for an orderline until it is confirmed.
+
+    The body may give the ttl of the hold in seconds.
+    """
+    try:
+        command = codec.from_json_body(
+            commands.Reserve,
+            request.get_json(silent=True),
+            idempotency_key=request.headers.get("Idempotency-Key"),
+        )
+    except codec.ValidationError as e:
+        return cast(Tuple[Dict[str, Optional[str]], int], _invalid_request(e))
+
+    try:
+        batchref = get_bus().handle(command).pop(0)
+    except handlers.InvalidSku as e:
+        return {"message": str(e)}, 400
+
+    return {"batchref": batchref}, 201
+
+
+def _handle_reservation(
+    command_type: Union[
+        Type[commands.ConfirmReservation], Type[commands.ReleaseReservation]
+    ]
+) -> Tuple[Dict[str, str], int]:
+    """Confirm or release the holds of the order in the request."""
+    try:
+        command = codec.from_json_body(command_type, request.get_json(silent=True))
+    except codec.ValidationError as e:
+        return _invalid_request(e)
+
+    try:
+        get_bus().handle(command)
+    except handlers.InvalidOrderId as e:
+        return {"message": str(e)}, 400
+    return {"message": "OK"}, 200
+
+
+@app.route("/confirm", methods=["POST"])
+def confirm_endpoint() -> Tuple[Dict[str, str], int]:
+    """Endpoint for allocating the stock held for an order."""
+    return _handle_reservation(commands.ConfirmReservation)
+
+
+@app.route("/release", methods=["POST"])
+def release_endpoint() -> Tuple[Dict[str, str], int]:
+    """Endpoint for giving back the stock held for an order."""
+    return _handle_reservation(commands.ReleaseReservation)
+
+
+@app.route("/allocations/<orderid>", methods=["GET"])
+def allocations_view_endpoint(orderid: str) -> Tuple[Dict[str, Any], int]:
+    """Endpoint with the batches the lines of an order are allocated to."""
+    result = views.allocations(orderid, unit_of_work.ReadOnlyUnitOfWork())
+    if not result:
+        return {"message": "not found"}, 404
+    return {"allocations": result}, 200
+
+
+@app.route("/availability/<sku>", methods=["GET"])
+def availability_view_endpoint(sku: str) -> Tuple[Dict[str, Any], int]:
+    """Endpoint with the batches of a product that can be allocated to."""
+    return {"batches": views.availability(sku, unit_of_work.ReadOnlyUnitOfWork())}, 200
+
+
+@app.route("/products/<sku>", methods=["GET"])
+def product_endpoint(sku: str) -> Any:
+    """Endpoint with a product and its batches.
+
+    The ETag is the version of the product, a request with that ETag in
+    If-None-Match gets a 304 after only looking up the version.
+    """
+    etag, body = views.product_if_changed(
+        sku,
+        request.headers.get("If-None-Match"),
+        unit_of_work.ReadOnlyUnitOfWork,
+        get_product_cache(),
+    )
+    if etag is None:
+        return {"message": "not found"}, 404
+    if body is None:
+        return Response(status=304, headers={"ETag": etag})
+    return body, 200, {"ETag": etag}
+
+
+@app.route("/debug/sql", methods=["GET"])
+def sql_profiles_endpoint() -> Tuple[Dict[str, Any], int]:
+    """Debug endpoint with the SQL reports of the last profiled units of work.
+
+    Only available when SQL_PROFILING is enabled.
+    """
+    if not config.get_sql_profiling():
+        return {"message": "SQL profiling is disabled"}, 404
+    return {"profiles": list(profiling.recent_reports)}, 200
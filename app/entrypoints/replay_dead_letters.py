@@ -0,0 +1,48 @@
+"""Command line tool for replaying the event handlers that ran out of attempts.
+
+Usage:
+    python -m app.entrypoints.replay_dead_letters --list
+    python -m app.entrypoints.replay_dead_letters [--id ID ...]
+"""
+import argparse
+import logging
+
+from app import bootstrap
+
+logger = logging.getLogger(__name__)
+
+
+def main() -> None:
+    """List or replay the dead letters of the configured database."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--id",
+        type=int,
+        action="append",
+        dest="ids",
+        help="id of a dead letter to replay, all of them when not given",
+    )
+    parser.add_argument(
+        "--list", action="store_true", help="only list the dead letters"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    bus = bootstrap.bootstrap()
+    assert bus.dead_letters is not None
+    try:
+        if args.list:
+            for letter in bus.dead_letters.list(args.ids):
+                print(
+                    f"{letter.id}\t{letter.handler}\t{letter.event}"
+                    f"\t{letter.attempts}\t{letter.error}"
+                )
+            return
+        replayed = bus.replay_dead_letters(args.ids)
+    finally:
+        bus.close()
+    logger.info("replayed %d dead letters", replayed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Command line tool for replaying the event log into selected event handlers.
+
+Usage:
+    python -m app.entrypoints.replay_event_log --handler NAME [--handler NAME ...]
+        [--checkpoint NAME] [--chunk-size 1000] [--workers 4]
+"""
+import argparse
+import logging
+
+from app import bootstrap
+from app.adapters.event_log import SqlAlchemyEventLog
+from app.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def main() -> None:
+    """Replay the event log of the configured database, from its checkpoint."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--handler",
+        action="append",
+        dest="handlers",
+        required=True,
+        help="name of an event handler to run",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default="replay",
+        help="name of the replay, a replay with the same name resumes",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="number of events read from the log at once",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="number of skus replayed in parallel"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    bus = bootstrap.bootstrap()
+    try:
+        replayed = bus.replay_event_log(
+            SqlAlchemyEventLog(unit_of_work.default_session_factory()),
+            args.handlers,
+            args.checkpoint,
+            args.chunk_size,
+            args.workers,
+        )
+    finally:
+        bus.close()
+    logger.info("replayed %d events", replayed)
+
+
+if __name__ == "__main__":
+    main()
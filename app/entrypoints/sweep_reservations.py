@@ -0,0 +1,51 @@
+"""Command line tool for releasing the expired reservations in the background.
+
+Usage:
+    python -m app.entrypoints.sweep_reservations --interval 30
+"""
+import argparse
+import logging
+import time
+
+import app.config as config
+from app.adapters import reservations
+from app.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def main() -> None:
+    """Release the expired reservations of the configured database periodically."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=config.get_reservation_sweep_interval(),
+        help="seconds between two sweeps",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="maximum number of reservations released in one transaction",
+    )
+    parser.add_argument(
+        "--once", action="store_true", help="sweep once instead of periodically"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    session_factory = unit_of_work.default_session_factory()
+    while True:
+        expired = reservations.expire_reservations(
+            session_factory, chunk_size=args.chunk_size
+        )
+        if expired:
+            logger.info("released %d expired reservations", expired)
+        if args.once:
+            return
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
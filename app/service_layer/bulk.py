@@ -0,0 +1,161 @@
+"""Bulk processing of command files in parallel worker processes.
+
+Commands of different skus never touch the same aggregate, so a command file is
+split into one partition per sku and the partitions are handled by a pool of
+worker processes, each with its own engine, session factory and message bus.
+Within a partition the commands keep their order. Commands that can not be tied
+to one sku, like a Deallocate without sku, act as barriers: everything before
+them is finished first, then they are handled on their own by one worker.
+"""
+import logging
+import multiprocessing.util
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app import bootstrap
+from app.domain import commands
+from app.service_layer import message_bus, unit_of_work
+
+logger = logging.getLogger(__name__)
+
+SessionFactoryBuilder = Callable[[], Callable[[], Session]]
+Partition = List[Tuple[int, commands.Command]]
+
+_worker_bus: Optional[message_bus.MessageBus] = None
+
+
+@dataclass(frozen=True)
+class CommandResult:
+    """Outcome of one command of a bulk file.
+
+    Attributes:
+        index: position of the command in the file, starting at 0
+        results: what the command handlers returned
+        error: description of the exception the command raised, if any
+    """
+
+    index: int
+    results: List[Optional[str]]
+    error: Optional[str] = None
+
+
+def _sku_of(command: commands.Command, skus_by_ref: Dict[str, str]) -> Optional[str]:
+    """Get the sku whose product a command changes, None if there is not one."""
+    if isinstance(
+        command,
+        (
+            commands.Allocate,
+            commands.CreateBatch,
+            commands.Deallocate,
+            commands.Reserve,
+            commands.ConfirmReservation,
+            commands.ReleaseReservation,
+        ),
+    ):
+        return command.sku
+    if isinstance(command, commands.ChangeBatchQuantity):
+        return skus_by_ref.get(command.ref)
+    return None
+
+
+def segments(
+    numbered: List[Tuple[int, commands.Command]], skus_by_ref: Dict[str, str]
+) -> Iterable[Tuple[List[Partition], Optional[Tuple[int, commands.Command]]]]:
+    """Split commands into partitions per sku, up to the next barrier command.
+
+    Args:
+        numbered: the commands with their position in the file
+        skus_by_ref: sku of every batch reference the commands use
+
+    Yields:
+        the partitions of a segment and the barrier command that ends it, None
+        for the last segment
+    """
+    partitions: Dict[str, Partition] = {}
+    for index, command in numbered:
+        if isinstance(command, commands.CreateBatch):
+            skus_by_ref[command.ref] = command.sku
+        sku = _sku_of(command, skus_by_ref)
+        if sku is None:
+            yield list(partitions.values()), (index, command)
+            partitions = {}
+        else:
+            partitions.setdefault(sku, []).append((index, command))
+    yield list(partitions.values()), None
+
+
+def _handle(
+    bus: message_bus.MessageBus, index: int, command: commands.Command
+) -> CommandResult:
+    """Handle a command, keeping the exception it raises as its result."""
+    try:
+        return CommandResult(index, bus.handle(command))
+    except Exception as e:
+        return CommandResult(index, [], f"{type(e).__name__}: {e}")
+
+
+def _init_worker(session_factory_builder: SessionFactoryBuilder) -> None:
+    """Bootstrap the message bus of a worker process, closed when it exits.
+
+    Worker processes skip the atexit hooks, so the bus is closed by a finalizer
+    of multiprocessing.
+    """
+    global _worker_bus
+    _worker_bus = bootstrap.bootstrap(session_factory=session_factory_builder())
+    multiprocessing.util.Finalize(_worker_bus, _worker_bus.close, exitpriority=10)
+
+
+def _handle_partition(partition: Partition) -> List[CommandResult]:
+    """Handle the commands of a partition in order, in a worker process."""
+    assert _worker_bus is not None
+    return [_handle(_worker_bus, index, command) for index, command in partition]
+
+
+def process_commands(
+    command_stream: Iterable[commands.Command],
+    workers: Optional[int] = None,
+    session_factory_builder: SessionFactoryBuilder = (
+        unit_of_work.default_session_factory
+    ),
+) -> List[CommandResult]:
+    """Handle commands with a pool of worker processes, partitioned by sku.
+
+    Args:
+        command_stream: the commands, in the order they should be handled per sku
+        workers: number of worker processes, defaults to the number of cores
+        session_factory_builder: picklable Callable that builds the session
+            factory, called once in every worker
+
+    Returns:
+        the result of every command, in the order of the commands
+    """
+    numbered = list(enumerate(command_stream))
+    refs = [
+        command.ref
+        for _, command in numbered
+        if isinstance(command, commands.ChangeBatchQuantity)
+    ]
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory_builder()) as uow:
+        skus_by_ref = uow.products.skus_by_batchref(refs)
+    workers = workers or os.cpu_count() or 1
+    results: List[CommandResult] = []
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(session_factory_builder,),
+    ) as executor:
+        for partitions, barrier in segments(numbered, skus_by_ref):
+            chunksize = max(1, len(partitions) // (workers * 4))
+            for partition_results in executor.map(
+                _handle_partition, partitions, chunksize=chunksize
+            ):
+                results.extend(partition_results)
+            if barrier is not None:
+                results.extend(executor.submit(_handle_partition, [barrier]).result())
+    results.sort(key=lambda result: result.index)
+    return results
@@ -1,9 +1,26 @@
 """Definition of service layer functions."""
-from typing import Optional, Protocol
+import functools
+from datetime import datetime, timedelta
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Protocol,
+    Set,
+    Tuple,
+    Type,
+    TypeVar,
+    cast,
+)
 
+import app.config as config
 import app.domain.model as model
+from app.adapters.notifications import AbstractNotifications
+from app.adapters.repository import ProcessedCommand
 from app.domain import commands, events
-from app.service_layer import unit_of_work
+from app.service_layer import retries, unit_of_work
 
 
 class InvalidSku(Exception):
@@ -25,6 +42,24 @@ class InvalidBatchRef(Exception):
     pass
 
 
+class InvalidOrderId(Exception):
+    """Exception to be raised.
+
+    Exception when trying to deallocate an order that has no allocations.
+    """
+
+    pass
+
+
+class IdempotencyKeyReused(Exception):
+    """Exception to be raised.
+
+    Exception when an idempotency key is sent again with another type of command.
+    """
+
+    pass
+
+
 class SessionProtocol(Protocol):
     """Ensure that a session has a commit method.
 
@@ -36,6 +71,70 @@ class SessionProtocol(Protocol):
         raise NotImplementedError
 
 
+KeyedHandler = TypeVar("KeyedHandler", bound=Callable[..., Any])
+
+
+def processed_command(
+    command: commands.Command, uow: unit_of_work.AbstractUnitOfWork
+) -> Optional[ProcessedCommand]:
+    """Get the stored result of a command that was sent before with the same key.
+
+    Args:
+        command: command with an idempotency key
+        uow: unit of work whose transaction the key is looked up in
+
+    Returns:
+        the processed command, None if the command has no key or it was not seen
+
+    Raises:
+        IdempotencyKeyReused: in the case the key was stored for another type of
+        command
+    """
+    key = getattr(command, "idempotency_key", None)
+    if key is None:
+        return None
+    processed = uow.processed_commands.get(key)
+    if processed is not None and processed.command != type(command).__name__:
+        raise IdempotencyKeyReused(
+            f"Idempotency key {key} was used for a {processed.command} command"
+        )
+    return processed
+
+
+def replays_key_races(handler: KeyedHandler) -> KeyedHandler:
+    """Answer a command that lost the race for its idempotency key like the winner.
+
+    Two requests with the same new key both find it unused and handle the
+    command, the one that commits second fails on the unique key. When a handler
+    fails with a conflict, the key is looked up again in a new transaction and
+    the stored result is returned, otherwise the conflict is raised.
+
+    Args:
+        handler: handler of a command with an idempotency key
+
+    Returns:
+        the handler, with the same parameters
+    """
+
+    @functools.wraps(handler)
+    def wrapper(
+        command: Any, uow: unit_of_work.AbstractUnitOfWork, **kwargs: Any
+    ) -> Any:
+        try:
+            return handler(command, uow, **kwargs)
+        except Exception as e:
+            if command.idempotency_key is None or not unit_of_work.is_conflict(e):
+                raise
+            with uow:
+                processed = processed_command(command, uow)
+            if processed is None:
+                raise
+            return processed.result
+
+    return cast(KeyedHandler, wrapper)
+
+
+@replays_key_races
 def add_batch(
     command: commands.CreateBatch,
     uow: unit_of_work.AbstractUnitOfWork,
@@ -50,18 +149,30 @@ def add_batch(
 
     Returns:
         None
+
+    Raises:
+        IdempotencyKeyReused: in the case the idempotency key was sent with
+        another type of command
     """
     with uow:
+        key = command.idempotency_key
+        if processed_command(command, uow) is not None:
+            return
         product = uow.products.get(sku=command.sku)
         if product is None:
             product = model.Product(command.sku, batches=[])
             uow.products.add(product)
-        product.batches.append(
-            model.Batch(command.ref, command.sku, command.qty, command.eta)
+        product.add_batch(
+            model.Batch(
+                command.ref, command.sku, command.qty, command.eta, command.location
+            )
         )
+        if key is not None:
+            uow.processed_commands.add(ProcessedCommand(key, "CreateBatch", None))
         uow.commit()
 
 
+@replays_key_races
 def allocate(
     command: commands.Allocate,
     uow: unit_of_work.AbstractUnitOfWork,
@@ -73,22 +184,154 @@ def allocate(
         ouw: class that abstracts atomic operations related to i/o of data
 
     Returns:
-        batchref: batchref of the batch to which the line was allocated
+        batchref: batchref of the batch to which the line was allocated, for a
+        replayed idempotency key the batchref of the original allocation
+
+    Raises:
+        InvalidSku: in the case that the sku of line is not found in any of the
+        batches of the repo
+        IdempotencyKeyReused: in the case the idempotency key was sent with
+        another type of command
+    """
+    line = model.OrderLine(command.orderid, command.sku, command.qty)
+    with uow:
+        key = command.idempotency_key
+        processed = processed_command(command, uow)
+        if processed is not None:
+            return processed.result
+        product = uow.products.get_for_allocation(sku=line.sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {line.sku}")
+        batchref = product.allocate(line, command.destination)
+        if key is not None:
+            uow.processed_commands.add(ProcessedCommand(key, "Allocate", batchref))
+        uow.commit()
+    return batchref
+
+
+@replays_key_races
+def reserve(
+    command: commands.Reserve,
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> Optional[str]:
+    """Hold stock for an orderline until it is confirmed, released or expires.
+
+    Args:
+        command: reserve command
+        uow: class that abstracts atomic operations related to i/o of data
+
+    Returns:
+        batchref: batchref of the batch the stock is held in, for a replayed
+        idempotency key the batchref of the original reservation
 
     Raises:
         InvalidSku: in the case that the sku of line is not found in any of the
         batches of the repo
+        IdempotencyKeyReused: in the case the idempotency key was sent with
+        another type of command
     """
     line = model.OrderLine(command.orderid, command.sku, command.qty)
+    ttl = command.ttl if command.ttl is not None else config.get_reservation_ttl()
+    expires_at = datetime.utcnow() + timedelta(seconds=ttl)
     with uow:
-        product = uow.products.get(sku=line.sku)
+        key = command.idempotency_key
+        processed = processed_command(command, uow)
+        if processed is not None:
+            return processed.result
+        product = uow.products.get_for_allocation(sku=line.sku)
         if product is None:
             raise InvalidSku(f"Invalid sku {line.sku}")
-        batchref = product.allocate(line)
+        batchref = product.reserve(line, expires_at, command.destination)
+        if key is not None:
+            uow.processed_commands.add(ProcessedCommand(key, "Reserve", batchref))
         uow.commit()
     return batchref
 
 
+def confirm_reservation(
+    command: commands.ConfirmReservation, uow: unit_of_work.AbstractUnitOfWork
+) -> None:
+    """Allocate the stock held for an order, if its holds did not expire.
+
+    Args:
+        command: command with the orderid and sku of the holds
+        uow: class that abstracts atomic operations related to i/o of data
+
+    Raises:
+        InvalidOrderId: in the case where the order has no unexpired holds
+    """
+    with uow:
+        product = uow.products.get(sku=command.sku)
+        confirmed = (
+            product.confirm(command.orderid, datetime.utcnow()) if product else []
+        )
+        if not confirmed:
+            raise InvalidOrderId(f"No reservation for order {command.orderid}")
+        uow.commit()
+
+
+def release_reservation(
+    command: commands.ReleaseReservation, uow: unit_of_work.AbstractUnitOfWork
+) -> None:
+    """Give back the stock held for an order.
+
+    Args:
+        command: command with the orderid and sku of the holds
+        uow: class that abstracts atomic operations related to i/o of data
+
+    Raises:
+        InvalidOrderId: in the case where the order has no holds
+    """
+    with uow:
+        product = uow.products.get(sku=command.sku)
+        released = product.release(command.orderid) if product else []
+        if not released:
+            raise InvalidOrderId(f"No reservation for order {command.orderid}")
+        uow.commit()
+
+
+def allocate_many(
+    allocations: List[commands.Allocate],
+    uow: unit_of_work.AbstractUnitOfWork,
+) -> List[Optional[str]]:
+    """Allocate several orderlines of the same sku in one transaction.
+
+    The product is loaded once and the lines are allocated in the order of the
+    commands, so every command gets the result it would have had on its own.
+
+    Args:
+        allocations: allocate commands that all share the same sku
+        uow: class that abstracts atomic operations related to i/o of data
+
+    Returns:
+        batchrefs of the batches to which each of the lines were allocated
+
+    Raises:
+        InvalidSku: in the case that the sku of the lines is not found
+        IdempotencyKeyReused: in the case an idempotency key was sent with
+        another type of command
+    """
+    sku = allocations[0].sku
+    results: List[Optional[str]] = []
+    with uow:
+        product = uow.products.get_for_allocation(sku=sku)
+        if product is None:
+            raise InvalidSku(f"Invalid sku {sku}")
+        for command in allocations:
+            key = command.idempotency_key
+            processed = processed_command(command, uow)
+            if processed is not None:
+                results.append(processed.result)
+                continue
+            line = model.OrderLine(command.orderid, command.sku, command.qty)
+            batchref = product.allocate(line, command.destination)
+            if key is not None:
+                uow.processed_commands.add(ProcessedCommand(key, "Allocate", batchref))
+            results.append(batchref)
+        uow.commit()
+    return results
+
+
 def change_batch_quantity(
     command: commands.ChangeBatchQuantity, uow: unit_of_work.AbstractUnitOfWork
 ) -> None:
@@ -110,8 +353,96 @@ def change_batch_quantity(
         uow.commit()
 
 
+def change_batch_quantities(
+    command: commands.ChangeBatchQuantities, uow: unit_of_work.AbstractUnitOfWork
+) -> None:
+    """Change the amounts of many batches, one transaction per product.
+
+    The skus of all batches are looked up at once. The lines that no longer fit
+    are reallocated in the transaction of their product.
+
+    Args:
+        command: command with the amount to change to, by batchref
+        uow: class that abstracts atomic operations related to i/o of data
+
+    Raises:
+        InvalidBatchRef: in the case where a batchref does not match a batch in
+        the system, before any quantity is changed
+    """
+    with uow:
+        skus = uow.products.skus_by_batchref(command.quantities)
+    unknown = sorted(set(command.quantities) - set(skus))
+    if unknown:
+        raise InvalidBatchRef(f"Invalid batchref {', '.join(unknown)}")
+    quantities_by_sku: Dict[str, Dict[str, int]] = {}
+    for batchref, qty in command.quantities.items():
+        quantities_by_sku.setdefault(skus[batchref], {})[batchref] = qty
+    for sku, quantities in quantities_by_sku.items():
+        with uow:
+            product = uow.products.get(sku=sku)
+            if product is None:
+                raise InvalidSku(f"Invalid sku {sku}")
+            product.change_batch_quantities(quantities)
+            uow.commit()
+
+
+def deallocate(
+    command: commands.Deallocate, uow: unit_of_work.AbstractUnitOfWork
+) -> None:
+    """Cancel the allocations of an order.
+
+    Args:
+        command: command with the orderid, and optionally the sku, to deallocate
+        uow: class that abstracts atomic operations related to i/o of data
+
+    Raises:
+        InvalidOrderId: in the case where the order has no allocations
+    """
+    with uow:
+        products = uow.products.list_by_orderid(command.orderid, command.sku)
+        deallocated = [
+            batchref
+            for product in products
+            for batchref in product.deallocate(command.orderid)
+        ]
+        if not deallocated:
+            raise InvalidOrderId(f"Invalid orderid {command.orderid}")
+        uow.commit()
+
+
 def send_out_of_stock_notification(
-    event: events.OutOfStock, uow: unit_of_work.AbstractUnitOfWork
+    event: events.OutOfStock, notifications: AbstractNotifications
 ) -> None:
-    """Notify users that an out of stock event was raised."""
-    pass
+    """Notify users that an out of stock event was raised.
+
+    Args:
+        event: out of stock event
+        notifications: adapter used to send the notification
+    """
+    notifications.send(
+        config.get_out_of_stock_recipient(), f"Out of stock for {event.sku}"
+    )
+
+
+EVENT_HANDLERS: Dict[Type[events.Event], List[Tuple[Callable, retries.RetryPolicy]]] = {
+    events.OutOfStock: [
+        (
+            send_out_of_stock_notification,
+            retries.RetryPolicy(max_attempts=5, initial_delay=2.0),
+        )
+    ],
+}
+
+COMMAND_HANDLERS: Dict[Type[commands.Command], Callable[..., Optional[str]]] = {
+    commands.CreateBatch: add_batch,
+    commands.Allocate: allocate,
+    commands.ChangeBatchQuantity: change_batch_quantity,
+    commands.ChangeBatchQuantities: change_batch_quantities,
+    commands.Deallocate: deallocate,
+    commands.Reserve: reserve,
+    commands.ConfirmReservation: confirm_reservation,
+    commands.ReleaseReservation: release_reservation,
+}
+
+# commands whose follow-up commands are handled in the transaction of the command
+ATOMIC_COMMANDS: Set[Type[commands.Command]] = {commands.ChangeBatchQuantity}
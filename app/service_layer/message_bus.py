@@ -1,105 +1,501 @@
 """How to store and process events."""
+import functools
 import logging
-from typing import Callable, Dict, List, Optional, Type, Union
-
-from tenacity import RetryError, Retrying, stop_after_attempt, wait_exponential
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+    Union,
+    cast,
+)
 
+from app.adapters import profiling
+from app.adapters.dead_letters import AbstractDeadLetterStore
+from app.adapters.event_log import AbstractEventLog
 from app.domain import commands, events
 from app.service_layer import handlers, unit_of_work
+from app.service_layer.retries import (
+    DEFAULT_RETRY_POLICY,
+    AbstractRetryQueue,
+    DelayedRetryQueue,
+    RetryPolicy,
+)
 
 logger = logging.getLogger(__name__)
 
 Message = Union[commands.Command, events.Event]
 
 
-def handle(
-    message: Message, uow: unit_of_work.AbstractUnitOfWork
-) -> List[Optional[str]]:
-    """Handle any message, be it a command or an event.
+Handler = Callable[[Message, unit_of_work.AbstractUnitOfWork], Any]
 
-    Args:
-        message: message to process
-        uow: class that abstracts atomic operations related to i/o of data
 
-    Returns:
-        List of results returns by the command handlers.
+@dataclass(frozen=True)
+class EventHandler:
+    """Event handler with the policy for retrying it when it fails.
 
+    Attributes:
+        name: name of the handler, used to find it again for dead letters
+        handle: Callable that takes the event and the unit of work
+        retry_policy: how often and how fast the handler is retried
     """
-    results = []
-    queue = [message]
-    while queue:
-        message = queue.pop(0)
-        if isinstance(message, events.Event):
-            handle_event(message, queue, uow)
-        elif isinstance(message, commands.Command):
-            cmd_result = handle_command(message, queue, uow)
-            results.append(cmd_result)
-        else:
-            raise Exception(f"{message} was not an Event or Command")
-    return results
-
-
-def handle_command(
-    command: commands.Command,
-    queue: List[Message],
-    uow: unit_of_work.AbstractUnitOfWork,
-) -> Optional[str]:
-    """Handler for commands. Different than the event handler as this raises errors.
-
-    Args:
-        command: command to be executed
-        queue: List of messages that still need to be processed
-        uow: class that abstracts atomic operations related to i/o of data
-
-    Returns:
-        List of results returned from the handlers
-    """
-    logger.debug("handling command %s", command)
-    try:
-        handler = COMMAND_HANDLERS[type(command)]
-        result = handler(command, uow)
+
+    name: str
+    handle: Handler
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY
+
+
+class MessageBus:
+    """Dispatches messages to handlers that were built with their dependencies."""
+
+    def __init__(
+        self,
+        uow_factory: Callable[[], unit_of_work.AbstractUnitOfWork],
+        event_handlers: Dict[Type[events.Event], List[EventHandler]],
+        command_handlers: Dict[Type[commands.Command], Handler],
+        retry_queue: Optional[AbstractRetryQueue] = None,
+        dead_letters: Optional[AbstractDeadLetterStore] = None,
+        atomic_commands: Optional[Set[Type[commands.Command]]] = None,
+        on_close: Sequence[Callable[[], None]] = (),
+    ):
+        """Init method.
+
+        Args:
+            uow_factory: Callable that returns the unit of work for a message
+            event_handlers: handlers for each type of event, called with the event
+                and the unit of work
+            command_handlers: handler for each type of command, called with the
+                command and the unit of work
+            retry_queue: queue that runs the retries of failed event handlers,
+                defaults to a queue in a background thread
+            dead_letters: store for events whose handlers ran out of attempts,
+                when None they are only logged
+            atomic_commands: types of commands that are handled in one transaction
+                with the commands they raise, the events they raise are handled
+                once that transaction is committed
+            on_close: Callables run by close once the retry queue stopped, such
+                as the flush of the adapters the handlers send through
+        """
+        self.uow_factory = uow_factory
+        self.event_handlers = event_handlers
+        self.command_handlers = command_handlers
+        self.retry_queue = retry_queue or DelayedRetryQueue()
+        self.dead_letters = dead_letters
+        self.atomic_commands = atomic_commands or set()
+        self.on_close = list(on_close)
+
+    def handle(self, message: Message) -> List[Optional[str]]:
+        """Handle any message, be it a command or an event.
+
+        Args:
+            message: message to process
+
+        Returns:
+            List of results returns by the command handlers.
+
+        """
+        uow = self.uow_factory()
+        results = []
+        queue: Deque[Message] = deque([message])
+        try:
+            while queue:
+                message = queue.popleft()
+                if isinstance(message, events.Event):
+                    self.handle_event(message, queue, uow)
+                elif isinstance(message, commands.Command):
+                    results.extend(self.handle_command(message, queue, uow))
+                else:
+                    raise Exception(f"{message} was not an Event or Command")
+        except Exception:
+            # the unit of work may be shared, the next message of this thread must
+            # not publish the events of the failed one
+            list(uow.collect_new_events())
+            raise
+        return results
+
+    def handle_command(
+        self,
+        command: commands.Command,
+        queue: Deque[Message],
+        uow: unit_of_work.AbstractUnitOfWork,
+    ) -> List[Optional[str]]:
+        """Handler for commands. Different than the event handler as this raises.
+
+        An atomic command is handled in a transaction of its own, the commands it
+        raises are handled right away inside that transaction.
+
+        Args:
+            command: command to be executed
+            queue: messages that still need to be processed
+            uow: class that abstracts atomic operations related to i/o of data
+
+        Returns:
+            List of results returned from the handlers
+        """
+        if type(command) not in self.atomic_commands:
+            result = self._run_command(command, uow)
+            queue.extend(uow.collect_new_events())
+            return [result]
+        results = []
+        pending: Deque[Message] = deque([command])
+        raised_events: List[Message] = []
+        with uow:
+            while pending:
+                message = pending.popleft()
+                if isinstance(message, events.Event):
+                    raised_events.append(message)
+                    continue
+                results.append(self._run_command(message, uow))
+                pending.extend(uow.collect_new_events())
+            uow.commit()
+        queue.extend(raised_events)
         queue.extend(uow.collect_new_events())
-        return result
-    except Exception:
-        logger.exception("Exception handling command %s", command)
-        raise
-
-
-def handle_event(
-    event: events.Event,
-    queue: List[Message],
-    uow: unit_of_work.AbstractUnitOfWork,
-) -> None:
-    """Handler for events.
-
-    Args:
-        event: event to be processed
-        queue: List of messages that still need to be processed
-        uow: class that abstracts atomic operations related to i/o of data
-    """
-    for handler in EVENT_HANDLERS[type(event)]:
+        return results
+
+    def _run_command(
+        self, command: commands.Command, uow: unit_of_work.AbstractUnitOfWork
+    ) -> Optional[str]:
+        """Run the handler of a command, logging the exception it raises."""
+        logger.debug("handling command %s", command)
         try:
-            for attempt in Retrying(
-                stop=stop_after_attempt(3), wait=wait_exponential()
-            ):
-                with attempt:
-                    logger.debug("handling event %s with handler %s", event, handler)
-                    handler(event, uow)
-                    queue.extend(uow.collect_new_events())
-        except RetryError as retry_failure:
-            logger.error(
-                "Failed to handle event %s times, giving up!",
-                retry_failure.last_attempt.attempt_number,
+            handler = self.command_handlers[type(command)]
+            with profiling.label(type(command).__name__):
+                result = handler(command, uow)
+            return cast(Optional[str], result)
+        except Exception:
+            logger.exception("Exception handling command %s", command)
+            raise
+
+    def handle_event(
+        self,
+        event: events.Event,
+        queue: Deque[Message],
+        uow: unit_of_work.AbstractUnitOfWork,
+    ) -> None:
+        """Handler for events.
+
+        A failing handler is not retried here, its retry is scheduled on the retry
+        queue so the message that raised the event is not kept waiting.
+
+        Args:
+            event: event to be processed
+            queue: messages that still need to be processed
+            uow: class that abstracts atomic operations related to i/o of data
+        """
+        for handler in self.event_handlers[type(event)]:
+            logger.debug("handling event %s with handler %s", event, handler.name)
+            try:
+                with profiling.label(f"{type(event).__name__}:{handler.name}"):
+                    handler.handle(event, uow)
+                queue.extend(uow.collect_new_events())
+            except Exception as e:
+                self._handler_failed(handler, event, 1, e)
+
+    def replay_dead_letters(self, ids: Optional[List[int]] = None) -> int:
+        """Run the handlers of dead letters again.
+
+        Dead letters are removed once their handler succeeds, otherwise their
+        error and number of attempts are updated.
+
+        Args:
+            ids: ids of the dead letters to replay, all of them when None
+
+        Returns:
+            the number of dead letters that were replayed successfully
+        """
+        if self.dead_letters is None:
+            raise RuntimeError("The message bus has no dead letter store")
+        replayed = 0
+        for letter in self.dead_letters.list(ids):
+            handler = next(
+                (
+                    h
+                    for h in self.event_handlers.get(type(letter.event), [])
+                    if h.name == letter.handler
+                ),
+                None,
             )
-            continue
+            if handler is None:
+                logger.error("No handler %s for dead letter %s", letter.handler, letter)
+                continue
+            try:
+                new_messages = self._run_event_handler(handler, letter.event)
+            except Exception as e:
+                logger.exception("Exception replaying dead letter %s", letter)
+                self.dead_letters.record_failure(letter.id, repr(e))
+                continue
+            self.dead_letters.remove(letter.id)
+            replayed += 1
+            for message in new_messages:
+                self.handle(message)
+        return replayed
+
+    def replay_event_log(
+        self,
+        log: AbstractEventLog,
+        handler_names: Sequence[str],
+        checkpoint: str,
+        chunk_size: int = 1000,
+        workers: int = 1,
+    ) -> int:
+        """Run selected handlers again for the logged events, to rebuild read models.
 
+        The log is read from the checkpoint of the replay, which is moved forward
+        after every chunk, so a replay that failed resumes where it stopped. The
+        events of a chunk are handled in parallel per sku, in order within a sku.
+        Messages raised by the replayed handlers are not handled, so commands are
+        not processed again.
 
-EVENT_HANDLERS: Dict[Type[events.Event], List[Callable]] = {
-    events.OutOfStock: [handlers.send_out_of_stock_notification],
-}
+        Args:
+            log: the event log
+            handler_names: names of the handlers to run
+            checkpoint: name of the replay, used to resume it
+            chunk_size: number of events read from the log at once
+            workers: number of threads handling the skus of a chunk
+
+        Returns:
+            the number of events replayed
+
+        Raises:
+            ValueError: when a handler name is not known to the bus
+        """
+        known = {
+            handler.name
+            for event_handlers in self.event_handlers.values()
+            for handler in event_handlers
+        }
+        unknown = set(handler_names) - known
+        if unknown:
+            raise ValueError(f"Unknown event handlers {sorted(unknown)}")
+        event_types = [
+            event_type.__name__
+            for event_type, event_handlers in self.event_handlers.items()
+            if any(handler.name in handler_names for handler in event_handlers)
+        ]
+        replayed = 0
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="event-replay"
+        ) as executor:
+            for chunk in log.stream(checkpoint, chunk_size, event_types):
+                by_sku: Dict[Optional[str], List[events.Event]] = {}
+                for _, event in chunk:
+                    by_sku.setdefault(getattr(event, "sku", None), []).append(event)
+                futures = [
+                    executor.submit(self._replay_events, sku_events, handler_names)
+                    for sku_events in by_sku.values()
+                ]
+                for future in futures:
+                    future.result()
+                replayed += len(chunk)
+        return replayed
+
+    def _replay_events(
+        self, replayed: List[events.Event], handler_names: Sequence[str]
+    ) -> None:
+        """Run the selected handlers for events, in order."""
+        for event in replayed:
+            for handler in self.event_handlers.get(type(event), []):
+                if handler.name in handler_names:
+                    new_messages = self._run_event_handler(handler, event)
+                    if new_messages:
+                        logger.debug(
+                            "Not handling %s raised replaying %s", new_messages, event
+                        )
+
+    def _handler_failed(
+        self, handler: EventHandler, event: events.Event, attempt: int, error: Exception
+    ) -> None:
+        """Schedule a retry of a failed handler, or store it as a dead letter."""
+        policy = handler.retry_policy
+        if attempt < policy.max_attempts:
+            logger.warning(
+                "Failed to handle event %s with %s, retrying: %r",
+                event,
+                handler.name,
+                error,
+            )
+            self.retry_queue.schedule(
+                policy.delay(attempt),
+                functools.partial(self._retry_event, handler, event, attempt + 1),
+            )
+            return
+        logger.error(
+            "Failed to handle event %s with %s %s times, giving up!",
+            event,
+            handler.name,
+            attempt,
+            exc_info=error,
+        )
+        if self.dead_letters is not None:
+            self.dead_letters.add(handler.name, event, repr(error), attempt)
+
+    def _retry_event(
+        self, handler: EventHandler, event: events.Event, attempt: int
+    ) -> None:
+        """Retry a failed handler, then handle the messages it raised."""
+        try:
+            new_messages = self._run_event_handler(handler, event)
+        except Exception as e:
+            self._handler_failed(handler, event, attempt, e)
+            return
+        for message in new_messages:
+            self.handle(message)
+
+    def close(self) -> None:
+        """Stop the retry queue and flush the adapters of the handlers.
+
+        Called once when the process shuts down, the bus handles no messages
+        afterwards.
+        """
+        self.retry_queue.close()
+        for close in self.on_close:
+            try:
+                close()
+            except Exception:
+                logger.exception("Failed to close %s", close)
+
+    def _run_event_handler(
+        self, handler: EventHandler, event: events.Event
+    ) -> List[Message]:
+        """Run a handler with a new unit of work.
+
+        Returns:
+            the messages raised while handling the event
+        """
+        uow = self.uow_factory()
+        with profiling.label(f"{type(event).__name__}:{handler.name}"):
+            handler.handle(event, uow)
+        return list(uow.collect_new_events())
+
+
+class AllocateBatcher:
+    """Micro-batching mode for allocations.
+
+    Allocate commands that arrive within a time or size window are grouped by sku,
+    every group is allocated against a single loaded product in one transaction
+    and the future of each caller is completed with its own result.
+    """
+
+    def __init__(
+        self,
+        bus: MessageBus,
+        max_batch_size: int = 50,
+        max_wait: float = 0.005,
+        workers: int = 4,
+    ):
+        """Start collecting allocations in a background thread.
+
+        Args:
+            bus: message bus that provides the units of work and handles the
+                events raised by the allocations
+            max_batch_size: maximum number of commands in a window
+            max_wait: seconds a window stays open after its first command
+            workers: number of groups that can be allocated at the same time
+        """
+        self.bus = bus
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: "queue.Queue[Optional[Tuple[commands.Allocate, Future]]]" = (
+            queue.Queue()
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="allocate-batch"
+        )
+        self._closed = False
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def submit(self, command: commands.Allocate) -> "Future[Optional[str]]":
+        """Queue an allocation for the next window.
+
+        Args:
+            command: allocate command
+
+        Returns:
+            future that is completed with the batchref of the allocation
+        """
+        if self._closed:
+            raise RuntimeError("The allocate batcher is closed")
+        future: "Future[Optional[str]]" = Future()
+        self._queue.put((command, future))
+        return future
+
+    def close(self) -> None:
+        """Handle the queued allocations and stop the background threads."""
+        self._closed = True
+        self._queue.put(None)
+        self._collector.join()
+        self._executor.shutdown(wait=True)
+
+    def _collect(self) -> None:
+        """Collect commands into windows and hand the groups to the executor."""
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            window = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(window) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=max(timeout, 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                window.append(item)
+            groups: Dict[str, List[Tuple[commands.Allocate, Future]]] = {}
+            for command, future in window:
+                groups.setdefault(command.sku, []).append((command, future))
+            for group in groups.values():
+                self._executor.submit(self._allocate_group, group)
+
+    def _allocate_group(self, group: List[Tuple[commands.Allocate, Future]]) -> None:
+        """Allocate a group of commands for one sku and complete their futures."""
+        allocations = [command for command, _ in group]
+        logger.debug("handling %s allocations in one batch", len(allocations))
+        uow = self.bus.uow_factory()
+        try:
+            results = handlers.allocate_many(allocations, uow)
+        except Exception as e:
+            # the unit of work may be shared, its events were not committed
+            list(uow.collect_new_events())
+            if unit_of_work.is_conflict(e) and any(
+                command.idempotency_key is not None for command in allocations
+            ):
+                # a concurrent command may have won the race for one of the keys,
+                # on their own each command gets the result stored for its key
+                self._allocate_one_by_one(group)
+                return
+            logger.exception("Exception handling commands %s", allocations)
+            for _, future in group:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(group, results):
+            future.set_result(result)
+        for event in list(uow.collect_new_events()):
+            self.bus.handle(event)
 
-COMMAND_HANDLERS: Dict[Type[commands.Command], Callable[..., Optional[str]]] = {
-    commands.CreateBatch: handlers.add_batch,
-    commands.Allocate: handlers.allocate,
-    commands.ChangeBatchQuantity: handlers.change_batch_quantity,
-}
+    def _allocate_one_by_one(
+        self, group: List[Tuple[commands.Allocate, Future]]
+    ) -> None:
+        """Handle the commands of a group through the bus, each on its own."""
+        for command, future in group:
+            try:
+                future.set_result(self.bus.handle(command)[0])
+            except Exception as e:
+                future.set_exception(e)
@@ -0,0 +1,132 @@
+"""Retry policies of event handlers and the queue of delayed retries.
+
+Failed event handlers are not retried inline, that would keep the request that
+raised the event waiting. The retry is scheduled on a queue that runs it in a
+background thread once its delay has passed.
+"""
+import abc
+import heapq
+import itertools
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """How often and how fast a failed event handler is retried.
+
+    Attributes:
+        max_attempts: number of times the handler is called, including the first
+        initial_delay: seconds before the first retry
+        multiplier: factor the delay grows with for every next retry
+        max_delay: upper limit of the seconds between two attempts
+    """
+
+    max_attempts: int = 3
+    initial_delay: float = 1.0
+    multiplier: float = 2.0
+    max_delay: float = 60.0
+
+    def delay(self, attempt: int) -> float:
+        """Get the seconds to wait before retrying a failed attempt.
+
+        Args:
+            attempt: number of the attempt that failed, starting at 1
+
+        Returns:
+            the delay in seconds
+        """
+        return min(
+            self.initial_delay * self.multiplier ** (attempt - 1), self.max_delay
+        )
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+NO_RETRIES = RetryPolicy(max_attempts=1)
+
+
+class AbstractRetryQueue(abc.ABC):
+    """Interface for running actions after a delay."""
+
+    @abc.abstractmethod
+    def schedule(self, delay: float, action: Callable[[], None]) -> None:
+        """Run an action once the delay has passed.
+
+        Args:
+            delay: seconds to wait
+            action: Callable to run
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Stop running the scheduled actions."""
+        pass
+
+
+class DelayedRetryQueue(AbstractRetryQueue):
+    """Runs scheduled actions in order of their due time in a background thread.
+
+    The thread is only started when the first action is scheduled. Actions that
+    are still waiting when the process stops are lost, the retried handlers end
+    up in the dead letter store once they run out of attempts instead.
+    """
+
+    def __init__(self) -> None:
+        """Init method."""
+        self._scheduled: List[Tuple[float, int, Callable[[], None]]] = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def schedule(self, delay: float, action: Callable[[], None]) -> None:
+        """Run an action once the delay has passed.
+
+        Args:
+            delay: seconds to wait
+            action: Callable to run
+        """
+        with self._condition:
+            heapq.heappush(
+                self._scheduled, (time.monotonic() + delay, next(self._counter), action)
+            )
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="delayed-retries", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify()
+
+    def close(self) -> None:
+        """Stop the background thread, the waiting actions are dropped."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        """Wait for the next due action and run it."""
+        while True:
+            with self._condition:
+                while not self._closed and (
+                    not self._scheduled or self._scheduled[0][0] > time.monotonic()
+                ):
+                    timeout = (
+                        self._scheduled[0][0] - time.monotonic()
+                        if self._scheduled
+                        else None
+                    )
+                    self._condition.wait(timeout)
+                if self._closed:
+                    return
+                _, _, action = heapq.heappop(self._scheduled)
+            try:
+                action()
+            except Exception:
+                logger.exception("Exception running delayed retry %s", action)
@@ -0,0 +1,289 @@
+"""What-if simulation of allocating a stream of orders against the current stock.
+
+The stock is read once into columns per sku: the references of the batches and
+their available quantity. The allocation policy of Product.allocate, batches at
+the destination first and then warehouse stock before the earliest shipments, is
+turned into one fixed order of the batches per destination. Finding the first
+batch that fits a line is a search in a max segment tree over the available
+quantities in that order, so an allocation costs O(log batches) instead of a scan
+of all batches. Nothing is written to the database.
+"""
+import heapq
+import itertools
+from array import array
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import select
+
+from app.adapters import orm
+from app.adapters.repository import batch_available_quantity
+from app.domain import commands, model
+from app.service_layer.unit_of_work import ReadOnlyUnitOfWork
+
+# value of the empty leaves of the segment trees, below any available quantity
+_EMPTY = -(2**62)
+
+
+@dataclass
+class SkuStock:
+    """Batches of a sku in columns, in the order of Product.batches.
+
+    Attributes:
+        sku: sku of the batches
+        refs: reference of every batch
+        etas: eta of every batch, None for warehouse stock
+        locations: location of every batch
+        available: quantity that can still be allocated from every batch
+    """
+
+    sku: str
+    refs: List[str] = field(default_factory=list)
+    etas: List[Optional[date]] = field(default_factory=list)
+    locations: List[Optional[str]] = field(default_factory=list)
+    available: "array[int]" = field(default_factory=lambda: array("q"))
+
+    def append(
+        self, ref: str, eta: Optional[date], location: Optional[str], available: int
+    ) -> None:
+        """Add a batch to the columns.
+
+        Args:
+            ref: reference of the batch
+            eta: eta of the batch
+            location: location of the batch
+            available: quantity that can still be allocated from the batch
+        """
+        self.refs.append(ref)
+        self.etas.append(eta)
+        self.locations.append(location)
+        self.available.append(available)
+
+
+def stock_from_products(products: Iterable[model.Product]) -> Dict[str, SkuStock]:
+    """Get the stock of products that are already in memory.
+
+    Args:
+        products: the products
+
+    Returns:
+        the stock by sku
+    """
+    stock = {}
+    for product in products:
+        columns = stock[product.sku] = SkuStock(product.sku)
+        for batch in product.batches:
+            columns.append(
+                batch.reference, batch.eta, batch.location, batch.available_quantity
+            )
+    return stock
+
+
+def load_stock(
+    uow: ReadOnlyUnitOfWork, skus: Optional[Sequence[str]] = None
+) -> Dict[str, SkuStock]:
+    """Read the batches and their available quantity with one query.
+
+    Args:
+        uow: read-only unit of work
+        skus: only read these skus, all of them when None
+
+    Returns:
+        the stock by sku
+    """
+    query = select(
+        [
+            orm.batches.c.sku,
+            orm.batches.c.reference,
+            orm.batches.c.eta,
+            orm.batches.c.location,
+            batch_available_quantity(),
+        ]
+    ).order_by(orm.batches.c.id)
+    if skus is not None:
+        query = query.where(orm.batches.c.sku.in_(skus))
+    stock: Dict[str, SkuStock] = {}
+    with uow:
+        for sku, ref, eta, location, available in uow.session.execute(query):
+            if sku not in stock:
+                stock[sku] = SkuStock(sku)
+            stock[sku].append(ref, eta, location, available)
+    return stock
+
+
+class _FirstFit:
+    """Max segment tree for finding the first position with enough quantity."""
+
+    def __init__(self, values: Sequence[int]):
+        """Build the tree over the values, in their order."""
+        self.size = 1
+        while self.size < len(values):
+            self.size *= 2
+        self.tree = array("q", [_EMPTY]) * (2 * self.size)
+        start, end = self.size, self.size + len(values)
+        self.tree[start:end] = array("q", values)
+        for i in range(self.size - 1, 0, -1):
+            self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+
+    def first_at_least(self, qty: int) -> Optional[int]:
+        """Get the first position whose value is at least the quantity."""
+        tree = self.tree
+        if tree[1] < qty:
+            return None
+        i = 1
+        while i < self.size:
+            i = 2 * i if tree[2 * i] >= qty else 2 * i + 1
+        return i - self.size
+
+    def update(self, position: int, value: int) -> None:
+        """Change the value at a position."""
+        tree = self.tree
+        i = position + self.size
+        tree[i] = value
+        i //= 2
+        while i:
+            tree[i] = max(tree[2 * i], tree[2 * i + 1])
+            i //= 2
+
+
+def _eta_order(eta: Optional[date]) -> Tuple[bool, date]:
+    """Sort key of Product.allocate, warehouse stock first, then by eta."""
+    return eta is not None, eta or date.min
+
+
+class _SkuSimulation:
+    """Allocations of one sku against a copy of its stock."""
+
+    def __init__(self, stock: SkuStock):
+        """Group the batches by location in allocation order."""
+        self.refs = stock.refs
+        self.available = array("q", stock.available)
+        self.by_location: Dict[Optional[str], List[int]] = {}
+        for i in sorted(
+            range(len(stock.refs)), key=lambda i: _eta_order(stock.etas[i])
+        ):
+            self.by_location.setdefault(stock.locations[i], []).append(i)
+        self.etas = stock.etas
+        # order of the batches, position of every batch in it and its tree, by
+        # destination, None for destinations without batches
+        self.orders: Dict[Optional[str], Tuple[List[int], List[int], _FirstFit]] = {}
+
+    def allocate(self, qty: int, destination: Optional[str]) -> Optional[str]:
+        """Allocate a line to the first batch it fits in, as Product.allocate."""
+        key = destination if destination in self.by_location else None
+        if key not in self.orders:
+            self.orders[key] = self._build_order(key)
+        order, _, first_fit = self.orders[key]
+        position = first_fit.first_at_least(qty)
+        if position is None:
+            return None
+        batch = order[position]
+        self.available[batch] -= qty
+        for _, positions, tree in self.orders.values():
+            tree.update(positions[batch], self.available[batch])
+        return self.refs[batch]
+
+    def _build_order(
+        self, destination: Optional[str]
+    ) -> Tuple[List[int], List[int], _FirstFit]:
+        """Get the order batches are tried in for a destination, and its tree."""
+        local = self.by_location[destination] if destination is not None else []
+        others = heapq.merge(
+            *(
+                batches
+                for location, batches in self.by_location.items()
+                if batches is not local
+            ),
+            key=lambda i: _eta_order(self.etas[i]),
+        )
+        order = list(itertools.chain(local, others))
+        positions = [0] * len(order)
+        for position, batch in enumerate(order):
+            positions[batch] = position
+        return order, positions, _FirstFit([self.available[i] for i in order])
+
+
+@dataclass
+class SkuReport:
+    """Outcome of the simulated allocations of a sku.
+
+    Attributes:
+        sku: sku of the orders
+        orders: number of order lines
+        allocated: number of order lines that were allocated
+        requested_qty: total quantity of the order lines
+        allocated_qty: total quantity allocated
+    """
+
+    sku: str
+    orders: int = 0
+    allocated: int = 0
+    requested_qty: int = 0
+    allocated_qty: int = 0
+
+    @property
+    def out_of_stock(self) -> int:
+        """Number of order lines that could not be allocated."""
+        return self.orders - self.allocated
+
+    @property
+    def fill_rate(self) -> float:
+        """Fraction of the requested quantity that was allocated."""
+        return self.allocated_qty / self.requested_qty if self.requested_qty else 1.0
+
+
+class Simulation:
+    """Allocates orders against a snapshot of the stock without changing it."""
+
+    def __init__(self, stock: Dict[str, SkuStock]):
+        """Init method.
+
+        Args:
+            stock: the stock by sku, from load_stock or stock_from_products
+        """
+        self.stock = stock
+        self.reports: Dict[str, SkuReport] = {}
+        self._skus: Dict[str, _SkuSimulation] = {}
+
+    def allocate(
+        self, sku: str, qty: int, destination: Optional[str] = None
+    ) -> Optional[str]:
+        """Allocate an order line.
+
+        Lines for skus without stock are counted as out of stock.
+
+        Args:
+            sku: sku of the line
+            qty: quantity of the line
+            destination: location the order is shipped to, if known
+
+        Returns:
+            reference of the batch the line was allocated to
+        """
+        if sku not in self._skus:
+            if sku not in self.stock:
+                self.stock[sku] = SkuStock(sku)
+            self._skus[sku] = _SkuSimulation(self.stock[sku])
+            self.reports[sku] = SkuReport(sku)
+        batchref = self._skus[sku].allocate(qty, destination)
+        report = self.reports[sku]
+        report.orders += 1
+        report.requested_qty += qty
+        if batchref is not None:
+            report.allocated += 1
+            report.allocated_qty += qty
+        return batchref
+
+    def run(self, orders: Iterable[commands.Allocate]) -> Dict[str, SkuReport]:
+        """Allocate a stream of orders, in order.
+
+        Args:
+            orders: the allocate commands of the forecast orders
+
+        Returns:
+            the report of every sku that was ordered
+        """
+        for order in orders:
+            self.allocate(order.sku, order.qty, order.destination)
+        return self.reports
@@ -5,41 +5,223 @@ This module is coupled to the repository.
 from __future__ import annotations
 
 import abc
-from typing import Any, Callable, Generator, Union
+import asyncio
+import threading
+from contextvars import ContextVar
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+    cast,
+)
 
 from sqlalchemy.engine import create_engine
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.orm.session import SessionTransaction
 
 import app.config as config
-from app.adapters import repository
-from app.domain import commands, events
-
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
-        config.get_postgres_uri(),
-        isolation_level="REPEATABLE READ",
-    ),
+from app.adapters import (
+    event_log,
+    event_store,
+    profiling,
+    replicas,
+    repository,
+    sqlite,
 )
+from app.domain import commands, events
 
 Message = Union[commands.Command, events.Event]
 
+_default_session_factory: Optional[sessionmaker] = None
+_default_read_session_factory: Optional[Callable[[], Session]] = None
+_default_session_factory_lock = threading.Lock()
+
+# sqlstates of a transaction losing a race: serialization failure, deadlock and
+# a unique key inserted concurrently
+CONFLICT_SQLSTATES = frozenset(["40001", "40P01", "23505"])
+
+
+def default_session_factory() -> sessionmaker:
+    """Get the session factory for the configured database.
+
+    The engine is only created the first time this is called, so importing the
+    module does not need a resolvable database uri.
+
+    Returns:
+        the sessionmaker, the same one on every call
+    """
+    global _default_session_factory
+    with _default_session_factory_lock:
+        if _default_session_factory is None:
+            if config.get_database() == "sqlite":
+                engine = sqlite.create_writer_engine(
+                    config.get_sqlite_path(), **_sqlite_settings()
+                )
+            else:
+                engine = create_engine(
+                    config.get_postgres_uri(), isolation_level="REPEATABLE READ"
+                )
+            _default_session_factory = sessionmaker(bind=engine)
+    return _default_session_factory
+
+
+def _sqlite_settings() -> Dict[str, Any]:
+    """Get the configured settings of the sqlite engines."""
+    return {
+        "busy_timeout": config.get_sqlite_busy_timeout(),
+        "cache_size_kib": config.get_sqlite_cache_size(),
+        "synchronous": config.get_sqlite_synchronous(),
+        "pool_size": config.get_message_bus_threads(),
+    }
+
+
+def default_read_session_factory() -> Callable[[], Session]:
+    """Get the session factory for read-only queries on the configured database.
+
+    The sessions are bound to the configured read replicas, in turn, or to the
+    primary in read-only mode when there are no healthy replicas. A sqlite
+    database has no replicas, its sessions read the file with connections that
+    can not write.
+
+    Returns:
+        Callable that returns a sqlalchemy session, the same one on every call
+    """
+    global _default_read_session_factory
+    primary = default_session_factory().kw["bind"]
+    with _default_session_factory_lock:
+        if _default_read_session_factory is None:
+            if primary.dialect.name == "sqlite":
+                _default_read_session_factory = replicas.ReplicaRouter(
+                    [],
+                    sqlite.create_reader_engine(
+                        primary.url.database, **_sqlite_settings()
+                    ),
+                )
+            else:
+                _default_read_session_factory = replicas.ReplicaRouter(
+                    [
+                        create_engine(
+                            uri,
+                            pool_pre_ping=True,
+                            connect_args={
+                                "connect_timeout": config.get_replica_connect_timeout()
+                            },
+                        )
+                        for uri in config.get_postgres_replica_uris()
+                    ],
+                    primary.execution_options(postgresql_readonly=True),
+                    config.get_replica_health_check_interval(),
+                )
+    return _default_read_session_factory
+
+
+def is_conflict(error: BaseException) -> bool:
+    """Check whether a unit of work failed because a concurrent one won a race.
+
+    Such a unit of work changed nothing and may succeed when it is retried.
+
+    Args:
+        error: exception raised by a unit of work
+
+    Returns:
+        True for serialization failures, deadlocks and duplicate keys of postgres,
+        a locked or duplicate key of sqlite and stale rows of the orm
+    """
+    if isinstance(error, StaleDataError):
+        return True
+    if not isinstance(error, DBAPIError):
+        return False
+    if getattr(error.orig, "pgcode", None) in CONFLICT_SQLSTATES:
+        return True
+    message = str(error.orig)
+    return "database is locked" in message or "UNIQUE constraint failed" in message
+
+
+def _current_owner() -> Tuple[int, int]:
+    """Identify the running thread and asyncio task, 0 outside of a task."""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return threading.get_ident(), id(task) if task is not None else 0
+
+
+class _Context:
+    """State of a unit of work in the thread or asyncio task that uses it."""
+
+    def __init__(self, owner: Tuple[int, int]):
+        """Init method.
+
+        Args:
+            owner: the thread and task the state belongs to
+        """
+        self.owner = owner
+        self.depth = 0
+        self.unpublished_events: List[Message] = []
+
 
 class AbstractUnitOfWork(abc.ABC):
-    """Abstract class defintion, children must have commit and rollback methods."""
+    """Abstract class defintion, children must have commit and rollback methods.
+
+    The state of a unit of work is kept per thread and per asyncio task in a
+    context variable, so one unit of work can be used by concurrent requests.
+    Entering it again in the same thread or task nests the context in the outer
+    transaction: a commit of a nested context is only final when the outermost
+    context commits, leaving a nested context without commit undoes only its work.
+    """
 
     products: repository.AbstractRepository
+    processed_commands: repository.AbstractProcessedCommandRepository
+
+    def __init__(self) -> None:
+        """Init method."""
+        self._contexts: ContextVar[Optional[_Context]] = ContextVar(
+            f"unit_of_work_{id(self)}", default=None
+        )
 
     def __enter__(self, *args: Any) -> AbstractUnitOfWork:
-        """How to use the class in a context manager."""
+        """Begin a transaction, or a nested one inside the current transaction."""
+        context = self._context()
+        if context.depth == 0:
+            self._begin(context)
+        else:
+            self._begin_nested(context)
+        context.depth += 1
         return self
 
     def __exit__(self, *args: Any) -> None:
-        """What to do when exiting a context."""
-        self.rollback()
+        """What to do when exiting a context.
+
+        The events of the products are kept, as the next context may replace the
+        repository before they are collected.
+        """
+        context = self._context()
+        try:
+            if context.depth > 1:
+                self._rollback_nested(context)
+            else:
+                self.rollback()
+            context.unpublished_events.extend(self._pop_product_events())
+        finally:
+            context.depth -= 1
+            if context.depth == 0:
+                self._end(context)
 
     def commit(self) -> None:
         """How to commit work and publish events."""
-        self._commit()
+        if self._context().depth > 1:
+            self._commit_nested()
+        else:
+            self._commit()
 
     @abc.abstractmethod
     def _commit(self) -> None:
@@ -48,6 +230,19 @@ class AbstractUnitOfWork(abc.ABC):
 
     def collect_new_events(self) -> Generator[Message, None, None]:
         """Event handler."""
+        unpublished = self._context().unpublished_events
+        while unpublished:
+            yield unpublished.pop(0)
+        yield from self._pop_product_events()
+
+    def _pop_product_events(self) -> Generator[Message, None, None]:
+        """Take the events of the products seen by the repository.
+
+        Handlers that do not use their unit of work never enter it, then there is
+        no repository yet.
+        """
+        if not hasattr(self, "products"):
+            return
         for product in self.products.seen:
             while product.events:
                 yield product.events.pop(0)
@@ -57,36 +252,251 @@ class AbstractUnitOfWork(abc.ABC):
         """How to roll work back from the persistent storage."""
         raise NotImplementedError
 
+    def _context(self) -> _Context:
+        """Get the state of the unit of work for the running thread or task.
+
+        Tasks inherit the context variables of the task that created them, a
+        state that belongs to another thread or task is replaced instead of
+        shared.
+        """
+        owner = _current_owner()
+        context = self._contexts.get()
+        if context is None or context.owner != owner:
+            context = self._new_context(owner)
+            self._contexts.set(context)
+        return context
+
+    def _new_context(self, owner: Tuple[int, int]) -> _Context:
+        """Create the state of the unit of work for a thread or task."""
+        return _Context(owner)
+
+    def _begin(self, context: _Context) -> None:
+        """Begin the outermost transaction."""
+        pass
+
+    def _begin_nested(self, context: _Context) -> None:
+        """Begin a transaction nested in the current one."""
+        pass
+
+    def _commit_nested(self) -> None:
+        """Keep the work of a nested transaction in the outer one."""
+        pass
+
+    def _rollback_nested(self, context: _Context) -> None:
+        """Undo the work of a nested transaction that was not committed."""
+        pass
+
+    def _end(self, context: _Context) -> None:
+        """Release what the outermost transaction used."""
+        pass
+
+
+class ReadOnlyUnitOfWork:
+    """Unit of work for queries, on a read replica when there is one.
+
+    Nothing read through it is committed, the transaction is rolled back when the
+    context is left. Use it for views and reports, never for command handlers.
+    """
+
+    def __init__(self, session_factory: Optional[Callable[[], Session]] = None):
+        """Init method.
+
+        Args:
+            session_factory: Callable that returns a sqlalchemy session, defaults to
+                the read-only session factory of the configured database
+        """
+        self.session_factory = session_factory
+
+    def __enter__(self) -> ReadOnlyUnitOfWork:
+        """Open a session when entering a context manager."""
+        session_factory = self.session_factory or default_read_session_factory()
+        self.session = session_factory()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        """Roll back and close the session."""
+        self.session.rollback()
+        self.session.close()
+
+
+class _SessionContext(_Context):
+    """Session and repositories of a sqlalchemy unit of work in a thread or task."""
+
+    session: Session
+    products: repository.AbstractRepository
+    processed_commands: repository.AbstractProcessedCommandRepository
+
+    def __init__(self, owner: Tuple[int, int]):
+        """Init method.
+
+        Args:
+            owner: the thread and task the state belongs to
+        """
+        super().__init__(owner)
+        self.logged: Set[int] = set()
+        self.savepoints: List[SessionTransaction] = []
+        self.recording: Optional[ContextManager[profiling.QueryProfile]] = None
+        self.query_profile: Optional[profiling.QueryProfile] = None
+
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    """Unit of work for a sqlalchemy engine."""
+    """Unit of work for a sqlalchemy engine.
+
+    Every thread and asyncio task gets its own session, nested contexts use a
+    savepoint of the session of the outermost one.
+    """
 
     def __init__(
         self,
-        session_factory: Callable[[], Session] = DEFAULT_SESSION_FACTORY,
+        session_factory: Optional[Callable[[], Session]] = None,
+        profile: bool = False,
     ):
         """Init method.
 
         Args:
-            session_factory: Callable that returns a sqlalchemy session
+            session_factory: Callable that returns a sqlalchemy session, defaults to
+                the session factory of the configured database
+            profile: whether to record and report the statements of every context
         """
+        super().__init__()
         self.session_factory = session_factory
+        self.profile = profile
 
-    def __enter__(self, *args: Any) -> AbstractUnitOfWork:
-        """Return a unit of work subclass when entering a context manager."""
-        self.session = self.session_factory()
-        self.products = repository.SqlAlchemyRepository(self.session)
-        return super().__enter__()
+    @property
+    def session(self) -> Session:
+        """The session of the running thread or task."""
+        return self._session_context().session
 
-    def __exit__(self, *args: Any) -> None:
-        """Close the session after rolling back."""
-        super().__exit__(*args)
-        self.session.close()
+    @property
+    def products(self) -> repository.AbstractRepository:
+        """The product repository of the running thread or task."""
+        return self._session_context().products
+
+    @products.setter
+    def products(self, products: repository.AbstractRepository) -> None:
+        """Replace the product repository of the running thread or task."""
+        self._session_context().products = products
+
+    @property
+    def processed_commands(  # type: ignore[override]
+        self,
+    ) -> repository.AbstractProcessedCommandRepository:
+        """The processed command repository of the running thread or task."""
+        return self._session_context().processed_commands
+
+    def _session_context(self) -> _SessionContext:
+        """Get the state of the running thread or task."""
+        return cast(_SessionContext, self._context())
+
+    def _new_context(self, owner: Tuple[int, int]) -> _Context:
+        """Create the state of the unit of work for a thread or task."""
+        return _SessionContext(owner)
+
+    def _begin(self, context: _Context) -> None:
+        """Open a session with its repositories."""
+        context = cast(_SessionContext, context)
+        session_factory = self.session_factory or default_session_factory()
+        context.session = session_factory()
+        context.logged = set()
+        context.products = self._product_repository(context.session)
+        context.processed_commands = repository.SqlAlchemyProcessedCommandRepository(
+            context.session
+        )
+        if self.profile:
+            profiling.instrument(context.session.get_bind())
+            context.recording = profiling.record_queries()
+            context.query_profile = context.recording.__enter__()
+
+    def _product_repository(self, session: Session) -> repository.AbstractRepository:
+        """Create the product repository for a session."""
+        return repository.SqlAlchemyRepository(session)
+
+    def _begin_nested(self, context: _Context) -> None:
+        """Begin a savepoint in the session of the outer transaction.
+
+        pysqlite only begins a transaction before the first write, a savepoint
+        taken before that would begin it instead and releasing the savepoint would
+        commit it, so the transaction is begun first.
+        """
+        context = cast(_SessionContext, context)
+        connection = context.session.connection()
+        if connection.dialect.name == "sqlite":
+            if not connection.connection.in_transaction:
+                connection.exec_driver_sql("BEGIN")
+        context.savepoints.append(context.session.begin_nested())
+
+    def _end(self, context: _Context) -> None:
+        """Close the session."""
+        context = cast(_SessionContext, context)
+        context.session.close()
+        if context.recording is not None:
+            context.recording.__exit__(None, None, None)
+            context.recording = None
+            if context.query_profile is not None:
+                profiling.publish(context.query_profile)
 
     def _commit(self) -> None:
-        """Commit the work to the sqlalchemy session."""
+        """Commit the work to the sqlalchemy session, with its events logged."""
+        self._write()
         self.session.commit()
 
+    def _commit_nested(self) -> None:
+        """Release the savepoint of the nested transaction."""
+        self._write()
+        self._session_context().savepoints[-1].commit()
+
+    def _rollback_nested(self, context: _Context) -> None:
+        """Roll back to the savepoint, unless it was released."""
+        savepoint = cast(_SessionContext, context).savepoints.pop()
+        if savepoint.is_active:
+            savepoint.rollback()
+
+    def _write(self) -> None:
+        """Add what is not in the session yet, before a commit."""
+        event_log.append(self.session, self._events_to_log())
+
+    def _events_to_log(self) -> List[events.Event]:
+        """Get the events raised by the products that are not logged yet."""
+        logged = self._session_context().logged
+        unlogged = [
+            message
+            for product in self.products.seen
+            for message in product.events
+            if isinstance(message, events.Event) and id(message) not in logged
+        ]
+        logged.update(id(event) for event in unlogged)
+        return unlogged
+
     def rollback(self) -> None:
         """How to perform a rollback."""
         self.session.rollback()
+
+
+class EventSourcedUnitOfWork(SqlAlchemyUnitOfWork):
+    """Unit of work that stores products as streams of their changes."""
+
+    def __init__(
+        self,
+        session_factory: Optional[Callable[[], Session]] = None,
+        profile: bool = False,
+        snapshot_interval: int = 100,
+    ):
+        """Init method.
+
+        Args:
+            session_factory: Callable that returns a sqlalchemy session, defaults to
+                the session factory of the configured database
+            profile: whether to record and report the statements of every context
+            snapshot_interval: number of versions between two snapshots of a product
+        """
+        super().__init__(session_factory, profile)
+        self.snapshot_interval = snapshot_interval
+
+    def _product_repository(self, session: Session) -> repository.AbstractRepository:
+        """Use the event sourced product repository."""
+        return event_store.EventSourcedRepository(session, self.snapshot_interval)
+
+    def _write(self) -> None:
+        """Append the changes of the products, then log their events."""
+        cast(event_store.EventSourcedRepository, self.products).save()
+        super()._write()
@@ -1,7 +1,17 @@
 """Pytest fixtures for running sqlite."""
+import contextlib
 import time
 from pathlib import Path
-from typing import Callable, Generator, List, Optional, Tuple, cast
+from typing import (
+    Callable,
+    ContextManager,
+    Generator,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    cast,
+)
 
 import pytest
 import requests
@@ -11,6 +21,7 @@ from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import Session, clear_mappers, sessionmaker
 
 import app.config as config
+from app.adapters import profiling
 from app.adapters.orm import metadata, start_mappers
 
 
@@ -36,6 +47,42 @@ def session(session_factory: sessionmaker) -> Session:
     return cast(Session, session_factory())
 
 
+@pytest.fixture
+def max_queries(
+    in_memory_db: Engine,
+) -> Callable[[int], ContextManager[profiling.QueryProfile]]:
+    """Fixture that returns a context manager limiting the statements sent.
+
+    Usage:
+        with max_queries(3):
+            bus.handle(command)
+    """
+    profiling.instrument(in_memory_db)
+
+    @contextlib.contextmanager
+    def _max_queries(limit: int) -> Iterator[profiling.QueryProfile]:
+        with profiling.record_queries() as profile:
+            yield profile
+        assert profile.count <= limit, profile.report()
+
+    return _max_queries
+
+
+@pytest.fixture
+def sqlite_file_session_factory(
+    tmp_path: Path,
+) -> Generator[sessionmaker, None, None]:
+    """Session factory for a sqlite file, so it can be shared between threads."""
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'allocation.db'}",
+        connect_args={"check_same_thread": False},
+    )
+    metadata.create_all(engine)
+    start_mappers()
+    yield sessionmaker(bind=engine)
+    clear_mappers()
+
+
 def wait_for_postgres_to_come_up(engine: Engine) -> Connection:
     """Wait for connection to postgres.
 
@@ -28,6 +28,23 @@ def test_api_returns_allocation_and_201() -> None:
     assert r.json()["batchref"] == early_batch
 
 
+@pytest.mark.non_postgres_tests
+@pytest.mark.usefixtures("postgres_db")
+@pytest.mark.usefixtures("restart_api")
+def test_replayed_idempotency_key_returns_original_batchref() -> None:
+    sku, batch = random_sku(), random_batchref()
+    post_to_add_batch(batch, sku, 10, None)
+    data = {"orderid": random_orderid(), "sku": sku, "qty": 10}
+    headers = {"Idempotency-Key": random_orderid("key")}
+    url = config.get_api_url()
+
+    first = requests.post(f"{url}/allocate", json=data, headers=headers)
+    replayed = requests.post(f"{url}/allocate", json=data, headers=headers)
+
+    assert first.status_code == replayed.status_code == 201
+    assert first.json()["batchref"] == replayed.json()["batchref"] == batch
+
+
 @pytest.mark.non_postgres_tests
 @pytest.mark.usefixtures("postgres_db")
 @pytest.mark.usefixtures("restart_api")
@@ -0,0 +1,173 @@
+"""Tests for archiving the batches that ran out of stock."""
+from datetime import datetime, timedelta
+from typing import Callable
+
+from sqlalchemy.orm import Session
+
+from app import views
+from app.adapters import archive
+from app.domain import model
+from app.service_layer import unit_of_work
+from app.tests.integration.test_uow import insert_batch
+
+
+def allocate_all(
+    session_factory: Callable[[], Session], *lines: model.OrderLine
+) -> None:
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        for line in lines:
+            product = uow.products.get(sku=line.sku)
+            assert product is not None
+            product.allocate(line)
+        uow.commit()
+
+
+def backdate_allocations(session: Session, days: int) -> None:
+    session.execute(
+        "UPDATE allocations SET allocated_at = :at",
+        dict(at=datetime.utcnow() - timedelta(days=days)),
+    )
+    session.commit()
+
+
+def test_archives_exhausted_batches_with_their_allocations(
+    session_factory: Callable[[], Session]
+) -> None:
+    session = session_factory()
+    insert_batch(session, "batch1", "HIPSTER-WORKBENCH", 10, None)
+    session.execute(
+        "INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
+        " VALUES ('batch2', 'HIPSTER-WORKBENCH', 10, NULL)",
+    )
+    session.commit()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        product = uow.products.get(sku="HIPSTER-WORKBENCH")
+        assert product is not None
+        product.allocate(model.OrderLine("o1", "HIPSTER-WORKBENCH", 10))
+        product.allocate(model.OrderLine("o2", "HIPSTER-WORKBENCH", 5))
+        uow.commit()
+        version = product.version_number
+    backdate_allocations(session, days=100)
+
+    assert archive.archive_exhausted_batches(session_factory, chunk_size=1) == 1
+
+    with uow:
+        product = uow.products.get(sku="HIPSTER-WORKBENCH")
+        assert product is not None
+        assert [b.reference for b in product.batches] == ["batch2"]
+        assert product.version_number == version + 1
+    assert list(session.execute("SELECT reference FROM archived_batches")) == [
+        ("batch1",)
+    ]
+    assert list(session.execute("SELECT order_id FROM archived_order_lines")) == [
+        ("o1",)
+    ]
+    assert list(session.execute("SELECT order_id FROM order_lines")) == [("o2",)]
+    assert len(list(session.execute("SELECT * FROM archived_allocations"))) == 1
+
+
+def test_archiving_without_exhausted_batches_changes_nothing(
+    session_factory: Callable[[], Session]
+) -> None:
+    session = session_factory()
+    insert_batch(session, "batch1", "HIPSTER-WORKBENCH", 10, None)
+    session.commit()
+
+    assert archive.archive_exhausted_batches(session_factory) == 0
+
+    [[version]] = session.execute("SELECT version_number FROM products")
+    assert version == 1
+
+
+def test_keeps_exhausted_batches_within_the_retention_window(
+    session_factory: Callable[[], Session]
+) -> None:
+    session = session_factory()
+    insert_batch(session, "batch1", "HIPSTER-WORKBENCH", 10, None)
+    session.commit()
+    allocate_all(session_factory, model.OrderLine("o1", "HIPSTER-WORKBENCH", 10))
+    backdate_allocations(session, days=30)
+
+    archived = archive.archive_exhausted_batches(
+        session_factory, retention=timedelta(days=90)
+    )
+
+    assert archived == 0
+    assert list(session.execute("SELECT reference FROM batches")) == [("batch1",)]
+
+
+def test_chunks_are_bounded_by_the_number_of_order_lines(
+    session_factory: Callable[[], Session]
+) -> None:
+    session = session_factory()
+    insert_batch(session, "batch1", "HIPSTER-WORKBENCH", 2, None)
+    for reference in ["batch2", "batch3"]:
+        session.execute(
+            "INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
+            " VALUES (:reference, 'HIPSTER-WORKBENCH', 1, NULL)",
+            dict(reference=reference),
+        )
+    session.commit()
+    allocate_all(
+        session_factory,
+        *[model.OrderLine(f"o{i}", "HIPSTER-WORKBENCH", 1) for i in range(4)],
+    )
+    backdate_allocations(session, days=100)
+    cutoff = datetime.utcnow() - timedelta(days=90)
+
+    assert archive.archive_chunk(session, cutoff, chunk_size=2) == 1
+    assert archive.archive_chunk(session, cutoff, chunk_size=2) == 2
+    assert archive.archive_chunk(session, cutoff, chunk_size=2) == 0
+    session.commit()
+    assert len(list(session.execute("SELECT * FROM archived_order_lines"))) == 4
+    assert list(session.execute("SELECT * FROM order_lines")) == []
+
+
+def test_allocations_view_reads_the_archived_lines(
+    session_factory: Callable[[], Session]
+) -> None:
+    session = session_factory()
+    insert_batch(session, "batch1", "HIPSTER-WORKBENCH", 10, None)
+    session.commit()
+    allocate_all(session_factory, model.OrderLine("o1", "HIPSTER-WORKBENCH", 10))
+    backdate_allocations(session, days=100)
+
+    assert archive.archive_exhausted_batches(session_factory) == 1
+
+    uow = unit_of_work.ReadOnlyUnitOfWork(session_factory)
+    assert views.allocations("o1", uow) == [
+        {"sku": "HIPSTER-WORKBENCH", "batchref": "batch1"}
+    ]
+
+
+def test_batches_created_after_an_archival_are_archived_with_new_ids(
+    session_factory: Callable[[], Session]
+) -> None:
+    session = session_factory()
+    insert_batch(session, "batch1", "HIPSTER-WORKBENCH", 10, None)
+    session.commit()
+    allocate_all(session_factory, model.OrderLine("o1", "HIPSTER-WORKBENCH", 10))
+    backdate_allocations(session, days=100)
+    assert archive.archive_exhausted_batches(session_factory) == 1
+
+    for reference, qty in [("batch2", 5), ("batch3", 10)]:
+        session.execute(
+            "INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
+            " VALUES (:reference, 'HIPSTER-WORKBENCH', :qty, NULL)",
+            dict(reference=reference, qty=qty),
+        )
+    session.commit()
+    allocate_all(session_factory, model.OrderLine("o2", "HIPSTER-WORKBENCH", 5))
+    allocate_all(session_factory, model.OrderLine("o3", "HIPSTER-WORKBENCH", 5))
+    backdate_allocations(session, days=100)
+
+    assert archive.archive_exhausted_batches(session_factory) == 1
+
+    assert list(session.execute("SELECT reference FROM archived_batches")) == [
+        ("batch1",),
+        ("batch2",),
+    ]
+    assert list(session.execute("SELECT reference FROM batches")) == [("batch3",)]
+    assert list(session.execute("SELECT order_id FROM order_lines")) == [("o3",)]
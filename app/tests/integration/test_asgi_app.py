@@ -0,0 +1,238 @@
+"""Tests for the asgi api endpoints."""
+import sqlite3
+from typing import Generator, List, Optional, cast
+
+import pytest
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
+from starlette.testclient import TestClient
+
+from app import bootstrap
+from app.entrypoints.asgi_app import create_app
+from app.service_layer import message_bus, unit_of_work
+from app.tests.random_refs import random_batchref, random_orderid, random_sku
+
+
+@pytest.fixture
+def client(
+    sqlite_file_session_factory: sessionmaker,
+) -> Generator[TestClient, None, None]:
+    bus = bootstrap.bootstrap(
+        start_orm=False, session_factory=sqlite_file_session_factory
+    )
+    app = create_app(bus, max_workers=2)
+    with TestClient(app) as client:
+        yield client
+
+
+def post_to_add_batch(
+    client: TestClient, ref: str, sku: str, qty: int, eta: Optional[str]
+) -> None:
+    r = client.post("/add_batch", json={"ref": ref, "sku": sku, "qty": qty, "eta": eta})
+    assert r.status_code == 201
+
+
+def test_api_returns_allocation_and_201(client: TestClient) -> None:
+    sku, other_sku = random_sku(), random_sku("other")
+    early_batch = random_batchref("1")
+    later_batch = random_batchref("2")
+    other_batch = random_batchref("3")
+    post_to_add_batch(client, later_batch, sku, 100, "2011-01-02")
+    post_to_add_batch(client, early_batch, sku, 100, "2011-01-01")
+    post_to_add_batch(client, other_batch, other_sku, 100, None)
+
+    data = {"orderid": random_orderid(), "sku": sku, "qty": 3}
+    r = client.post("/allocate", json=data)
+
+    assert r.status_code == 201
+    assert r.json()["batchref"] == early_batch
+
+
+def test_replayed_idempotency_key_returns_original_batchref(
+    client: TestClient,
+) -> None:
+    sku, batch = random_sku(), random_batchref()
+    post_to_add_batch(client, batch, sku, 10, None)
+    data = {"orderid": random_orderid(), "sku": sku, "qty": 10}
+    headers = {"Idempotency-Key": random_orderid("key")}
+
+    first = client.post("/allocate", json=data, headers=headers)
+    replayed = client.post("/allocate", json=data, headers=headers)
+
+    assert first.status_code == replayed.status_code == 201
+    assert first.json()["batchref"] == replayed.json()["batchref"] == batch
+
+
+def test_idempotency_key_of_another_command_returns_422(client: TestClient) -> None:
+    sku, batch = random_sku(), random_batchref()
+    post_to_add_batch(client, batch, sku, 10, None)
+    headers = {"Idempotency-Key": random_orderid("key")}
+    data = {"orderid": random_orderid(), "sku": sku, "qty": 1}
+
+    reserved = client.post("/reserve", json=data, headers=headers)
+    allocated = client.post("/allocate", json=data, headers=headers)
+
+    assert reserved.status_code == 201
+    assert allocated.status_code == 422
+    assert "Reserve" in allocated.json()["message"]
+
+
+def test_allocations_can_be_batched_per_sku(
+    sqlite_file_session_factory: sessionmaker,
+) -> None:
+    bus = bootstrap.bootstrap(
+        start_orm=False, session_factory=sqlite_file_session_factory
+    )
+    app = create_app(bus, max_workers=2, allocate_batch_window=(0.001, 10))
+    sku, batch = random_sku(), random_batchref()
+    with TestClient(app) as client:
+        post_to_add_batch(client, batch, sku, 10, None)
+        data = {"orderid": random_orderid(), "sku": sku, "qty": 10}
+        r = client.post("/allocate", json=data)
+
+    assert r.status_code == 201
+    assert r.json()["batchref"] == batch
+
+
+def test_deallocate_frees_stock_for_other_orders(client: TestClient) -> None:
+    sku, batch = random_sku(), random_batchref()
+    post_to_add_batch(client, batch, sku, 10, None)
+    orderid = random_orderid()
+    client.post("/allocate", json={"orderid": orderid, "sku": sku, "qty": 10})
+
+    r = client.post("/deallocate", json={"orderid": orderid})
+    assert r.status_code == 200
+    r = client.post(
+        "/allocate", json={"orderid": random_orderid(), "sku": sku, "qty": 10}
+    )
+    assert r.json()["batchref"] == batch
+    r = client.post("/deallocate", json={"orderid": orderid})
+    assert r.status_code == 400
+    assert r.json()["message"] == f"Invalid orderid {orderid}"
+
+
+def test_bad_call_returns_400_and_error_message(client: TestClient) -> None:
+    unknown_sku, orderid = random_sku(), random_orderid()
+    data = {"orderid": orderid, "sku": unknown_sku, "qty": 20}
+    r = client.post("/allocate", json=data)
+    assert r.status_code == 400
+    assert r.json()["message"] == f"Invalid sku {unknown_sku}"
+
+
+def test_missing_keys_returns_400(client: TestClient) -> None:
+    r = client.post("/allocate", json={"orderid": random_orderid()})
+    assert r.status_code == 400
+    assert r.json()["message"] == "Missing the following input keys: 'sku'"
+
+
+def test_empty_request_returns_400(client: TestClient) -> None:
+    r = client.post("/add_batch")
+    assert r.status_code == 400
+
+
+def test_views_read_allocations_and_availability(
+    sqlite_file_session_factory: sessionmaker,
+) -> None:
+    bus = bootstrap.bootstrap(
+        start_orm=False, session_factory=sqlite_file_session_factory
+    )
+    app = create_app(
+        bus,
+        max_workers=2,
+        read_uow_factory=lambda: unit_of_work.ReadOnlyUnitOfWork(
+            sqlite_file_session_factory
+        ),
+    )
+    sku, batch, orderid = random_sku(), random_batchref(), random_orderid()
+    with TestClient(app) as client:
+        post_to_add_batch(client, batch, sku, 10, "2011-01-01")
+        client.post("/allocate", json={"orderid": orderid, "sku": sku, "qty": 3})
+
+        allocations = client.get(f"/allocations/{orderid}")
+        availability = client.get(f"/availability/{sku}")
+        unknown = client.get(f"/allocations/{random_orderid()}")
+
+    assert allocations.status_code == 200
+    assert allocations.json() == {"allocations": [{"sku": sku, "batchref": batch}]}
+    assert availability.json() == {
+        "batches": [
+            {"batchref": batch, "eta": "2011-01-01", "location": None, "available": 7}
+        ]
+    }
+    assert unknown.status_code == 404
+
+
+def test_product_supports_conditional_gets(
+    sqlite_file_session_factory: sessionmaker,
+) -> None:
+    bus = bootstrap.bootstrap(
+        start_orm=False, session_factory=sqlite_file_session_factory
+    )
+    app = create_app(
+        bus,
+        max_workers=2,
+        read_uow_factory=lambda: unit_of_work.ReadOnlyUnitOfWork(
+            sqlite_file_session_factory
+        ),
+    )
+    sku, batch = random_sku(), random_batchref()
+    with TestClient(app) as client:
+        post_to_add_batch(client, batch, sku, 10, None)
+        first = client.get(f"/products/{sku}")
+        etag = first.headers["ETag"]
+        unchanged = client.get(f"/products/{sku}", headers={"If-None-Match": etag})
+        client.post(
+            "/allocate", json={"orderid": random_orderid(), "sku": sku, "qty": 3}
+        )
+        changed = client.get(f"/products/{sku}", headers={"If-None-Match": etag})
+        missing = client.get(f"/products/{random_sku()}")
+
+    assert first.status_code == 200
+    assert first.json()["batches"][0]["available"] == 10
+    assert unchanged.status_code == 304
+    assert unchanged.headers["ETag"] == etag
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert changed.json()["batches"][0]["available"] == 7
+    assert missing.status_code == 404
+
+
+class FailingBus:
+    """Message bus whose units of work always fail."""
+
+    def __init__(self, error: Exception):
+        """Init function."""
+        self.error = error
+
+    def handle(self, message: message_bus.Message) -> List[Optional[str]]:
+        raise self.error
+
+    def close(self) -> None:
+        pass
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        StaleDataError("UPDATE statement on table 'products' expected 1 row"),
+        OperationalError("UPDATE", {}, sqlite3.OperationalError("database is locked")),
+    ],
+)
+def test_lost_races_return_409(error: Exception) -> None:
+    app = create_app(cast(message_bus.MessageBus, FailingBus(error)), max_workers=1)
+    data = {"orderid": random_orderid(), "sku": random_sku(), "qty": 3}
+    with TestClient(app) as client:
+        r = client.post("/allocate", json=data)
+
+    assert r.status_code == 409
+
+
+def test_other_database_errors_return_500() -> None:
+    error = OperationalError("SELECT", {}, sqlite3.OperationalError("no such table"))
+    app = create_app(cast(message_bus.MessageBus, FailingBus(error)), max_workers=1)
+    data = {"orderid": random_orderid(), "sku": random_sku(), "qty": 3}
+    with TestClient(app, raise_server_exceptions=False) as client:
+        r = client.post("/allocate", json=data)
+
+    assert r.status_code == 500
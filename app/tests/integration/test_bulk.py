@@ -0,0 +1,62 @@
+"""Tests for handling command files with worker processes."""
+from functools import partial
+from pathlib import Path
+from typing import Callable
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from app.adapters.orm import metadata
+from app.domain import commands
+from app.service_layer import bulk
+
+
+def sqlite_session_factory(path: Path) -> Callable[[], Session]:
+    engine = create_engine(f"sqlite:///{path}")
+    metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+def test_segments_partition_by_sku_up_to_barriers() -> None:
+    numbered = list(
+        enumerate(
+            [
+                commands.CreateBatch("b1", "LAMP", 10),
+                commands.Allocate("o1", "CHAIR", 1),
+                commands.ChangeBatchQuantity("b1", 5),
+                commands.Deallocate("o1"),
+                commands.Allocate("o2", "LAMP", 1),
+            ]
+        )
+    )
+
+    first, last = bulk.segments(numbered, {})
+
+    assert first == ([[numbered[0], numbered[2]], [numbered[1]]], numbered[3])
+    assert last == ([[numbered[4]]], None)
+
+
+def test_processes_commands_in_worker_processes(tmp_path: Path) -> None:
+    builder = partial(sqlite_session_factory, tmp_path / "bulk.db")
+    command_stream = [
+        commands.CreateBatch("b1", "LAMP", 10),
+        commands.CreateBatch("b2", "CHAIR", 10),
+        commands.Allocate("o1", "LAMP", 6),
+        commands.Allocate("o2", "CHAIR", 6),
+        commands.Allocate("o3", "LAMP", 6),
+        commands.Deallocate("o1"),
+        commands.Allocate("o4", "LAMP", 6),
+        commands.Allocate("o5", "UNKNOWN", 1),
+    ]
+
+    results = bulk.process_commands(command_stream, 2, builder)
+
+    assert [result.index for result in results] == list(range(8))
+    assert [result.results for result in results[2:7]] == [
+        ["b1"],
+        ["b2"],
+        [None],
+        [None],
+        ["b1"],
+    ]
+    assert results[7].error == "InvalidSku: Invalid sku UNKNOWN"
@@ -0,0 +1,24 @@
+"""Tests for storing dead letters in the database."""
+from typing import Callable
+
+from sqlalchemy.orm import Session
+
+from app.adapters.dead_letters import SqlAlchemyDeadLetterStore
+from app.domain import events
+
+
+def test_dead_letters_round_trip(session_factory: Callable[[], Session]) -> None:
+    store = SqlAlchemyDeadLetterStore(session_factory)
+    store.add("send_out_of_stock_notification", events.OutOfStock("LAMP"), "boom", 3)
+    store.add("send_out_of_stock_notification", events.OutOfStock("DESK"), "boom", 3)
+
+    first, second = store.list()
+    assert first.event == events.OutOfStock("LAMP")
+    assert first.handler == "send_out_of_stock_notification"
+
+    store.record_failure(first.id, "still broken")
+    [updated] = store.list([first.id])
+    assert (updated.error, updated.attempts) == ("still broken", 4)
+
+    store.remove(first.id)
+    assert store.list() == [second]
@@ -0,0 +1,22 @@
+"""Tests for sending notifications through a local debug SMTP server."""
+import pytest
+import requests
+
+import app.config as config
+from app.adapters.notifications import EmailNotifications
+from app.tests.random_refs import random_sku
+
+
+@pytest.mark.non_postgres_tests
+def test_out_of_stock_email_reaches_the_smtp_server() -> None:
+    host, port = config.get_email_host_and_port()
+    sku = random_sku()
+    EmailNotifications(host, port).send("stock@made.com", f"Out of stock for {sku}")
+
+    api_port = 18025 if host == "localhost" else 8025
+    messages = requests.get(
+        f"http://{host}:{api_port}/api/v2/search",
+        params={"kind": "containing", "query": sku},
+    ).json()
+    [message] = messages["items"]
+    assert message["Content"]["Headers"]["To"] == ["stock@made.com"]
@@ -0,0 +1,46 @@
+"""Tests for logging the events of the aggregates and replaying them."""
+from typing import Callable
+
+from sqlalchemy.orm import Session
+
+from app import bootstrap
+from app.adapters.event_log import SqlAlchemyEventLog
+from app.domain import commands, events
+from app.tests.unit.test_handlers import FakeNotifications, FakeRetryQueue
+
+
+def test_committed_events_are_logged_and_can_be_replayed(
+    session_factory: Callable[[], Session]
+) -> None:
+    notifications = FakeNotifications()
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        session_factory=session_factory,
+        notifications=notifications,
+        retry_queue=FakeRetryQueue(),
+    )
+    bus.handle(commands.CreateBatch("b1", "LAMP", 10, None))
+    bus.handle(commands.CreateBatch("b2", "DESK", 10, None))
+    for sku in ["LAMP", "DESK", "LAMP"]:
+        bus.handle(commands.Allocate(f"o-{sku}", sku, 20))
+    log = SqlAlchemyEventLog(session_factory)
+
+    assert [event for _, event in log.read(0, 10)] == [
+        events.OutOfStock("LAMP"),
+        events.OutOfStock("DESK"),
+        events.OutOfStock("LAMP"),
+    ]
+
+    notifications.sent.clear()
+    replayed = bus.replay_event_log(
+        log, ["send_out_of_stock_notification"], "rebuild", chunk_size=2, workers=2
+    )
+    assert replayed == 3
+    assert sorted(sum(notifications.sent.values(), [])) == [
+        "Out of stock for DESK",
+        "Out of stock for LAMP",
+        "Out of stock for LAMP",
+    ]
+
+    bus.handle(commands.Allocate("o-new", "DESK", 20))
+    assert bus.replay_event_log(log, ["send_out_of_stock_notification"], "rebuild") == 1
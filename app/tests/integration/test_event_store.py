@@ -0,0 +1,133 @@
+"""Tests for storing products as streams of their changes."""
+from datetime import date
+from typing import Callable
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app import bootstrap, views
+from app.domain import commands, model
+from app.service_layer import unit_of_work
+
+
+def event_sourced_uow(
+    session_factory: Callable[[], Session]
+) -> unit_of_work.EventSourcedUnitOfWork:
+    return unit_of_work.EventSourcedUnitOfWork(session_factory, snapshot_interval=3)
+
+
+def test_handlers_round_trip_through_the_event_stream(
+    session_factory: Callable[[], Session]
+) -> None:
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow_factory=lambda: event_sourced_uow(session_factory)
+    )
+    bus.handle(commands.CreateBatch("b1", "LAMP", 10, None))
+    bus.handle(commands.CreateBatch("b2", "LAMP", 10, date(2030, 1, 1), None, "PARIS"))
+    [batchref] = bus.handle(commands.Allocate("o1", "LAMP", 8))
+    bus.handle(commands.Allocate("o2", "LAMP", 5))
+    bus.handle(commands.ChangeBatchQuantity("b1", 6))
+
+    uow = event_sourced_uow(session_factory)
+    with uow:
+        product = uow.products.get("LAMP")
+        assert product is not None
+        assert batchref == "b1"
+        assert {
+            (b.reference, b.eta, b.location, b.available_quantity)
+            for b in product.batches
+        } == {("b1", None, None, 6), ("b2", date(2030, 1, 1), "PARIS", 5)}
+        assert uow.products.skus_by_batchref(["b2", "missing"]) == {"b2": "LAMP"}
+        assert [p.sku for p in uow.products.list_by_orderid("o2")] == ["LAMP"]
+        [[version]] = uow.session.execute(
+            "SELECT version FROM product_snapshots WHERE sku = 'LAMP'"
+        )
+        assert version == 6
+        assert product.version_number == 6
+
+
+def test_views_read_the_streams_in_the_events_persistence_mode(
+    session_factory: Callable[[], Session], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("PERSISTENCE", "events")
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow_factory=lambda: event_sourced_uow(session_factory)
+    )
+    bus.handle(commands.CreateBatch("b1", "LAMP", 10, None))
+    bus.handle(commands.CreateBatch("b2", "LAMP", 10, date(2030, 1, 1), None, "PARIS"))
+    bus.handle(commands.Allocate("o1", "LAMP", 10))
+    bus.handle(commands.Allocate("o2", "LAMP", 4))
+
+    read_uow = unit_of_work.ReadOnlyUnitOfWork(session_factory)
+    assert views.product_version("LAMP", read_uow) == 4
+    assert views.product_version("MISSING", read_uow) is None
+    assert views.product("MISSING", read_uow) is None
+    assert views.product("LAMP", read_uow) == {
+        "sku": "LAMP",
+        "version": 4,
+        "batches": [
+            {
+                "batchref": "b1",
+                "eta": None,
+                "location": None,
+                "purchased": 10,
+                "available": 0,
+            },
+            {
+                "batchref": "b2",
+                "eta": "2030-01-01",
+                "location": "PARIS",
+                "purchased": 10,
+                "available": 6,
+            },
+        ],
+    }
+    assert views.availability("LAMP", read_uow) == [
+        {"batchref": "b2", "eta": "2030-01-01", "location": "PARIS", "available": 6}
+    ]
+    assert views.allocations("o2", read_uow) == [{"sku": "LAMP", "batchref": "b2"}]
+
+
+def test_orders_allocated_by_confirming_their_holds_are_found_by_orderid(
+    session_factory: Callable[[], Session], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("PERSISTENCE", "events")
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow_factory=lambda: event_sourced_uow(session_factory)
+    )
+    bus.handle(commands.CreateBatch("b1", "LAMP", 10, None))
+    bus.handle(commands.Reserve("o1", "LAMP", 4))
+    bus.handle(commands.ConfirmReservation("o1", "LAMP"))
+
+    read_uow = unit_of_work.ReadOnlyUnitOfWork(session_factory)
+    assert views.allocations("o1", read_uow) == [{"sku": "LAMP", "batchref": "b1"}]
+
+    bus.handle(commands.Deallocate("o1", "LAMP"))
+
+    assert views.allocations("o1", read_uow) == []
+    assert views.availability("LAMP", read_uow)[0]["available"] == 10
+
+
+def test_concurrent_changes_conflict_on_the_stream_version(
+    session_factory: Callable[[], Session]
+) -> None:
+    uow = event_sourced_uow(session_factory)
+    with uow:
+        uow.products.add(model.Product("LAMP", []))
+        product = uow.products.get("LAMP")
+        assert product is not None
+        product.add_batch(model.Batch("b1", "LAMP", 10))
+        uow.commit()
+
+    first, second = event_sourced_uow(session_factory), event_sourced_uow(
+        session_factory
+    )
+    with first, second:
+        for uow in (first, second):
+            product = uow.products.get("LAMP")
+            assert product is not None
+            product.allocate(model.OrderLine("o1", "LAMP", 1))
+        first.commit()
+        with pytest.raises(IntegrityError):
+            second.commit()
@@ -0,0 +1,89 @@
+"""Tests for exporting the allocations."""
+import csv
+import json
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Callable
+
+from sqlalchemy.orm import Session
+
+from app import bootstrap
+from app.adapters import archive, export
+from app.domain import commands
+from app.tests.integration.test_archive import backdate_allocations
+
+
+def test_exports_allocations_to_chunked_files(
+    session_factory: Callable[[], Session], tmp_path: Path
+) -> None:
+    bus = bootstrap.bootstrap(start_orm=False, session_factory=session_factory)
+    bus.handle(commands.CreateBatch("b1", "LAMP", 100, date(2030, 1, 1)))
+    bus.handle(commands.CreateBatch("b2", "CHAIR", 100, None))
+    for i in range(5):
+        bus.handle(commands.Allocate(f"o{i}", "LAMP", i + 1))
+    bus.handle(commands.Allocate("o9", "CHAIR", 1))
+
+    session = session_factory()
+    rows = export.stream_rows(
+        session, export.allocations_query(skus=["LAMP"]), chunk_size=2
+    )
+    paths = export.export_allocations(rows, tmp_path / "lamps", rows_per_file=2)
+
+    assert [p.name for p in paths] == [
+        "lamps-0001.csv",
+        "lamps-0002.csv",
+        "lamps-0003.csv",
+    ]
+    exported = [row for p in paths for row in csv.DictReader(p.open())]
+    assert [(r["order_id"], r["qty"], r["batchref"]) for r in exported] == [
+        (f"o{i}", str(i + 1), "b1") for i in range(5)
+    ]
+    assert {r["eta"] for r in exported} == {"2030-01-01"}
+
+
+def test_exports_json_lines_filtered_by_allocation_time(
+    session_factory: Callable[[], Session], tmp_path: Path
+) -> None:
+    bus = bootstrap.bootstrap(start_orm=False, session_factory=session_factory)
+    bus.handle(commands.CreateBatch("b1", "LAMP", 100, None))
+    bus.handle(commands.Allocate("o1", "LAMP", 1))
+    tomorrow = datetime.utcnow() + timedelta(days=1)
+
+    session = session_factory()
+    [path] = export.export_allocations(
+        export.stream_rows(session, export.allocations_query()),
+        tmp_path / "all",
+        "jsonl",
+    )
+    [empty] = export.export_allocations(
+        export.stream_rows(session, export.allocations_query(since=tomorrow)),
+        tmp_path / "tomorrow",
+        "jsonl",
+    )
+
+    [line] = path.read_text().splitlines()
+    assert json.loads(line)["order_id"] == "o1"
+    assert empty.read_text() == ""
+
+
+def test_exports_the_allocations_of_archived_batches(
+    session_factory: Callable[[], Session], tmp_path: Path
+) -> None:
+    bus = bootstrap.bootstrap(start_orm=False, session_factory=session_factory)
+    bus.handle(commands.CreateBatch("b1", "LAMP", 5, None))
+    bus.handle(commands.Allocate("o1", "LAMP", 5))
+    session = session_factory()
+    backdate_allocations(session, days=100)
+    assert archive.archive_exhausted_batches(session_factory) == 1
+    bus.handle(commands.CreateBatch("b2", "LAMP", 5, None))
+    bus.handle(commands.Allocate("o2", "LAMP", 2))
+
+    [path] = export.export_allocations(
+        export.stream_rows(session, export.allocations_query(skus=["LAMP"])),
+        tmp_path / "lamps",
+    )
+
+    assert [(r["order_id"], r["batchref"]) for r in csv.DictReader(path.open())] == [
+        ("o1", "b1"),
+        ("o2", "b2"),
+    ]
@@ -57,6 +57,13 @@ def test_saving_batches(session: Session) -> None:
     assert list(rows) == [("batch1", "sku1", 100, None)]
 
 
+def test_saving_the_location_of_batches(session: Session) -> None:
+    session.add(model.Batch("batch1", "sku1", 100, eta=None, location="LONDON"))
+    session.commit()
+    rows = session.execute('SELECT reference, location FROM "batches"')
+    assert list(rows) == [("batch1", "LONDON")]
+
+
 def test_saving_allocations(session: Session) -> None:
     batch = model.Batch("batch1", "sku1", 100, eta=None)
     line = model.OrderLine("order1", "sku1", 10)
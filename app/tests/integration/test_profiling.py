@@ -0,0 +1,95 @@
+"""Tests for profiling the SQL of the units of work."""
+from typing import Callable, ContextManager
+
+from sqlalchemy.orm import Session
+
+from app import bootstrap
+from app.adapters import profiling
+from app.domain import commands
+from app.service_layer import unit_of_work
+
+MaxQueries = Callable[[int], ContextManager[profiling.QueryProfile]]
+
+
+def test_handlers_stay_within_their_query_budget(
+    session_factory: Callable[[], Session], max_queries: MaxQueries
+) -> None:
+    bus = bootstrap.bootstrap(start_orm=False, session_factory=session_factory)
+    bus.handle(commands.CreateBatch("batch1", "HIPSTER-WORKBENCH", 100, None))
+
+    with max_queries(6):
+        bus.handle(commands.Allocate("o1", "HIPSTER-WORKBENCH", 10))
+
+
+def test_allocate_does_not_load_the_lines_of_the_batch(
+    session_factory: Callable[[], Session], max_queries: MaxQueries
+) -> None:
+    bus = bootstrap.bootstrap(start_orm=False, session_factory=session_factory)
+    bus.handle(commands.CreateBatch("batch1", "HIPSTER-WORKBENCH", 1000, None))
+    for i in range(500):
+        bus.handle(commands.Allocate(f"o{i}", "HIPSTER-WORKBENCH", 1))
+
+    with max_queries(6) as profile:
+        bus.handle(commands.Allocate("o500", "HIPSTER-WORKBENCH", 1))
+
+    line_loads = [
+        record
+        for record in profile.statements
+        if "FROM order_lines" in record.statement
+    ]
+    assert line_loads == [], profile.report()
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        product = uow.products.get_for_allocation("HIPSTER-WORKBENCH")
+        assert product is not None
+        assert product.batches[0].available_quantity == 499
+
+
+def test_deallocate_loads_only_the_lines_of_the_order(
+    session_factory: Callable[[], Session], max_queries: MaxQueries
+) -> None:
+    bus = bootstrap.bootstrap(start_orm=False, session_factory=session_factory)
+    for i in range(20):
+        bus.handle(commands.CreateBatch(f"batch{i}", "HIPSTER-WORKBENCH", 5, None))
+    for i in range(100):
+        bus.handle(commands.Allocate(f"o{i}", "HIPSTER-WORKBENCH", 1))
+
+    with max_queries(4) as profile:
+        bus.handle(commands.Deallocate("o42"))
+
+    assert profile.repeated_statements() == {}
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        product = uow.products.get("HIPSTER-WORKBENCH")
+        assert product is not None
+        lines = [line for b in product.batches for line in b._allocations]
+        assert len(lines) == 99
+        assert "o42" not in {line.order_id for line in lines}
+
+
+def test_profiled_uow_reports_its_statements_by_command(
+    session_factory: Callable[[], Session]
+) -> None:
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow_factory=lambda: unit_of_work.SqlAlchemyUnitOfWork(
+            session_factory, profile=True
+        ),
+    )
+    profiling.recent_reports.clear()
+
+    bus.handle(commands.CreateBatch("batch1", "HIPSTER-WORKBENCH", 100, None))
+
+    [report] = profiling.recent_reports
+    assert report["label"] == "CreateBatch"
+    assert report["count"] == len(report["statements"]) > 0
+    assert all("rowcount" in statement for statement in report["statements"])
+
+
+def test_repeated_statements_are_flagged() -> None:
+    profile = profiling.QueryProfile("Allocate")
+    for _ in range(3):
+        profile.statements.append(
+            profiling.StatementRecord("SELECT * FROM order_lines", 0.001, 1)
+        )
+
+    assert profile.repeated_statements() == {"SELECT * FROM order_lines": 3}
+    assert "possible N+1, 3 times" in profile.report()
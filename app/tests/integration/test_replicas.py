@@ -0,0 +1,68 @@
+"""Tests for routing read-only sessions to the read replicas."""
+import threading
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+
+from app.adapters.replicas import ReplicaRouter
+
+
+def sqlite_engine(path: Path) -> Engine:
+    return create_engine(f"sqlite:///{path}")
+
+
+def test_replicas_are_picked_in_turn(tmp_path: Path) -> None:
+    first, second = sqlite_engine(tmp_path / "1.db"), sqlite_engine(tmp_path / "2.db")
+    router = ReplicaRouter([first, second], sqlite_engine(tmp_path / "primary.db"))
+
+    assert [router().get_bind() for _ in range(4)] == [first, second, first, second]
+
+
+def test_unhealthy_replicas_are_skipped_until_checked_again(tmp_path: Path) -> None:
+    healthy = sqlite_engine(tmp_path / "replica.db")
+    down = sqlite_engine(tmp_path / "missing" / "replica.db")
+    router = ReplicaRouter([down, healthy], healthy, check_interval=60)
+
+    assert [router.engine() for _ in range(3)] == [healthy] * 3
+    assert not router.is_healthy(down)
+
+    (tmp_path / "missing").mkdir()
+    assert not router.is_healthy(down)
+    router.check_interval = 0
+    assert router.is_healthy(down)
+
+
+def test_reads_fall_back_to_the_primary_without_healthy_replicas(
+    tmp_path: Path,
+) -> None:
+    primary = sqlite_engine(tmp_path / "primary.db")
+    router = ReplicaRouter([sqlite_engine(tmp_path / "missing" / "1.db")], primary)
+
+    assert router.engine() is primary
+    assert ReplicaRouter([], primary).engine() is primary
+
+
+def test_a_replica_is_checked_by_one_thread_at_a_time(tmp_path: Path) -> None:
+    replica = sqlite_engine(tmp_path / "replica.db")
+    checking, release = threading.Event(), threading.Event()
+    checks = []
+
+    class SlowRouter(ReplicaRouter):
+        def _check(self, engine: Engine) -> bool:
+            checks.append(engine)
+            checking.set()
+            release.wait(5)
+            return True
+
+    router = SlowRouter([replica], replica, check_interval=0)
+    thread = threading.Thread(target=router.is_healthy, args=(replica,))
+    thread.start()
+    assert checking.wait(5)
+
+    assert not router.is_healthy(replica)
+    release.set()
+    thread.join()
+    assert checks == [replica]
+    router.check_interval = 60
+    assert router.is_healthy(replica)
@@ -0,0 +1,88 @@
+"""Tests for holding stock with reservations that expire."""
+from datetime import datetime, timedelta
+from typing import Callable
+
+from sqlalchemy.orm import Session
+
+from app import bootstrap, views
+from app.adapters import reservations
+from app.domain import commands
+from app.service_layer import unit_of_work
+from app.tests.integration.test_event_store import event_sourced_uow
+
+
+def test_holds_are_stored_and_confirmed(session_factory: Callable[[], Session]) -> None:
+    bus = bootstrap.bootstrap(start_orm=False, session_factory=session_factory)
+    bus.handle(commands.CreateBatch("b1", "LAMP", 10))
+    bus.handle(commands.CreateBatch("b2", "LAMP", 10))
+
+    assert bus.handle(commands.Reserve("o1", "LAMP", 8)) == ["b1"]
+    assert bus.handle(commands.Allocate("o2", "LAMP", 5)) == ["b2"]
+    read_uow = unit_of_work.ReadOnlyUnitOfWork(session_factory)
+    assert [b["available"] for b in views.availability("LAMP", read_uow)] == [2, 5]
+
+    bus.handle(commands.ConfirmReservation("o1", "LAMP"))
+
+    assert views.allocations("o1", read_uow) == [{"sku": "LAMP", "batchref": "b1"}]
+    session = session_factory()
+    assert list(session.execute("SELECT * FROM reservations")) == []
+
+
+def test_allocations_use_the_stock_of_expired_holds_before_the_sweep(
+    session_factory: Callable[[], Session]
+) -> None:
+    bus = bootstrap.bootstrap(start_orm=False, session_factory=session_factory)
+    bus.handle(commands.CreateBatch("b1", "LAMP", 10))
+    bus.handle(commands.Reserve("o1", "LAMP", 8, ttl=0))
+
+    read_uow = unit_of_work.ReadOnlyUnitOfWork(session_factory)
+    assert views.availability("LAMP", read_uow)[0]["available"] == 10
+    assert bus.handle(commands.Allocate("o2", "LAMP", 10)) == ["b1"]
+    session = session_factory()
+    assert len(list(session.execute("SELECT * FROM reservations"))) == 1
+
+
+def test_sweeper_deletes_expired_holds_in_bulk(
+    session_factory: Callable[[], Session]
+) -> None:
+    bus = bootstrap.bootstrap(start_orm=False, session_factory=session_factory)
+    bus.handle(commands.CreateBatch("b1", "LAMP", 10))
+    bus.handle(commands.Reserve("o1", "LAMP", 3, ttl=0))
+    bus.handle(commands.Reserve("o2", "LAMP", 3, ttl=0))
+    bus.handle(commands.Reserve("o3", "LAMP", 3, ttl=3600))
+    version = views.product_version(
+        "LAMP", unit_of_work.ReadOnlyUnitOfWork(session_factory)
+    )
+    now = datetime.utcnow() + timedelta(seconds=1)
+
+    assert reservations.expire_reservations(session_factory, now, chunk_size=1) == 2
+    assert reservations.expire_reservations(session_factory, now) == 0
+
+    read_uow = unit_of_work.ReadOnlyUnitOfWork(session_factory)
+    assert views.availability("LAMP", read_uow)[0]["available"] == 7
+    assert views.product_version("LAMP", read_uow) == (version or 0) + 2
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        product = uow.products.get("LAMP")
+        assert product is not None
+        assert {r.order_id for r in product.batches[0]._reservations} == {"o3"}
+
+
+def test_holds_round_trip_through_the_event_stream(
+    session_factory: Callable[[], Session]
+) -> None:
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow_factory=lambda: event_sourced_uow(session_factory)
+    )
+    bus.handle(commands.CreateBatch("b1", "LAMP", 10))
+    bus.handle(commands.Reserve("o1", "LAMP", 4))
+    bus.handle(commands.Reserve("o2", "LAMP", 3))
+    bus.handle(commands.ConfirmReservation("o1", "LAMP"))
+
+    uow = event_sourced_uow(session_factory)
+    with uow:
+        product = uow.products.get("LAMP")
+        assert product is not None
+        [batch] = product.batches
+        assert batch.allocated_quantity == 4
+        assert [(r.order_id, r.qty) for r in batch._reservations] == [("o2", 3)]
@@ -0,0 +1,27 @@
+"""Tests for simulating allocations against the stock in the database."""
+from typing import Callable
+
+from sqlalchemy.orm import Session
+
+from app import bootstrap
+from app.domain import commands
+from app.service_layer import simulation, unit_of_work
+
+
+def test_simulates_against_the_available_stock(
+    session_factory: Callable[[], Session]
+) -> None:
+    bus = bootstrap.bootstrap(start_orm=False, session_factory=session_factory)
+    bus.handle(commands.CreateBatch("b1", "LAMP", 10, None))
+    bus.handle(commands.CreateBatch("b2", "LAMP", 10, None, None, "PARIS"))
+    bus.handle(commands.Allocate("o1", "LAMP", 8))
+
+    stock = simulation.load_stock(unit_of_work.ReadOnlyUnitOfWork(session_factory))
+    sim = simulation.Simulation(stock)
+
+    assert sim.allocate("LAMP", 3) == "b2"
+    assert sim.allocate("LAMP", 2) == "b1"
+    assert sim.allocate("LAMP", 8, "PARIS") is None
+    assert sim.reports["LAMP"].out_of_stock == 1
+    [[allocated]] = session_factory().execute("SELECT count(*) FROM allocations")
+    assert allocated == 1
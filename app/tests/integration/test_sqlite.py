@@ -0,0 +1,135 @@
+"""Tests for running the app on a sqlite database."""
+import threading
+import time
+from pathlib import Path
+from typing import Generator, List
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import clear_mappers, sessionmaker
+
+from app import bootstrap
+from app.adapters import orm, sqlite
+from app.domain import commands
+from app.service_layer import unit_of_work
+
+
+@pytest.fixture
+def writer_engine(tmp_path: Path) -> Generator[Engine, None, None]:
+    orm.start_mappers()
+    yield sqlite.create_writer_engine(str(tmp_path / "allocation.db"))
+    clear_mappers()
+
+
+def test_connections_use_wal_and_the_tuned_pragmas(tmp_path: Path) -> None:
+    engine = sqlite.create_writer_engine(
+        str(tmp_path / "allocation.db"), busy_timeout=2, cache_size_kib=1024
+    )
+
+    with engine.connect() as connection:
+        pragmas = {
+            name: connection.execute(text(f"PRAGMA {name}")).scalar()
+            for name in ["journal_mode", "synchronous", "cache_size", "busy_timeout"]
+        }
+
+    assert pragmas == {
+        "journal_mode": "wal",
+        "synchronous": 1,
+        "cache_size": -1024,
+        "busy_timeout": 2000,
+    }
+
+
+def test_reader_connections_can_not_write(tmp_path: Path) -> None:
+    path = str(tmp_path / "allocation.db")
+    sqlite.create_writer_engine(path)
+    reader = sqlite.create_reader_engine(path)
+
+    with reader.connect() as connection:
+        assert connection.execute(text("SELECT count(*) FROM batches")).scalar() == 0
+        with pytest.raises(OperationalError, match="readonly"):
+            connection.execute(text("DELETE FROM batches"))
+
+
+def test_concurrent_allocations_queue_for_the_write_lock(
+    writer_engine: Engine,
+) -> None:
+    bus = bootstrap.bootstrap(
+        start_orm=False, session_factory=sessionmaker(bind=writer_engine)
+    )
+    bus.handle(commands.CreateBatch("b1", "BUSY-LAMP", 100, None))
+    errors: List[Exception] = []
+
+    def allocate(thread: int) -> None:
+        for i in range(10):
+            try:
+                bus.handle(commands.Allocate(f"o{thread}-{i}", "BUSY-LAMP", 1))
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=allocate, args=(t,)) for t in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    with writer_engine.connect() as connection:
+        allocated = connection.execute(text("SELECT count(*) FROM allocations"))
+        assert allocated.scalar() == 80
+
+
+def test_waiting_too_long_for_the_write_lock_is_a_conflict(tmp_path: Path) -> None:
+    engine = sqlite.create_writer_engine(
+        str(tmp_path / "allocation.db"), busy_timeout=0.1
+    )
+
+    with engine.begin():
+        with pytest.raises(OperationalError) as error:
+            engine.begin().__enter__()
+
+    assert unit_of_work.is_conflict(error.value)
+    with engine.begin() as connection:
+        connection.execute(text("SELECT 1"))
+
+
+def test_writers_get_their_turn_in_order() -> None:
+    writers = sqlite.WriterQueue()
+    turns: List[int] = []
+
+    def write(i: int) -> None:
+        writers.acquire()
+        turns.append(i)
+        writers.release()
+
+    writers.acquire()
+    threads = []
+    for i in range(3):
+        threads.append(threading.Thread(target=write, args=(i,)))
+        threads[-1].start()
+        while len(writers._waiting) <= i:
+            time.sleep(0.001)
+    writers.release()
+    for thread in threads:
+        thread.join()
+
+    assert turns == [0, 1, 2]
+
+
+def test_default_session_factories_use_the_configured_sqlite_file(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    path = tmp_path / "edge.db"
+    monkeypatch.setenv("DATABASE", "sqlite")
+    monkeypatch.setenv("SQLITE_PATH", str(path))
+    monkeypatch.setattr(unit_of_work, "_default_session_factory", None)
+    monkeypatch.setattr(unit_of_work, "_default_read_session_factory", None)
+
+    writer = unit_of_work.default_session_factory().kw["bind"]
+    reader = unit_of_work.default_read_session_factory()().get_bind()
+
+    assert writer.url.database == reader.url.database == str(path)
+    with reader.connect() as connection:
+        assert connection.execute(text("PRAGMA query_only")).scalar() == 1
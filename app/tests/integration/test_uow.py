@@ -1,4 +1,5 @@
 """Tests for the unit of work."""
+import asyncio
 import threading
 import time
 import traceback
@@ -7,6 +8,7 @@ from typing import Callable, List, Optional, cast
 import pytest
 from sqlalchemy.orm import Session
 
+from app.adapters.repository import ProcessedCommand
 from app.domain import model
 from app.service_layer import unit_of_work
 from app.tests.random_refs import random_batchref, random_orderid, random_sku
@@ -65,6 +67,105 @@ def test_uow_can_retrieve_a_batch_and_allocate_to_it(
     assert batchref == "batch1"
 
 
+def test_uow_stores_processed_commands_with_the_allocation(
+    session_factory: Callable[[], Session]
+) -> None:
+    session = session_factory()
+    insert_batch(session, "batch1", "HIPSTER-WORKBENCH", 100, None)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        product = uow.products.get(sku="HIPSTER-WORKBENCH")
+        assert product is not None
+        batchref = product.allocate(model.OrderLine("o1", "HIPSTER-WORKBENCH", 10))
+        uow.processed_commands.add(ProcessedCommand("key-1", "Allocate", batchref))
+        uow.commit()
+
+    with uow:
+        processed = uow.processed_commands.get("key-1")
+        assert processed == ProcessedCommand("key-1", "Allocate", "batch1")
+        assert uow.processed_commands.get("key-2") is None
+
+
+def test_uow_can_find_and_deallocate_an_order(
+    session_factory: Callable[[], Session]
+) -> None:
+    session = session_factory()
+    insert_batch(session, "batch1", "HIPSTER-WORKBENCH", 100, None)
+    insert_batch(session, "batch2", "SHABBY-WORKBENCH", 100, None)
+    session.commit()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        for sku in ["HIPSTER-WORKBENCH", "SHABBY-WORKBENCH"]:
+            product = uow.products.get(sku=sku)
+            assert product is not None
+            product.allocate(model.OrderLine(f"o-{sku}", sku, 10))
+        uow.commit()
+
+    with uow:
+        [product] = uow.products.list_by_orderid("o-HIPSTER-WORKBENCH")
+        assert product.sku == "HIPSTER-WORKBENCH"
+        assert product.deallocate("o-HIPSTER-WORKBENCH") == ["batch1"]
+        uow.commit()
+
+    rows = list(session.execute('SELECT batch_id FROM "allocations"'))
+    assert len(rows) == 1
+
+
+def test_uow_loads_only_batches_with_stock_for_allocation(
+    session_factory: Callable[[], Session]
+) -> None:
+    session = session_factory()
+    insert_batch(session, "batch1", "HIPSTER-WORKBENCH", 10, None)
+    session.execute(
+        "INSERT INTO batches (reference, sku, _purchased_quantity, eta)"
+        " VALUES ('batch2', 'HIPSTER-WORKBENCH', 100, NULL)",
+    )
+    session.commit()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        product = uow.products.get(sku="HIPSTER-WORKBENCH")
+        assert product is not None
+        product.allocate(model.OrderLine("o1", "HIPSTER-WORKBENCH", 10))
+        product.allocate(model.OrderLine("o2", "HIPSTER-WORKBENCH", 10))
+        uow.commit()
+
+    with uow:
+        product = uow.products.get_for_allocation(sku="HIPSTER-WORKBENCH")
+        assert product is not None
+        [batch] = product.batches
+        assert batch.reference == "batch2"
+        assert batch.available_quantity == 90
+        assert batch.__dict__["_allocations"] == set()
+        assert product.allocate(model.OrderLine("o3", "HIPSTER-WORKBENCH", 5)) == (
+            "batch2"
+        )
+        assert batch.available_quantity == 85
+        full_product = uow.products.get(sku="HIPSTER-WORKBENCH")
+        assert full_product is product
+        assert len(product.batches) == 2
+        assert {line.order_id for line in batch._allocations} == {"o2", "o3"}
+        assert batch.available_quantity == 85
+        uow.commit()
+
+    assert get_allocated_batch_ref(session, "o3", "HIPSTER-WORKBENCH") == "batch2"
+
+
+def test_uow_looks_up_the_skus_of_batchrefs(
+    session_factory: Callable[[], Session]
+) -> None:
+    session = session_factory()
+    insert_batch(session, "batch1", "HIPSTER-WORKBENCH", 10, None)
+    insert_batch(session, "batch2", "SHABBY-WORKBENCH", 10, None)
+    session.commit()
+
+    with unit_of_work.SqlAlchemyUnitOfWork(session_factory) as uow:
+        skus = uow.products.skus_by_batchref(["batch1", "batch2", "batch3"])
+
+    assert skus == {"batch1": "HIPSTER-WORKBENCH", "batch2": "SHABBY-WORKBENCH"}
+
+
 def test_rolls_back_uncommitted_work_by_default(
     session_factory: Callable[[], Session]
 ) -> None:
@@ -151,3 +252,123 @@ def test_concurrent_updates_to_version_are_not_allowed(
     assert orders.rowcount == 1
     with unit_of_work.SqlAlchemyUnitOfWork() as uow:
         cast(unit_of_work.SqlAlchemyUnitOfWork, uow).session.execute("select 1")
+
+
+def test_shares_one_uow_between_threads_with_a_session_each(
+    session_factory: Callable[[], Session]
+) -> None:
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    entered = threading.Barrier(2)
+    sessions: List[Session] = []
+
+    def use_uow() -> None:
+        with uow:
+            entered.wait(timeout=5)
+            sessions.append(uow.session)
+
+    threads = [threading.Thread(target=use_uow) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(sessions) == 2
+    assert sessions[0] is not sessions[1]
+
+
+def test_shares_one_uow_between_tasks_with_a_session_each(
+    session_factory: Callable[[], Session]
+) -> None:
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+    async def use_uow() -> Session:
+        with uow:
+            session = uow.session
+            await asyncio.sleep(0)
+            assert uow.session is session
+            return session
+
+    async def main() -> List[Session]:
+        with uow:
+            return list(await asyncio.gather(use_uow(), use_uow()))
+
+    first, second = asyncio.run(main())
+
+    assert first is not second
+
+
+def test_nested_uow_commits_with_the_outer_transaction(
+    session_factory: Callable[[], Session]
+) -> None:
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        outer_session = uow.session
+        with uow:
+            assert uow.session is outer_session
+            insert_batch(uow.session, "batch1", "SMALL-TABLE", 10, None)
+            uow.commit()
+
+    rows = list(session_factory().execute("SELECT * FROM batches"))
+    assert rows == []
+
+
+def test_nested_uow_rolls_back_only_its_own_work(
+    session_factory: Callable[[], Session]
+) -> None:
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        insert_batch(uow.session, "batch1", "SMALL-TABLE", 10, None)
+        with uow:
+            insert_batch(uow.session, "batch2", "LARGE-TABLE", 10, None)
+        uow.commit()
+
+    rows = list(session_factory().execute("SELECT reference FROM batches"))
+    assert rows == [("batch1",)]
+
+
+def test_rolled_back_allocation_is_not_counted_by_the_loaded_batch(
+    session_factory: Callable[[], Session]
+) -> None:
+    session = session_factory()
+    insert_batch(session, "batch1", "SMALL-TABLE", 10, None)
+    session.commit()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        product = uow.products.get_for_allocation(sku="SMALL-TABLE")
+        assert product is not None
+        [batch] = product.batches
+        with uow:
+            product.allocate(model.OrderLine("o1", "SMALL-TABLE", 4))
+            uow.session.flush()
+            assert batch.available_quantity == 6
+
+        assert batch.available_quantity == 10
+
+
+def test_location_index_follows_the_batches_loaded_later(
+    session_factory: Callable[[], Session]
+) -> None:
+    session = session_factory()
+    insert_batch(session, "london", "SMALL-TABLE", 10, None)
+    session.execute(
+        "INSERT INTO batches (reference, sku, _purchased_quantity, eta, location)"
+        " VALUES ('paris', 'SMALL-TABLE', 1, NULL, 'PARIS')",
+    )
+    session.commit()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        product = uow.products.get(sku="SMALL-TABLE")
+        assert product is not None
+        product.allocate(model.OrderLine("o1", "SMALL-TABLE", 1), "PARIS")
+        uow.commit()
+
+    with uow:
+        product = uow.products.get_for_allocation(sku="SMALL-TABLE")
+        assert product is not None
+        assert product.allocate(model.OrderLine("o2", "SMALL-TABLE", 1)) == "london"
+        assert uow.products.get(sku="SMALL-TABLE") is product
+        product.deallocate("o1")
+
+        assert product.allocate(model.OrderLine("o3", "SMALL-TABLE", 1), "PARIS") == (
+            "paris"
+        )
@@ -55,3 +55,15 @@ def test_idempotent_allocation_to_batch() -> None:
     test_batch.allocate(test_order_line)
 
     assert test_batch.available_quantity == 18
+
+
+def test_allocated_quantity_from_the_database_is_kept_up_to_date() -> None:
+    test_batch, test_order_line = create_batch_and_line(
+        sku="SMALL-TABLE", batch_qty=20, line_qty=2
+    )
+    test_batch._allocated_quantity = 15
+
+    test_batch.allocate(test_order_line)
+    assert test_batch.available_quantity == 3
+    test_batch.deallocate(test_order_line)
+    assert test_batch.available_quantity == 5
@@ -0,0 +1,38 @@
+"""Tests for building the dependencies of the app."""
+from typing import List
+
+from sqlalchemy.orm import sessionmaker
+
+from app import bootstrap
+from app.domain import commands, events
+from app.service_layer import unit_of_work
+
+
+def test_bootstrap_uses_the_given_session_factory() -> None:
+    fake_session_factory = sessionmaker()
+    bus = bootstrap.bootstrap(False, session_factory=fake_session_factory)
+    uow = bus.uow_factory()
+
+    assert isinstance(uow, unit_of_work.SqlAlchemyUnitOfWork)
+    assert uow.session_factory is fake_session_factory
+
+
+def test_handlers_get_only_the_dependencies_they_ask_for() -> None:
+    calls: List[tuple] = []
+
+    def handler_with_uow(command: commands.Command, uow: str) -> None:
+        calls.append((command, uow))
+
+    def handler_with_notifications(event: events.Event, notifications: str) -> None:
+        calls.append((event, notifications))
+
+    dependencies = {"notifications": "fake-notifications"}
+    with_uow = bootstrap.inject_dependencies(handler_with_uow, dependencies)
+    with_notifications = bootstrap.inject_dependencies(
+        handler_with_notifications, dependencies
+    )
+    command, event = commands.Command(), events.Event()
+    with_uow(command, "fake-uow")  # type: ignore[arg-type]
+    with_notifications(event, "fake-uow")  # type: ignore[arg-type]
+
+    assert calls == [(command, "fake-uow"), (event, "fake-notifications")]
@@ -0,0 +1,25 @@
+"""Tests for the in-process response cache."""
+import time
+
+from app.adapters.cache import TTLCache
+
+
+def test_evicts_the_least_recently_used_entry() -> None:
+    cache: TTLCache[int] = TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert len(cache) == 2
+
+
+def test_entries_expire_after_their_ttl() -> None:
+    cache: TTLCache[int] = TTLCache(ttl=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+
+    assert cache.get("a") is None
+    assert len(cache) == 0
@@ -0,0 +1,45 @@
+"""Tests for the wire format of the commands and events."""
+from datetime import date
+
+import pytest
+
+from app.adapters import codec
+from app.domain import commands, events
+
+
+@pytest.mark.parametrize(
+    "message",
+    [
+        commands.Allocate("o1", "LAMP", 3, destination="PARIS"),
+        commands.CreateBatch("b1", "LAMP", 10, date(2030, 1, 1)),
+        commands.ChangeBatchQuantities({"b1": 5, "b2": 0}),
+        commands.Deallocate("o1"),
+        events.OutOfStock("LAMP"),
+        events.BatchAdded("LAMP", "b1", 10, date(2030, 1, 1), "PARIS"),
+    ],
+)
+def test_messages_round_trip(message: codec.Message) -> None:
+    name, payload = type(message).__name__, codec.encode_payload(message)
+
+    assert codec.decode(codec.encode(message)) == message
+    assert codec.decode_payload(name, payload) == message
+
+
+def test_encoding_is_compact() -> None:
+    encoded = codec.encode(commands.Allocate("o1", "LAMP", 3))
+
+    assert encoded == '{"orderid":"o1","sku":"LAMP","qty":3,"type":"Allocate"}'
+
+
+def test_decoding_validates_the_fields() -> None:
+    with pytest.raises(codec.MissingFieldError) as missing:
+        codec.from_dict(commands.Allocate, {"orderid": "o1", "qty": 3})
+    assert str(missing.value) == "'sku'"
+    with pytest.raises(codec.ValidationError, match="Invalid value '3' for qty"):
+        codec.from_dict(commands.Allocate, {"orderid": "o1", "sku": "LAMP", "qty": "3"})
+    with pytest.raises(codec.ValidationError, match="for eta"):
+        codec.decode('{"type":"CreateBatch","ref":"b","sku":"s","qty":1,"eta":"x"}')
+    with pytest.raises(codec.ValidationError, match="Unknown message type"):
+        codec.decode('{"type":"Unknown"}')
+    with pytest.raises(codec.ValidationError):
+        codec.from_dict(commands.Allocate, None)
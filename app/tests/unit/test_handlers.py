@@ -1,15 +1,27 @@
 """Functions for testing the service layer."""
+import sqlite3
+import threading
+from collections import defaultdict
 from datetime import date
-from typing import List, Optional, Set
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 import pytest
+from sqlalchemy.exc import IntegrityError
 
 import app.domain.model as model
 import app.service_layer.handlers as handlers
 import app.service_layer.unit_of_work as unit_of_work
-from app.adapters.repository import AbstractRepository
-from app.domain import commands
+from app import bootstrap
+from app.adapters.dead_letters import AbstractDeadLetterStore, DeadLetter
+from app.adapters.notifications import AbstractNotifications, DigestNotifications
+from app.adapters.repository import (
+    AbstractProcessedCommandRepository,
+    AbstractRepository,
+    ProcessedCommand,
+)
+from app.domain import commands, events
 from app.service_layer import message_bus
+from app.service_layer.retries import AbstractRetryQueue, DelayedRetryQueue
 
 
 class FakeRepository(AbstractRepository):
@@ -43,6 +55,27 @@ class FakeRepository(AbstractRepository):
         """
         return next((p for p in self._products if p.sku == sku), None)
 
+    def _list_by_orderid(
+        self, orderid: str, sku: Optional[str] = None
+    ) -> List[model.Product]:
+        """Get the products with allocations for an order.
+
+        Args:
+            orderid: id of the order
+            sku: only get the product of this sku, if given
+
+        Returns:
+            products
+        """
+        products = [p for p in self._products if sku in (None, p.sku)]
+        return [
+            p
+            for p in products
+            if any(
+                line.order_id == orderid for b in p.batches for line in b._allocations
+            )
+        ]
+
     def list(self) -> Set[model.Product]:
         """Get the set of products associated to a repo.
 
@@ -66,12 +99,41 @@ class FakeRepository(AbstractRepository):
         )
 
 
+class FakeProcessedCommandRepository(AbstractProcessedCommandRepository):
+    """Fake for the processed command repository."""
+
+    def __init__(self) -> None:
+        """Init function."""
+        self._processed: Dict[str, ProcessedCommand] = {}
+
+    def get(self, idempotency_key: str) -> Optional[ProcessedCommand]:
+        """Get a processed command by its key.
+
+        Args:
+            idempotency_key: key the command was sent with
+
+        Returns:
+            the processed command
+        """
+        return self._processed.get(idempotency_key)
+
+    def add(self, processed: ProcessedCommand) -> None:
+        """Store a processed command.
+
+        Args:
+            processed: the processed command
+        """
+        self._processed[processed.idempotency_key] = processed
+
+
 class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
     """Fake unit of work for testing."""
 
     def __init__(self) -> None:
         """Init function."""
+        super().__init__()
         self.products = FakeRepository([])
+        self.processed_commands = FakeProcessedCommandRepository()
         self.committed = False
 
     def _commit(self) -> None:
@@ -93,25 +155,138 @@ class FakeSession:
         self.committed = True
 
 
+class FakeNotifications(AbstractNotifications):
+    """Fake notifications that are kept in memory."""
+
+    def __init__(self) -> None:
+        """Init function."""
+        self.sent: Dict[str, List[str]] = defaultdict(list)
+
+    def send(self, destination: str, message: str) -> None:
+        """Keep the notification.
+
+        Args:
+            destination: who to notify
+            message: what to tell them
+        """
+        self.sent[destination].append(message)
+
+
+class FlakyNotifications(FakeNotifications):
+    """Fake notifications that fail a number of times before they work."""
+
+    def __init__(self, failures: int) -> None:
+        """Init function.
+
+        Args:
+            failures: number of sends that fail
+        """
+        super().__init__()
+        self.failures = failures
+
+    def send(self, destination: str, message: str) -> None:
+        """Fail, or keep the notification once all failures happened.
+
+        Args:
+            destination: who to notify
+            message: what to tell them
+        """
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("notification service is down")
+        super().send(destination, message)
+
+
+class FakeRetryQueue(AbstractRetryQueue):
+    """Fake retry queue that runs the scheduled actions when asked to."""
+
+    def __init__(self) -> None:
+        """Init function."""
+        self.scheduled: List[Tuple[float, Callable[[], None]]] = []
+
+    def schedule(self, delay: float, action: Callable[[], None]) -> None:
+        """Keep the action.
+
+        Args:
+            delay: seconds to wait
+            action: Callable to run
+        """
+        self.scheduled.append((delay, action))
+
+    def run_all(self) -> List[float]:
+        """Run the scheduled actions, including those scheduled while running.
+
+        Returns:
+            the delays of the actions that were run
+        """
+        delays = []
+        while self.scheduled:
+            delay, action = self.scheduled.pop(0)
+            delays.append(delay)
+            action()
+        return delays
+
+
+class FakeDeadLetterStore(AbstractDeadLetterStore):
+    """Fake dead letter store that is kept in memory."""
+
+    def __init__(self) -> None:
+        """Init function."""
+        self.letters: Dict[int, DeadLetter] = {}
+
+    def add(self, handler: str, event: events.Event, error: str, attempts: int) -> None:
+        """Keep a dead letter."""
+        id = len(self.letters) + 1
+        self.letters[id] = DeadLetter(id, handler, event, error, attempts)
+
+    def list(self, ids: Optional[List[int]] = None) -> List[DeadLetter]:
+        """Get the kept dead letters."""
+        return [
+            letter for id, letter in self.letters.items() if ids is None or id in ids
+        ]
+
+    def record_failure(self, id: int, error: str) -> None:
+        """Update a dead letter."""
+        letter = self.letters[id]
+        self.letters[id] = DeadLetter(
+            id, letter.handler, letter.event, error, letter.attempts + 1
+        )
+
+    def remove(self, id: int) -> None:
+        """Remove a dead letter."""
+        del self.letters[id]
+
+
+def bootstrap_test_app(
+    uow: FakeUnitOfWork,
+    notifications: Optional[FakeNotifications] = None,
+    retry_queue: Optional[FakeRetryQueue] = None,
+    dead_letters: Optional[FakeDeadLetterStore] = None,
+) -> message_bus.MessageBus:
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow_factory=lambda: uow,
+        notifications=notifications or FakeNotifications(),
+        retry_queue=retry_queue or FakeRetryQueue(),
+        dead_letters=dead_letters or FakeDeadLetterStore(),
+    )
+
+
 class TestBatch:
     """Group of tests related to handling batches."""
 
     def test_add_batch_for_new_product(self) -> None:
         uow = FakeUnitOfWork()
-        message_bus.handle(
-            commands.CreateBatch("b1", "CRUNCHY-ARMCHAIR", 100, None), uow
-        )
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("b1", "CRUNCHY-ARMCHAIR", 100, None))
         assert uow.products.get("CRUNCHY-ARMCHAIR") is not None
         assert uow.committed
 
     def test_add_batch_for_existing_product(self) -> None:
         uow = FakeUnitOfWork()
-        message_bus.handle(
-            commands.CreateBatch("b1", "CRUNCHY-ARMCHAIR", 100, None), uow
-        )
-        message_bus.handle(
-            commands.CreateBatch("b2", "CRUNCHY-ARMCHAIR", 99, None), uow
-        )
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("b1", "CRUNCHY-ARMCHAIR", 100, None))
+        bus.handle(commands.CreateBatch("b2", "CRUNCHY-ARMCHAIR", 99, None))
         product = uow.products.get("CRUNCHY-ARMCHAIR")
         if product:
             assert "b2" in [b.reference for b in product.batches]
@@ -124,54 +299,386 @@ class TestAllocate:
 
     def test_allocate_returns_allocation(self) -> None:
         uow = FakeUnitOfWork()
-        message_bus.handle(
-            commands.CreateBatch("batch1", "COMPLICATED-LAMP", 100, None), uow
-        )
-        result = message_bus.handle(
-            commands.Allocate("o1", "COMPLICATED-LAMP", 10), uow
-        )
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("batch1", "COMPLICATED-LAMP", 100, None))
+        result = bus.handle(commands.Allocate("o1", "COMPLICATED-LAMP", 10))
         assert result.pop(0) == "batch1"
 
     def test_allocate_errors_for_invalid_sku(self) -> None:
         uow = FakeUnitOfWork()
-        message_bus.handle(commands.CreateBatch("b1", "AREALSKU", 100, None), uow)
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("b1", "AREALSKU", 100, None))
 
         with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
-            message_bus.handle(commands.Allocate("o1", "NONEXISTENTSKU", 10), uow)
+            bus.handle(commands.Allocate("o1", "NONEXISTENTSKU", 10))
+
+    def test_allocate_prefers_the_destination(self) -> None:
+        uow = FakeUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        bus.handle(
+            commands.CreateBatch("b1", "FLAT-LAMP", 100, None, location="LONDON")
+        )
+        bus.handle(commands.CreateBatch("b2", "FLAT-LAMP", 100, None, location="PARIS"))
+        result = bus.handle(commands.Allocate("o1", "FLAT-LAMP", 10, None, "PARIS"))
+        assert result.pop(0) == "b2"
 
     def test_allocate_commits(self) -> None:
         uow = FakeUnitOfWork()
-        message_bus.handle(commands.CreateBatch("b1", "OMINOUS-MIRROR", 100, None), uow)
-        message_bus.handle(commands.Allocate("o1", "OMINOUS-MIRROR", 10), uow)
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("b1", "OMINOUS-MIRROR", 100, None))
+        bus.handle(commands.Allocate("o1", "OMINOUS-MIRROR", 10))
+        assert uow.committed
+
+
+class TestOutOfStock:
+    """Tests related to out of stock notifications."""
+
+    def test_sends_notification_when_allocation_fails(self) -> None:
+        uow, notifications = FakeUnitOfWork(), FakeNotifications()
+        bus = bootstrap_test_app(uow, notifications)
+        bus.handle(commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None))
+        bus.handle(commands.Allocate("o1", "POPULAR-CURTAINS", 10))
+        assert notifications.sent["stock@made.com"] == [
+            "Out of stock for POPULAR-CURTAINS"
+        ]
+
+    def test_closing_the_bus_sends_the_waiting_digests(self) -> None:
+        uow, sent = FakeUnitOfWork(), FakeNotifications()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow_factory=lambda: uow,
+            notifications=DigestNotifications(sent, window=60),
+            retry_queue=FakeRetryQueue(),
+            dead_letters=FakeDeadLetterStore(),
+        )
+        bus.handle(commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None))
+        bus.handle(commands.Allocate("o1", "POPULAR-CURTAINS", 10))
+        assert sent.sent == {}
+
+        bus.close()
+
+        assert sent.sent["stock@made.com"] == ["Out of stock for POPULAR-CURTAINS"]
+
+
+class TestEventRetries:
+    """Tests related to retrying failed event handlers."""
+
+    def test_failed_handler_is_retried_later_with_backoff(self) -> None:
+        uow, notifications = FakeUnitOfWork(), FlakyNotifications(failures=2)
+        retry_queue = FakeRetryQueue()
+        bus = bootstrap_test_app(uow, notifications, retry_queue)
+        bus.handle(commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None))
+
+        bus.handle(commands.Allocate("o1", "POPULAR-CURTAINS", 10))
+        assert notifications.sent == {}
+
+        assert retry_queue.run_all() == [2.0, 4.0]
+        assert notifications.sent["stock@made.com"] == [
+            "Out of stock for POPULAR-CURTAINS"
+        ]
+
+    def test_handler_out_of_attempts_becomes_a_dead_letter(self) -> None:
+        uow, notifications = FakeUnitOfWork(), FlakyNotifications(failures=5)
+        retry_queue, dead_letters = FakeRetryQueue(), FakeDeadLetterStore()
+        bus = bootstrap_test_app(uow, notifications, retry_queue, dead_letters)
+        bus.handle(commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None))
+        bus.handle(commands.Allocate("o1", "POPULAR-CURTAINS", 10))
+        retry_queue.run_all()
+
+        [letter] = dead_letters.list()
+        assert letter.handler == "send_out_of_stock_notification"
+        assert letter.event == events.OutOfStock("POPULAR-CURTAINS")
+        assert letter.attempts == 5
+
+    def test_dead_letters_can_be_replayed(self) -> None:
+        uow, notifications = FakeUnitOfWork(), FlakyNotifications(failures=6)
+        retry_queue, dead_letters = FakeRetryQueue(), FakeDeadLetterStore()
+        bus = bootstrap_test_app(uow, notifications, retry_queue, dead_letters)
+        bus.handle(commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None))
+        bus.handle(commands.Allocate("o1", "POPULAR-CURTAINS", 10))
+        retry_queue.run_all()
+
+        assert bus.replay_dead_letters() == 0
+        [letter] = dead_letters.list()
+        assert letter.attempts == 6
+
+        assert bus.replay_dead_letters([letter.id]) == 1
+        assert dead_letters.list() == []
+        assert notifications.sent["stock@made.com"] == [
+            "Out of stock for POPULAR-CURTAINS"
+        ]
+
+    def test_delayed_retry_queue_runs_actions_when_they_are_due(self) -> None:
+        retry_queue = DelayedRetryQueue()
+        done: List[str] = []
+        finished = threading.Event()
+
+        def later() -> None:
+            done.append("later")
+            finished.set()
+
+        retry_queue.schedule(0.02, later)
+        retry_queue.schedule(0, lambda: done.append("now"))
+
+        assert finished.wait(timeout=1)
+        retry_queue.close()
+        assert done == ["now", "later"]
+
+
+class TestIdempotency:
+    """Tests related to replaying commands with an idempotency key."""
+
+    def test_replayed_allocation_returns_original_batchref(self) -> None:
+        uow = FakeUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("batch1", "NOISY-TRUMPET", 100, None))
+        allocate = commands.Allocate("o1", "NOISY-TRUMPET", 10, "key-1")
+        [first] = bus.handle(allocate)
+        [replayed] = bus.handle(allocate)
+        assert first == replayed == "batch1"
+
+    def test_replayed_allocation_does_not_allocate_again(self) -> None:
+        uow = FakeUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("batch1", "NOISY-TRUMPET", 100, None))
+        bus.handle(commands.Allocate("o1", "NOISY-TRUMPET", 10, "key-1"))
+        bus.handle(commands.Allocate("o2", "NOISY-TRUMPET", 10, "key-1"))
+        assert (product := uow.products.get(sku="NOISY-TRUMPET")) is not None
+        [batch] = product.batches
+        assert batch.available_quantity == 90
+
+    def test_replayed_create_batch_does_not_add_a_batch(self) -> None:
+        uow = FakeUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        create = commands.CreateBatch("batch1", "NOISY-TRUMPET", 100, None, "key-1")
+        bus.handle(create)
+        bus.handle(create)
+        assert (product := uow.products.get(sku="NOISY-TRUMPET")) is not None
+        assert len(product.batches) == 1
+
+    def test_allocation_losing_the_race_for_its_key_returns_the_winner(
+        self,
+    ) -> None:
+        uow = FakeUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("batch1", "NOISY-TRUMPET", 100, None))
+        winner = ProcessedCommand("key-1", "Allocate", "batch0")
+        uow.processed_commands = RacingProcessedCommandRepository(winner)
+
+        [batchref] = bus.handle(commands.Allocate("o1", "NOISY-TRUMPET", 10, "key-1"))
+
+        assert batchref == "batch0"
+
+    def test_key_of_another_type_of_command_is_rejected(self) -> None:
+        uow = FakeUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("batch1", "NOISY-TRUMPET", 100, None, "key-1"))
+
+        with pytest.raises(handlers.IdempotencyKeyReused, match="CreateBatch"):
+            bus.handle(commands.Allocate("o1", "NOISY-TRUMPET", 10, "key-1"))
+
+
+class RacingProcessedCommandRepository(FakeProcessedCommandRepository):
+    """Fake processed commands where a concurrent command stores a key first."""
+
+    def __init__(self, winner: ProcessedCommand) -> None:
+        """Init function.
+
+        Args:
+            winner: command stored by the concurrent transaction
+        """
+        super().__init__()
+        self.winner = winner
+
+    def add(self, processed: ProcessedCommand) -> None:
+        """Fail on the unique key when the concurrent command stored it first.
+
+        Args:
+            processed: the processed command
+        """
+        if processed.idempotency_key == self.winner.idempotency_key:
+            super().add(self.winner)
+            raise IntegrityError(
+                "INSERT INTO processed_commands",
+                {},
+                sqlite3.IntegrityError(
+                    "UNIQUE constraint failed: processed_commands.idempotency_key"
+                ),
+            )
+        super().add(processed)
+
+
+class CommitCountingUnitOfWork(FakeUnitOfWork):
+    """Fake unit of work that counts its commits."""
+
+    def __init__(self) -> None:
+        """Init function."""
+        super().__init__()
+        self.commits = 0
+
+    def _commit(self) -> None:
+        """How to commit."""
+        super()._commit()
+        self.commits += 1
+
+
+class TestAllocateBatcher:
+    """Tests related to micro-batching allocations."""
+
+    def test_window_is_allocated_in_one_transaction(self) -> None:
+        uow = CommitCountingUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("b1", "SOFT-PILLOW", 15, None))
+        bus.handle(commands.CreateBatch("b2", "SOFT-PILLOW", 15, date.today()))
+        batcher = message_bus.AllocateBatcher(
+            bus, max_batch_size=3, max_wait=10, workers=1
+        )
+        futures = [
+            batcher.submit(commands.Allocate(f"o{i}", "SOFT-PILLOW", 10))
+            for i in range(3)
+        ]
+        batcher.close()
+
+        assert [f.result() for f in futures] == ["b1", "b2", None]
+        assert uow.commits == 3
+
+    def test_windows_are_grouped_by_sku(self) -> None:
+        uow = CommitCountingUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("b1", "SOFT-PILLOW", 100, None))
+        bus.handle(commands.CreateBatch("b2", "HARD-PILLOW", 100, None))
+        batcher = message_bus.AllocateBatcher(
+            bus, max_batch_size=4, max_wait=10, workers=1
+        )
+        futures = [
+            batcher.submit(commands.Allocate(f"o{i}", sku, 10))
+            for i, sku in enumerate(["SOFT-PILLOW", "HARD-PILLOW"] * 2)
+        ]
+        batcher.close()
+
+        assert [f.result() for f in futures] == ["b1", "b2", "b1", "b2"]
+        assert uow.commits == 4
+
+    def test_errors_are_set_on_the_futures_of_the_group(self) -> None:
+        uow = FakeUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        batcher = message_bus.AllocateBatcher(bus, workers=1)
+        future = batcher.submit(commands.Allocate("o1", "NONEXISTENTSKU", 10))
+        batcher.close()
+
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            future.result()
+
+
+class TestDeallocate:
+    """Tests related to cancelling orders."""
+
+    def test_deallocates_order_for_every_sku(self) -> None:
+        uow = FakeUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("b1", "DUSTY-RUG", 100, None))
+        bus.handle(commands.CreateBatch("b2", "SHINY-RUG", 100, None))
+        bus.handle(commands.Allocate("o1", "DUSTY-RUG", 10))
+        bus.handle(commands.Allocate("o1", "SHINY-RUG", 10))
+        bus.handle(commands.Allocate("o2", "SHINY-RUG", 10))
+
+        bus.handle(commands.Deallocate("o1"))
+
+        assert (dusty := uow.products.get(sku="DUSTY-RUG")) is not None
+        assert (shiny := uow.products.get(sku="SHINY-RUG")) is not None
+        assert dusty.batches[0].available_quantity == 100
+        assert shiny.batches[0].available_quantity == 90
         assert uow.committed
 
+    def test_deallocates_only_the_given_sku(self) -> None:
+        uow = FakeUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("b1", "DUSTY-RUG", 100, None))
+        bus.handle(commands.CreateBatch("b2", "SHINY-RUG", 100, None))
+        bus.handle(commands.Allocate("o1", "DUSTY-RUG", 10))
+        bus.handle(commands.Allocate("o1", "SHINY-RUG", 10))
+
+        bus.handle(commands.Deallocate("o1", "SHINY-RUG"))
+
+        assert (dusty := uow.products.get(sku="DUSTY-RUG")) is not None
+        assert dusty.batches[0].available_quantity == 90
+
+    def test_raises_invalid_orderid(self) -> None:
+        uow = FakeUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("b1", "DUSTY-RUG", 100, None))
+        with pytest.raises(handlers.InvalidOrderId, match="Invalid orderid o1"):
+            bus.handle(commands.Deallocate("o1"))
+
+
+class TestReservations:
+    """Tests related to holding stock until checkout."""
+
+    def test_reserve_holds_stock_until_confirmed(self) -> None:
+        uow = FakeUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("b1", "RETRO-CLOCK", 10, None))
+
+        [batchref] = bus.handle(commands.Reserve("o1", "RETRO-CLOCK", 8, ttl=60))
+        [allocated] = bus.handle(commands.Allocate("o2", "RETRO-CLOCK", 5))
+        bus.handle(commands.ConfirmReservation("o1", "RETRO-CLOCK"))
+
+        assert batchref == "b1"
+        assert allocated is None
+        assert (product := uow.products.get(sku="RETRO-CLOCK")) is not None
+        assert product.batches[0].allocated_quantity == 8
+        assert product.batches[0].reserved_quantity == 0
+
+    def test_expired_holds_are_not_confirmed(self) -> None:
+        uow = FakeUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("b1", "RETRO-CLOCK", 10, None))
+        bus.handle(commands.Reserve("o1", "RETRO-CLOCK", 8, ttl=0))
+
+        with pytest.raises(
+            handlers.InvalidOrderId, match="No reservation for order o1"
+        ):
+            bus.handle(commands.ConfirmReservation("o1", "RETRO-CLOCK"))
+
+    def test_release_gives_back_the_stock(self) -> None:
+        uow = FakeUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("b1", "RETRO-CLOCK", 10, None))
+        bus.handle(commands.Reserve("o1", "RETRO-CLOCK", 8))
+
+        bus.handle(commands.ReleaseReservation("o1", "RETRO-CLOCK"))
+
+        assert (product := uow.products.get(sku="RETRO-CLOCK")) is not None
+        assert product.batches[0].available_quantity == 10
+        with pytest.raises(handlers.InvalidOrderId):
+            bus.handle(commands.ReleaseReservation("o1", "RETRO-CLOCK"))
+
 
 class TestChangeBatchQuantity:
     """Tests related to handling change batch quantity commands."""
 
     def test_changes_available_quantity(self) -> None:
         uow = FakeUnitOfWork()
-        message_bus.handle(
-            commands.CreateBatch("batch1", "ADORABLE-SETTEE", 100, None), uow
-        )
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("batch1", "ADORABLE-SETTEE", 100, None))
         assert (test_product := uow.products.get(sku="ADORABLE-SETTEE")) is not None
         [batch] = test_product.batches
         assert batch.available_quantity == 100
 
-        message_bus.handle(commands.ChangeBatchQuantity("batch1", 50), uow)
+        bus.handle(commands.ChangeBatchQuantity("batch1", 50))
 
         assert batch.available_quantity == 50
 
     def test_raises_invalid_batchref(self) -> None:
         uow = FakeUnitOfWork()
-        message_bus.handle(
-            commands.CreateBatch("batch1", "ADORABLE-SETTEE", 100, None), uow
-        )
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("batch1", "ADORABLE-SETTEE", 100, None))
         with pytest.raises(handlers.InvalidBatchRef, match="Invalid batchref batch2"):
-            message_bus.handle(commands.ChangeBatchQuantity("batch2", 10), uow)
+            bus.handle(commands.ChangeBatchQuantity("batch2", 10))
 
     def test_reallocates_if_necessary(self) -> None:
         uow = FakeUnitOfWork()
+        bus = bootstrap_test_app(uow)
         event_history = [
             commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None),
             commands.CreateBatch("batch2", "INDIFFERENT-TABLE", 50, date.today()),
@@ -179,15 +686,79 @@ class TestChangeBatchQuantity:
             commands.Allocate("order2", "INDIFFERENT-TABLE", 20),
         ]
         for e in event_history:
-            message_bus.handle(e, uow)
+            bus.handle(e)
         assert (test_product := uow.products.get(sku="INDIFFERENT-TABLE")) is not None
         [batch1, batch2] = test_product.batches
         assert batch1.available_quantity == 10
         assert batch2.available_quantity == 50
 
-        message_bus.handle(commands.ChangeBatchQuantity("batch1", 25), uow)
+        bus.handle(commands.ChangeBatchQuantity("batch1", 25))
 
         # order1 or order2 will be deallocated, so we'll have 25 - 20
         assert batch1.available_quantity == 5
         # and 20 will be reallocated to the next batch
         assert batch2.available_quantity == 30
+
+    def test_reallocates_in_the_same_transaction(self) -> None:
+        uow = CommitCountingUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None))
+        bus.handle(commands.CreateBatch("batch2", "INDIFFERENT-TABLE", 50, None))
+        bus.handle(commands.Allocate("order1", "INDIFFERENT-TABLE", 20))
+        bus.handle(commands.Allocate("order2", "INDIFFERENT-TABLE", 20))
+        commits = uow.commits
+
+        results = bus.handle(commands.ChangeBatchQuantity("batch1", 10))
+
+        assert results == [None, "batch2", "batch2"]
+        assert uow.commits == commits + 1
+
+
+class TestChangeBatchQuantities:
+    """Tests related to handling bulk change batch quantity commands."""
+
+    def test_commits_once_per_product(self) -> None:
+        uow = CommitCountingUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("batch1", "ADORABLE-SETTEE", 100, None))
+        bus.handle(commands.CreateBatch("batch2", "ADORABLE-SETTEE", 100, None))
+        bus.handle(commands.CreateBatch("batch3", "FRIENDLY-SOFA", 100, None))
+        commits = uow.commits
+
+        bus.handle(
+            commands.ChangeBatchQuantities({"batch1": 10, "batch2": 20, "batch3": 30})
+        )
+
+        assert uow.commits == commits + 2
+        quantities = {
+            b.reference: b.available_quantity
+            for sku in ["ADORABLE-SETTEE", "FRIENDLY-SOFA"]
+            for b in getattr(uow.products.get(sku=sku), "batches", [])
+        }
+        assert quantities == {"batch1": 10, "batch2": 20, "batch3": 30}
+
+    def test_reallocates_in_the_same_transaction(self) -> None:
+        uow = CommitCountingUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None))
+        bus.handle(commands.CreateBatch("batch2", "INDIFFERENT-TABLE", 50, None))
+        bus.handle(commands.Allocate("order1", "INDIFFERENT-TABLE", 20))
+        commits = uow.commits
+
+        results = bus.handle(commands.ChangeBatchQuantities({"batch1": 10}))
+
+        assert results == [None]
+        assert uow.commits == commits + 1
+        assert (test_product := uow.products.get(sku="INDIFFERENT-TABLE")) is not None
+        [batch1, batch2] = test_product.batches
+        assert batch1.available_quantity == 10
+        assert batch2.available_quantity == 30
+
+    def test_raises_invalid_batchref_before_changing_anything(self) -> None:
+        uow = FakeUnitOfWork()
+        bus = bootstrap_test_app(uow)
+        bus.handle(commands.CreateBatch("batch1", "ADORABLE-SETTEE", 100, None))
+        with pytest.raises(handlers.InvalidBatchRef, match="Invalid batchref batch2"):
+            bus.handle(commands.ChangeBatchQuantities({"batch1": 10, "batch2": 10}))
+        assert (test_product := uow.products.get(sku="ADORABLE-SETTEE")) is not None
+        assert test_product.batches[0].available_quantity == 100
@@ -0,0 +1,132 @@
+"""Tests for the notification adapters."""
+from pathlib import Path
+from typing import Iterable, List, Tuple
+
+import pytest
+
+from app import bootstrap
+from app.adapters.notifications import (
+    AbstractNotifications,
+    DigestNotifications,
+    FileNotifications,
+)
+
+
+class RecordingNotifications(AbstractNotifications):
+    """Fake notifications that record the batches they were sent in."""
+
+    def __init__(self, fail: bool = False) -> None:
+        """Init function.
+
+        Args:
+            fail: whether sending should fail
+        """
+        self.fail = fail
+        self.batches: List[List[Tuple[str, str]]] = []
+
+    def send(self, destination: str, message: str) -> None:
+        """Record a single notification."""
+        self.send_many([(destination, message)])
+
+    def send_many(self, notifications: Iterable[Tuple[str, str]]) -> None:
+        """Record a batch of notifications."""
+        if self.fail:
+            raise ConnectionError("smtp server is down")
+        self.batches.append(list(notifications))
+
+
+def test_digest_coalesces_repeated_messages_per_destination() -> None:
+    sent = RecordingNotifications()
+    notifications = DigestNotifications(sent, window=60)
+    for _ in range(1000):
+        notifications.send("stock@made.com", "Out of stock for LAMP")
+    notifications.send("stock@made.com", "Out of stock for DESK")
+    notifications.send("buyer@made.com", "Out of stock for DESK")
+
+    notifications.close()
+
+    assert sent.batches == [
+        [
+            ("stock@made.com", "Out of stock for DESK\nOut of stock for LAMP (x1000)"),
+            ("buyer@made.com", "Out of stock for DESK"),
+        ]
+    ]
+
+
+def test_digest_is_sent_once_the_window_passed() -> None:
+    sent = RecordingNotifications()
+    notifications = DigestNotifications(sent, window=0.01)
+    notifications.send("stock@made.com", "Out of stock for LAMP")
+
+    assert notifications._timer is not None
+    notifications._timer.join(timeout=1)
+
+    assert sent.batches == [[("stock@made.com", "Out of stock for LAMP")]]
+
+
+def test_failed_digest_is_kept_for_the_next_window() -> None:
+    sent = RecordingNotifications(fail=True)
+    notifications = DigestNotifications(sent, window=60)
+    notifications.send("stock@made.com", "Out of stock for LAMP")
+    notifications.flush()
+    notifications.send("stock@made.com", "Out of stock for LAMP")
+
+    sent.fail = False
+    notifications.close()
+
+    assert sent.batches == [[("stock@made.com", "Out of stock for LAMP (x2)")]]
+
+
+class UnreachableNotifications(AbstractNotifications):
+    """Fake notifications that can not reach some destinations."""
+
+    def __init__(self, unreachable: List[str]) -> None:
+        """Init function.
+
+        Args:
+            unreachable: destinations that sending to fails
+        """
+        self.unreachable = unreachable
+        self.sent: List[Tuple[str, str]] = []
+
+    def send(self, destination: str, message: str) -> None:
+        """Record a single notification, unless its destination is unreachable."""
+        if destination in self.unreachable:
+            raise ConnectionError(f"{destination} is unreachable")
+        self.sent.append((destination, message))
+
+
+def test_only_the_digests_that_were_not_sent_are_kept() -> None:
+    sent = UnreachableNotifications(unreachable=["buyer@made.com"])
+    notifications = DigestNotifications(sent, window=60)
+    notifications.send("stock@made.com", "Out of stock for LAMP")
+    notifications.send("buyer@made.com", "Out of stock for DESK")
+    notifications.send("sales@made.com", "Out of stock for SOFA")
+    notifications.flush()
+
+    sent.unreachable = []
+    notifications.close()
+
+    assert sent.sent == [
+        ("stock@made.com", "Out of stock for LAMP"),
+        ("buyer@made.com", "Out of stock for DESK"),
+        ("sales@made.com", "Out of stock for SOFA"),
+    ]
+
+
+def test_file_notifications_append_a_line_each(tmp_path: Path) -> None:
+    path = tmp_path / "notifications.log"
+    notifications = FileNotifications(path)
+    notifications.send("stock@made.com", "Out of stock for LAMP")
+    notifications.send_many([("stock@made.com", "first line\nsecond line")])
+
+    assert path.read_text().splitlines() == [
+        "stock@made.com\tOut of stock for LAMP",
+        "stock@made.com\tfirst line | second line",
+    ]
+
+
+def test_unknown_backend_is_rejected(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("NOTIFICATIONS", "carrier-pigeon")
+    with pytest.raises(ValueError, match="Unknown notifications backend"):
+        bootstrap.default_notifications()
@@ -1,8 +1,8 @@
 """Tests for development."""
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
 
-from app.domain import events
-from app.domain.model import Batch, OrderLine, Product
+from app.domain import commands, events
+from app.domain.model import Batch, OrderLine, Product, Reservation
 
 
 def test_prefers_earlier_batches() -> None:
@@ -31,6 +31,45 @@ def test_allocate_returns_allocated_batch_ref() -> None:
     assert batch_ref == test_batch_yesterday.reference
 
 
+def test_prefers_batches_at_the_destination() -> None:
+    in_london = Batch("london", "CLOCK", 5, eta=None, location="LONDON")
+    shipping_to_paris = Batch(
+        "paris", "CLOCK", 5, eta=date.today() + timedelta(days=7), location="PARIS"
+    )
+    product = Product("CLOCK", [in_london, shipping_to_paris])
+
+    assert product.allocate(OrderLine("o1", "CLOCK", 2), "PARIS") == "paris"
+    assert product.allocate(OrderLine("o2", "CLOCK", 2)) == "london"
+
+
+def test_falls_back_to_other_locations_in_eta_order() -> None:
+    tomorrow = date.today() + timedelta(days=1)
+    in_paris = Batch("paris", "CLOCK", 1, eta=None, location="PARIS")
+    in_berlin = Batch("berlin", "CLOCK", 5, eta=tomorrow, location="BERLIN")
+    in_london = Batch("london", "CLOCK", 5, eta=None, location="LONDON")
+    product = Product("CLOCK", [in_paris, in_berlin, in_london])
+
+    assert product.allocate(OrderLine("o1", "CLOCK", 2), "PARIS") == "london"
+
+
+def test_location_index_includes_batches_added_later() -> None:
+    product = Product("CLOCK", [Batch("london", "CLOCK", 1, location="LONDON")])
+    product.allocate(OrderLine("o1", "CLOCK", 1), "PARIS")
+    product.add_batch(Batch("paris", "CLOCK", 5, location="PARIS"))
+
+    assert product.allocate(OrderLine("o2", "CLOCK", 1), "PARIS") == "paris"
+
+
+def test_reallocations_prefer_the_location_of_the_changed_batch() -> None:
+    batch = Batch("paris", "CLOCK", 10, location="PARIS")
+    product = Product("CLOCK", [batch])
+    product.allocate(OrderLine("o1", "CLOCK", 10))
+
+    product.change_batch_quantity("paris", 5)
+
+    assert product.events == [commands.Allocate("o1", "CLOCK", 10, destination="PARIS")]
+
+
 def test_records_out_of_stock_event_if_cannot_allocate() -> None:
     batch = Batch("batch1", "SMALL-FORK", 10, eta=date.today())
     product = Product(sku="SMALL-FORK", batches=[batch])
@@ -61,3 +100,175 @@ def test_increments_version_number() -> None:
     product.version_number = 7
     product.allocate(line)
     assert product.version_number == 8
+
+
+def test_allocating_a_line_twice_records_one_change() -> None:
+    line = OrderLine("oref", "SCANDI-PEN", 10)
+    product = Product(
+        sku="SCANDI-PEN", batches=[Batch("b1", "SCANDI-PEN", 100, eta=None)]
+    )
+
+    assert product.allocate(line) == "b1"
+    assert product.allocate(line) == "b1"
+
+    assert [type(change) for change in product.changes] == [events.Allocated]
+    assert product.batches[0].available_quantity == 90
+
+
+def test_deallocate_frees_the_lines_of_an_order() -> None:
+    batch = Batch("b1", "SMALL-SOFA", 20, eta=None)
+    product = Product("SMALL-SOFA", [batch])
+    product.allocate(OrderLine("order1", "SMALL-SOFA", 5))
+    product.allocate(OrderLine("order2", "SMALL-SOFA", 5))
+
+    assert product.deallocate("order1") == ["b1"]
+    assert batch.available_quantity == 15
+    assert product.deallocate("order1") == []
+
+
+def test_deallocate_finds_lines_allocated_before_the_index_was_built() -> None:
+    batch = Batch("b1", "SMALL-SOFA", 20, eta=None)
+    batch.allocate(OrderLine("order1", "SMALL-SOFA", 5))
+    product = Product("SMALL-SOFA", [batch], version_number=3)
+
+    assert product.deallocate("order1") == ["b1"]
+    assert batch.available_quantity == 20
+    assert product.version_number == 4
+
+
+def test_order_index_follows_reallocations() -> None:
+    batch1 = Batch("b1", "SMALL-SOFA", 10, eta=None)
+    batch2 = Batch("b2", "SMALL-SOFA", 10, eta=date.today())
+    product = Product("SMALL-SOFA", [batch1, batch2])
+    product.allocate(OrderLine("order1", "SMALL-SOFA", 10))
+    product.deallocate("unknown")  # builds the index
+
+    product.change_batch_quantity("b1", 5)
+    reallocate = product.events.pop()
+    assert isinstance(reallocate, commands.Allocate)
+    product.allocate(OrderLine(reallocate.orderid, "SMALL-SOFA", 10))
+
+    assert product.deallocate("order1") == ["b2"]
+    assert batch2.available_quantity == 10
+
+
+def test_replaying_the_changes_of_a_product_rebuilds_it() -> None:
+    product = Product("CLOCK", [])
+    product.add_batch(Batch("b1", "CLOCK", 10, eta=None))
+    product.add_batch(Batch("b2", "CLOCK", 10, eta=date.today(), location="PARIS"))
+    product.allocate(OrderLine("o1", "CLOCK", 8))
+    product.allocate(OrderLine("o2", "CLOCK", 5))
+    product.change_batch_quantity("b1", 6)
+    product.deallocate("o2")
+
+    replayed = Product("CLOCK", [])
+    for change in product.changes:
+        replayed.apply(change)
+
+    assert {
+        (
+            b.reference,
+            b.eta,
+            b.location,
+            b._purchased_quantity,
+            frozenset(b._allocations),
+        )
+        for b in replayed.batches
+    } == {
+        (
+            b.reference,
+            b.eta,
+            b.location,
+            b._purchased_quantity,
+            frozenset(b._allocations),
+        )
+        for b in product.batches
+    }
+
+
+def test_every_change_of_the_batches_increments_the_version_number() -> None:
+    product = Product("CLOCK", [])
+    product.add_batch(Batch("b1", "CLOCK", 10, eta=None))
+    product.allocate(OrderLine("o1", "CLOCK", 8))
+    product.change_batch_quantity("b1", 9)
+    product.deallocate("o1")
+
+    assert product.version_number == 4
+
+
+def test_held_stock_is_not_available_for_allocation() -> None:
+    batch = Batch("b1", "CLOCK", 10, eta=None)
+    product = Product("CLOCK", [batch])
+    expires_at = datetime(2030, 1, 1)
+
+    assert product.reserve(OrderLine("o1", "CLOCK", 8), expires_at) == "b1"
+
+    assert batch.available_quantity == 2
+    assert product.allocate(OrderLine("o2", "CLOCK", 5)) is None
+    assert product.events == [events.OutOfStock("CLOCK")]
+
+
+def test_expired_holds_do_not_hold_stock_before_they_are_released() -> None:
+    batch = Batch("b1", "CLOCK", 10, eta=None)
+    product = Product("CLOCK", [batch])
+    product.reserve(OrderLine("o1", "CLOCK", 8), datetime.utcnow() - timedelta(1))
+
+    assert batch.available_quantity == 10
+    assert product.allocate(OrderLine("o2", "CLOCK", 10)) == "b1"
+
+
+def test_confirm_turns_unexpired_holds_into_allocations() -> None:
+    batch = Batch("b1", "CLOCK", 10, eta=None)
+    product = Product("CLOCK", [batch])
+    product.reserve(OrderLine("o1", "CLOCK", 3), datetime(2030, 1, 1))
+    product.reserve(OrderLine("o1", "CLOCK", 2), datetime(2020, 1, 1))
+
+    assert product.confirm("o1", now=datetime(2025, 1, 1)) == ["b1"]
+
+    assert batch._allocations == {OrderLine("o1", "CLOCK", 3)}
+    assert batch._reservations == set()
+    assert batch.available_quantity == 7
+
+
+def test_release_gives_back_the_held_stock() -> None:
+    batch = Batch("b1", "CLOCK", 10, eta=None)
+    product = Product("CLOCK", [batch])
+    product.reserve(OrderLine("o1", "CLOCK", 3), datetime(2030, 1, 1))
+
+    assert product.release("o1") == ["b1"]
+    assert product.release("o1") == []
+    assert batch.available_quantity == 10
+
+
+def test_shrinking_a_batch_moves_its_holds_before_its_allocations() -> None:
+    b1 = Batch("b1", "CLOCK", 10, eta=None)
+    b2 = Batch("b2", "CLOCK", 10, eta=date.today())
+    product = Product("CLOCK", [b1, b2])
+    product.allocate(OrderLine("o1", "CLOCK", 5))
+    product.reserve(OrderLine("o2", "CLOCK", 5), datetime(2030, 1, 1))
+
+    product.change_batch_quantity("b1", 5)
+
+    assert b1._allocations == {OrderLine("o1", "CLOCK", 5)}
+    assert b2._reservations == {
+        Reservation("o2", "CLOCK", 5, datetime(2030, 1, 1)),
+    }
+    assert product.events == []
+
+
+def test_replaying_holds_rebuilds_them() -> None:
+    product = Product("CLOCK", [])
+    product.add_batch(Batch("b1", "CLOCK", 10, eta=None))
+    product.reserve(OrderLine("o1", "CLOCK", 3), datetime(2030, 1, 1))
+    product.reserve(OrderLine("o2", "CLOCK", 2), datetime(2030, 1, 1))
+    product.reserve(OrderLine("o3", "CLOCK", 1), datetime(2030, 1, 1))
+    product.confirm("o1", now=datetime(2025, 1, 1))
+    product.release("o2")
+
+    replayed = Product("CLOCK", [])
+    for change in product.changes:
+        replayed.apply(change)
+
+    [batch] = replayed.batches
+    assert batch._allocations == {OrderLine("o1", "CLOCK", 3)}
+    assert batch._reservations == {Reservation("o3", "CLOCK", 1, datetime(2030, 1, 1))}
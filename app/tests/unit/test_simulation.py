@@ -0,0 +1,71 @@
+"""Tests for the what-if allocation simulator."""
+import random
+from datetime import date, timedelta
+from typing import List, Optional
+
+from app.domain import commands
+from app.domain.model import Batch, OrderLine, Product
+from app.service_layer.simulation import Simulation, stock_from_products
+
+
+def random_product(rng: random.Random, sku: str) -> Product:
+    locations: List[Optional[str]] = [None, "LONDON", "PARIS"]
+    etas: List[Optional[date]] = [None] + [
+        date(2030, 1, 1) + timedelta(days=d) for d in range(3)
+    ]
+    batches = [
+        Batch(
+            f"{sku}-{i}",
+            sku,
+            rng.randint(0, 30),
+            rng.choice(etas),
+            rng.choice(locations),
+        )
+        for i in range(rng.randint(0, 12))
+    ]
+    product = Product(sku, batches)
+    for i in range(rng.randint(0, 5)):
+        product.allocate(OrderLine(f"existing-{i}", sku, rng.randint(1, 10)))
+    return product
+
+
+def test_simulation_matches_allocating_with_the_domain_model() -> None:
+    rng = random.Random(42)
+    products = [random_product(rng, f"SKU{i}") for i in range(20)]
+    simulation = Simulation(stock_from_products(products))
+    orders = [
+        commands.Allocate(
+            f"order-{i}",
+            rng.choice(["SKU0", "SKU1", "SKU2"] + [p.sku for p in products]),
+            rng.randint(1, 15),
+            destination=rng.choice([None, "LONDON", "PARIS", "BERLIN"]),
+        )
+        for i in range(2000)
+    ]
+    by_sku = {product.sku: product for product in products}
+
+    for order in orders:
+        expected = by_sku[order.sku].allocate(
+            OrderLine(order.orderid, order.sku, order.qty), order.destination
+        )
+        assert simulation.allocate(order.sku, order.qty, order.destination) == expected
+
+
+def test_simulation_reports_fill_rates_without_changing_the_stock() -> None:
+    product = Product("LAMP", [Batch("b1", "LAMP", 10, None)])
+    stock = stock_from_products([product])
+    orders = [
+        commands.Allocate("o1", "LAMP", 6),
+        commands.Allocate("o2", "LAMP", 6),
+        commands.Allocate("o3", "LAMP", 4),
+        commands.Allocate("o4", "CHAIR", 1),
+    ]
+
+    reports = Simulation(stock).run(orders)
+
+    assert reports["LAMP"].allocated == 2
+    assert reports["LAMP"].out_of_stock == 1
+    assert reports["LAMP"].fill_rate == 10 / 16
+    assert reports["CHAIR"].out_of_stock == 1
+    assert reports["CHAIR"].fill_rate == 0
+    assert list(stock["LAMP"].available) == [10]
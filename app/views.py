@@ -0,0 +1,263 @@
+"""Read-only queries for the api, kept out of the domain model.
+
+The views read the tables directly through a ReadOnlyUnitOfWork, so they run on a
+read replica when one is configured and may be slightly behind the primary. They
+read the tables of the orm persistence mode, or the streams of changes of the
+products in the events persistence mode.
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select
+
+from app import config
+from app.adapters import orm
+from app.adapters.cache import TTLCache
+from app.adapters.event_store import EventSourcedRepository
+from app.adapters.repository import batch_available_quantity
+from app.service_layer.unit_of_work import ReadOnlyUnitOfWork
+
+
+def allocations(orderid: str, uow: ReadOnlyUnitOfWork) -> List[Dict[str, str]]:
+    """Get the batches the lines of an order are allocated to.
+
+    Lines of archived batches are read from the archive tables.
+
+    Args:
+        orderid: id of the order
+        uow: read-only unit of work
+
+    Returns:
+        the sku and batchref of every allocated line of the order
+    """
+    if config.get_persistence() == "events":
+        with uow:
+            products = EventSourcedRepository(uow.session).list_by_orderid(orderid)
+            return [
+                {"sku": line.sku, "batchref": batch.reference}
+                for product in products
+                for batch in product.batches
+                for line in batch._allocations
+                if line.order_id == orderid
+            ]
+    live = (
+        select([orm.order_lines.c.sku, orm.batches.c.reference])
+        .select_from(
+            orm.order_lines.join(
+                orm.allocations,
+                orm.allocations.c.orderline_id == orm.order_lines.c.id,
+            ).join(orm.batches, orm.allocations.c.batch_id == orm.batches.c.id)
+        )
+        .where(orm.order_lines.c.order_id == orderid)
+    )
+    lines, allocated = orm.archived_order_lines, orm.archived_allocations
+    archived = (
+        select([lines.c.sku, orm.archived_batches.c.reference])
+        .select_from(
+            lines.join(allocated, allocated.c.orderline_id == lines.c.id).join(
+                orm.archived_batches,
+                allocated.c.batch_id == orm.archived_batches.c.id,
+            )
+        )
+        .where(lines.c.order_id == orderid)
+    )
+    with uow:
+        rows = uow.session.execute(live.union_all(archived))
+        return [{"sku": sku, "batchref": batchref} for sku, batchref in rows]
+
+
+def availability(sku: str, uow: ReadOnlyUnitOfWork) -> List[Dict[str, Any]]:
+    """Get the batches of a product that can still be allocated to.
+
+    Args:
+        sku: sku of the product
+        uow: read-only unit of work
+
+    Returns:
+        the batchref, eta, location and quantity that is neither allocated nor
+        held of the batches
+    """
+    if config.get_persistence() == "events":
+        with uow:
+            product = EventSourcedRepository(uow.session).get(sku)
+            batches = product.batches if product is not None else []
+            return [
+                {
+                    "batchref": batch.reference,
+                    "eta": batch.eta.isoformat() if batch.eta else None,
+                    "location": batch.location,
+                    "available": batch.available_quantity,
+                }
+                for batch in sorted(batches, key=lambda batch: batch.reference)
+                if batch.available_quantity > 0
+            ]
+    available = batch_available_quantity()
+    with uow:
+        rows = uow.session.execute(
+            select(
+                [
+                    orm.batches.c.reference,
+                    orm.batches.c.eta,
+                    orm.batches.c.location,
+                    available.label("available"),
+                ]
+            )
+            .where(orm.batches.c.sku == sku)
+            .where(available > 0)
+            .order_by(orm.batches.c.reference)
+        )
+        return [
+            {
+                "batchref": row.reference,
+                "eta": row.eta.isoformat() if row.eta else None,
+                "location": row.location,
+                "available": row.available,
+            }
+            for row in rows
+        ]
+
+
+def product_version(sku: str, uow: ReadOnlyUnitOfWork) -> Optional[int]:
+    """Get the version of a product with a primary key lookup.
+
+    Args:
+        sku: sku of the product
+        uow: read-only unit of work
+
+    Returns:
+        the version number, None if the product does not exist
+    """
+    with uow:
+        if config.get_persistence() == "events":
+            version = uow.session.execute(
+                select([func.max(orm.product_events.c.version)]).where(
+                    orm.product_events.c.sku == sku
+                )
+            ).scalar()
+        else:
+            version = uow.session.execute(
+                select([orm.products.c.version_number]).where(orm.products.c.sku == sku)
+            ).scalar()
+        return int(version) if version is not None else None
+
+
+def product(sku: str, uow: ReadOnlyUnitOfWork) -> Optional[Dict[str, Any]]:
+    """Get a product with its batches.
+
+    The version and the batches are read in one transaction.
+
+    Args:
+        sku: sku of the product
+        uow: read-only unit of work
+
+    Returns:
+        the sku, version and batches of the product, None if it does not exist
+    """
+    if config.get_persistence() == "events":
+        with uow:
+            found = EventSourcedRepository(uow.session).get(sku)
+            if found is None:
+                return None
+            return {
+                "sku": sku,
+                "version": found.version_number,
+                "batches": [
+                    {
+                        "batchref": batch.reference,
+                        "eta": batch.eta.isoformat() if batch.eta else None,
+                        "location": batch.location,
+                        "purchased": batch._purchased_quantity,
+                        "available": batch.available_quantity,
+                    }
+                    for batch in sorted(
+                        found.batches, key=lambda batch: batch.reference
+                    )
+                ],
+            }
+    available = batch_available_quantity()
+    with uow:
+        version = uow.session.execute(
+            select([orm.products.c.version_number]).where(orm.products.c.sku == sku)
+        ).scalar()
+        if version is None:
+            return None
+        rows = uow.session.execute(
+            select(
+                [
+                    orm.batches.c.reference,
+                    orm.batches.c.eta,
+                    orm.batches.c.location,
+                    orm.batches.c._purchased_quantity,
+                    available.label("available"),
+                ]
+            )
+            .where(orm.batches.c.sku == sku)
+            .order_by(orm.batches.c.reference)
+        )
+        return {
+            "sku": sku,
+            "version": version,
+            "batches": [
+                {
+                    "batchref": row.reference,
+                    "eta": row.eta.isoformat() if row.eta else None,
+                    "location": row.location,
+                    "purchased": row._purchased_quantity,
+                    "available": row.available,
+                }
+                for row in rows
+            ],
+        }
+
+
+def etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    """Check whether an If-None-Match header holds an entity tag.
+
+    Args:
+        etag: the current entity tag, quoted
+        if_none_match: value of the If-None-Match header of the request
+
+    Returns:
+        True when the client already has the current representation
+    """
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (
+        tag[2:] if tag.startswith("W/") else tag for tag in tags
+    )
+
+
+def product_if_changed(
+    sku: str,
+    if_none_match: Optional[str],
+    uow_factory: Callable[[], ReadOnlyUnitOfWork],
+    cache: TTLCache[Dict[str, Any]],
+) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """Get a product for a conditional GET, keyed on its version.
+
+    Only the version is looked up when the client has the current version, the
+    product itself comes from the cache when this version was read before.
+
+    Args:
+        sku: sku of the product
+        if_none_match: value of the If-None-Match header of the request
+        uow_factory: Callable that returns a read-only unit of work
+        cache: responses by sku and version
+
+    Returns:
+        the entity tag, None if the product does not exist, and the product,
+        None if the client already has it
+    """
+    version = product_version(sku, uow_factory())
+    if version is None:
+        return None, None
+    etag = f'"{version}"'
+    if etag_matches(etag, if_none_match):
+        return etag, None
+    body = cache.get((sku, version))
+    if body is None:
+        body = product(sku, uow_factory())
+        if body is None:
+            return None, None
+        cache.set((sku, body["version"]), body)
+    return f'"{body["version"]}"', body
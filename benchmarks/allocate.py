@@ -0,0 +1,144 @@
+"""Allocate benchmark of the database backends.
+
+Runs allocations through the message bus from a number of threads, like the
+thread pool of the asgi app, against the tuned sqlite backend, sqlite with its
+default settings and postgres. Postgres is skipped when it can not be reached.
+
+Usage:
+    python -m benchmarks.allocate --allocations 2000 --threads 8
+"""
+import argparse
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+import app.config as config
+from app import bootstrap
+from app.adapters import sqlite
+from app.adapters.orm import metadata
+from app.domain import commands
+from app.service_layer import unit_of_work
+
+
+def random_ref(kind: str) -> str:
+    """Reference of a new sku, batch or order, unique within a run."""
+    return f"{kind}-{uuid.uuid4().hex[:8]}"
+
+
+def tuned_sqlite(directory: Path) -> Engine:
+    """Engine of the sqlite backend, WAL with a queue for the write lock."""
+    return sqlite.create_writer_engine(str(directory / "tuned.db"))
+
+
+def default_sqlite(directory: Path) -> Engine:
+    """Engine for sqlite with the defaults of pysqlite, as in the tests."""
+    engine = create_engine(
+        f"sqlite:///{directory / 'default.db'}",
+        connect_args={"check_same_thread": False},
+    )
+    metadata.create_all(engine)
+    return engine
+
+
+def postgres(directory: Path) -> Engine:
+    """Engine for the configured postgres database."""
+    engine = create_engine(config.get_postgres_uri(), isolation_level="REPEATABLE READ")
+    metadata.create_all(engine)
+    return engine
+
+
+BACKENDS: Dict[str, Callable[[Path], Engine]] = {
+    "sqlite": tuned_sqlite,
+    "sqlite-default": default_sqlite,
+    "postgres": postgres,
+}
+
+
+def run(engine: Engine, n_skus: int, allocations: int, threads: int) -> str:
+    """Allocate one unit at a time from a number of threads.
+
+    Allocations that lose a race are counted as conflicts, not retried.
+
+    Args:
+        engine: engine of the backend under test
+        n_skus: number of products the allocations are spread over
+        allocations: number of allocations per thread
+        threads: number of threads allocating at the same time
+
+    Returns:
+        a line with the throughput, latencies and conflicts
+    """
+    bus = bootstrap.bootstrap(session_factory=sessionmaker(bind=engine))
+    latencies: List[float] = []
+    conflicts: List[Exception] = []
+    try:
+        skus = [random_ref("sku") for _ in range(n_skus)]
+        for sku in skus:
+            bus.handle(commands.CreateBatch(random_ref("batch"), sku, 10**6, None))
+
+        def allocate(thread: int) -> None:
+            for i in range(allocations):
+                command = commands.Allocate(
+                    random_ref("order"), skus[(thread + i) % n_skus], 1
+                )
+                start = time.perf_counter()
+                try:
+                    bus.handle(command)
+                except Exception as e:
+                    if not unit_of_work.is_conflict(e):
+                        raise
+                    conflicts.append(e)
+                latencies.append(time.perf_counter() - start)
+
+        workers = [threading.Thread(target=allocate, args=(t,)) for t in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        duration = time.perf_counter() - start
+    finally:
+        bus.close()
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    return (
+        f"{len(latencies) / duration:>10.0f}/s{quantiles[49] * 1000:>9.1f}ms"
+        f"{quantiles[98] * 1000:>9.1f}ms{len(conflicts):>11}"
+    )
+
+
+def main() -> None:
+    """Run the allocate benchmark from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--allocations", type=int, default=200, help="per thread")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--skus", type=int, default=8)
+    parser.add_argument(
+        "--backends", nargs="+", choices=list(BACKENDS), default=list(BACKENDS)
+    )
+    args = parser.parse_args()
+
+    print(f"{'backend':<16}{'throughput':>12}{'p50':>11}{'p99':>11}{'conflicts':>11}")
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.backends:
+            try:
+                engine = BACKENDS[name](Path(directory))
+            except OperationalError as e:
+                result = f"  skipped, {type(e.orig).__name__}"
+            else:
+                result = run(engine, args.skus, args.allocations, args.threads)
+                engine.dispose()
+            print(f"{name:<16}{result}")
+
+
+if __name__ == "__main__":
+    main()
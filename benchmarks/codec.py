@@ -0,0 +1,54 @@
+"""Codec benchmark.
+
+Measures how many messages per second the codec encodes and decodes for every
+command and event type, next to json of dataclasses.asdict, the generic way of
+serializing the dataclasses without a schema.
+
+Usage:
+    python -m benchmarks.codec --number 20000
+"""
+import argparse
+import dataclasses
+import json
+import timeit
+from datetime import date
+from typing import Any, Dict
+
+from app.adapters import codec
+from app.domain import commands, events
+
+SAMPLES: Dict[str, codec.Message] = {
+    "Allocate": commands.Allocate("order1", "RED-CHAIR", 10, "LONDON", "key-1"),
+    "CreateBatch": commands.CreateBatch("batch1", "RED-CHAIR", 100, date(2011, 1, 2)),
+    "ChangeBatchQuantity": commands.ChangeBatchQuantity("batch1", 50),
+    "Deallocate": commands.Deallocate("order1"),
+    "Allocated": events.Allocated("RED-CHAIR", "order1", 10, "batch1"),
+    "BatchAdded": events.BatchAdded("RED-CHAIR", "batch1", 100, date(2011, 1, 2)),
+}
+
+
+def _asdict_json(message: Any) -> str:
+    """Serialize a message the generic way, for comparison."""
+    return json.dumps(dataclasses.asdict(message), default=str)
+
+
+def main() -> None:
+    """Run the codec benchmark from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f"{'message':<22}{'encode':>12}{'decode':>12}{'asdict':>12}{'bytes':>8}")
+    for name, message in SAMPLES.items():
+        data = codec.encode(message)
+        encode = timeit.timeit(lambda: codec.encode(message), number=args.number)
+        decode = timeit.timeit(lambda: codec.decode(data), number=args.number)
+        asdict = timeit.timeit(lambda: _asdict_json(message), number=args.number)
+        print(
+            f"{name:<22}{args.number / encode:>10.0f}/s{args.number / decode:>10.0f}/s"
+            f"{args.number / asdict:>10.0f}/s{len(data):>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Startup benchmark.
+
+Measures in fresh interpreters how long it takes to import the modules of the app
+and to bootstrap it, which is what CLI tools, tests and cold workers pay before
+they handle their first message.
+
+Usage:
+    python -m benchmarks.startup --runs 10
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+STARTUP_STATEMENTS: Dict[str, str] = {
+    "python": "pass",
+    "domain": "import app.domain.model",
+    "unit_of_work": "import app.service_layer.unit_of_work",
+    "message_bus": "import app.service_layer.message_bus",
+    "flask_app": "import app.entrypoints.flask_app",
+    "asgi_app": "import app.entrypoints.asgi_app",
+    "bootstrap": "from app import bootstrap; bootstrap.bootstrap()",
+}
+
+
+def time_statement(statement: str, runs: int) -> List[float]:
+    """Time a statement in fresh interpreters.
+
+    Args:
+        statement: python code to run
+        runs: number of interpreters to start
+
+    Returns:
+        wall clock seconds of each run
+    """
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main() -> None:
+    """Run the startup benchmark from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'startup':<14}{'min':>10}{'median':>10}")
+    for name, statement in STARTUP_STATEMENTS.items():
+        timings = time_statement(statement, args.runs)
+        print(
+            f"{name:<14}{min(timings) * 1000:>8.1f}ms"
+            f"{statistics.median(timings) * 1000:>8.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()